@@ -0,0 +1,154 @@
+"""
+Benchmarks the top-k algorithms against SimulatedRanker over a grid of job sizes,
+concurrency levels and cache warmth, and prints the results as JSON.
+
+Run from the repository root, e.g.:
+
+    PYTHONPATH=src python benchmarks/run.py --n 100 1000 --k 10 --concurrency 1 8 --latency 0.01
+
+Each result records the configuration along with:
+- wall_seconds: time taken to find the top k
+- comparisons: comparisons made by the algorithm (including cache hits)
+- model_calls: comparisons that reached the simulated model
+- cache_hits and cache_misses
+- rate_limited: calls rejected with RateLimitedError (each is retried by a RequestScheduler,
+  after a random delay of up to retry_delay, doubled for each consecutive rejection)
+- concurrency_decreases: how often the RequestScheduler lowered its concurrency limit
+- agreement: the fraction of the true top k that was found
+- exact: whether the true top k was found in the right order
+"""
+from argparse import ArgumentParser
+from itertools import product
+from rank_files.algos import ComparisonTracker, TopKAlgorithm, select_top_k
+from rank_files.cache import Cache
+from rank_files.document import StrDocument
+from rank_files.ranker import SimulatedRanker
+from rank_files.scheduler import RequestScheduler
+import json
+import random
+import sys
+import time
+
+
+CRITERIA = "The best document has the lowest rank."
+
+# Enough attempts that a comparison practically never fails for good, even with a high
+# --rate-limit-rate.
+MAX_ATTEMPTS = 100
+
+
+def make_documents(n: int, seed: int) -> list[StrDocument]:
+    """
+    Returns n documents, each with a label and a rank. The labels are shuffled relative to the
+    ranks, so that the order of the documents in prompts doesn't correlate with their quality.
+    """
+    labels = list(range(n))
+    random.Random(seed).shuffle(labels)
+    return [StrDocument(f"{label:07d} {rank:07d}") for rank, label in enumerate(labels)]
+
+
+def rank_key(text: str) -> str:
+    return text.split()[1]
+
+
+def warm_cache(cache: Cache, docs: list[StrDocument], algorithm: TopKAlgorithm, k: int, concurrency: int, warmth: float, options: dict) -> None:
+    """
+    Stores the results of a random fraction (warmth) of the comparisons the job will make,
+    by running it once with an instant simulated model and copying some of its results.
+    """
+    if warmth <= 0:
+        return
+    scratch = Cache(":memory:")
+    ranker = SimulatedRanker(error_rate=options["error_rate"], position_bias=options["position_bias"], cache=scratch, seed=options["seed"], sort_key=rank_key)
+    select_top_k(algorithm, k, ranker.wrap_for_pairwise_comparison(CRITERIA, docs), concurrency=concurrency)
+    chooser = random.Random(options["seed"])
+    context = ranker.records.key(CRITERIA, docs[0], docs[1])
+    for key, winner in scratch.comparisons_matching(context.provider, context.model, context.system_digest, context.criteria_digest):
+        if chooser.random() < warmth:
+            cache.put_comparison(key, winner)
+    cache.flush()
+
+
+def run_benchmark(algorithm: TopKAlgorithm, n: int, k: int, concurrency: int, warmth: float, options: dict) -> dict:
+    """Runs one job and returns its configuration and measurements."""
+    docs = make_documents(n, options["seed"])
+    with Cache(":memory:") as cache:
+        warm_cache(cache, docs, algorithm, k, concurrency, warmth, options)
+        cache.total_hits = cache.total_misses = 0
+        scheduler = RequestScheduler(max_concurrency=concurrency, max_attempts=MAX_ATTEMPTS, base_delay=options["retry_delay"], max_delay=options["retry_delay"] * 64, seed=options["seed"])
+        ranker = SimulatedRanker(
+            latency=options["latency"],
+            latency_spread=options["latency_spread"],
+            error_rate=options["error_rate"],
+            position_bias=options["position_bias"],
+            rate_limit_rate=options["rate_limit_rate"],
+            cache=cache,
+            seed=options["seed"],
+            sort_key=rank_key,
+            scheduler=scheduler,
+        )
+        tracker = ComparisonTracker()
+        items = tracker.wrap(ranker.wrap_for_pairwise_comparison(CRITERIA, docs))
+        start = time.perf_counter()
+        results = ranker.unwrap(tracker.unwrap(select_top_k(algorithm, k, items, concurrency=concurrency)))
+        wall_seconds = time.perf_counter() - start
+        truth = sorted(docs, key=lambda doc: rank_key(doc.text))[:k]
+        return {
+            "algorithm": str(algorithm),
+            "n": n,
+            "k": k,
+            "concurrency": concurrency,
+            "warmth": warmth,
+            **options,
+            "wall_seconds": wall_seconds,
+            "comparisons": tracker.total,
+            "model_calls": ranker.total_calls - ranker.total_rate_limited,
+            "cache_hits": cache.total_hits,
+            "cache_misses": cache.total_misses,
+            "rate_limited": ranker.total_rate_limited,
+            "concurrency_decreases": scheduler.concurrency.total_decreases,
+            "agreement": len({doc.text for doc in results} & {doc.text for doc in truth}) / len(truth) if truth else 1.0,
+            "exact": [doc.text for doc in results] == [doc.text for doc in truth],
+        }
+
+
+def main() -> None:
+    parser = ArgumentParser(description="Benchmark the top-k algorithms with a simulated model.")
+    parser.add_argument("--algorithm", nargs="+", default=list(TopKAlgorithm), choices=list(TopKAlgorithm))
+    parser.add_argument("--n", nargs="+", type=int, default=[100, 1000])
+    parser.add_argument("--k", nargs="+", type=int, default=[10])
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 8])
+    parser.add_argument("--warmth", nargs="+", type=float, default=[0.0, 0.5], help="Fraction of the job's comparisons cached beforehand")
+    parser.add_argument("--latency", type=float, default=0.001, help="Median seconds per model call")
+    parser.add_argument("--latency-spread", type=float, default=0.5, help="Sigma of the log of the latency factor")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--position-bias", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--retry-delay", type=float, default=0.01, help="Most seconds to wait after a first simulated rate-limit error")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-o", "--output", type=str, help="Write results to this file instead of stdout")
+    args = parser.parse_args()
+    options = {
+        "latency": args.latency,
+        "latency_spread": args.latency_spread,
+        "error_rate": args.error_rate,
+        "position_bias": args.position_bias,
+        "rate_limit_rate": args.rate_limit_rate,
+        "retry_delay": args.retry_delay,
+        "seed": args.seed,
+    }
+    results = []
+    for algorithm, n, k, concurrency, warmth in product(args.algorithm, args.n, args.k, args.concurrency, args.warmth):
+        result = run_benchmark(TopKAlgorithm(algorithm), n, k, concurrency, warmth, options)
+        print(f"{algorithm} n={n} k={k} concurrency={concurrency} warmth={warmth}: {result['wall_seconds']:.3f}s", file=sys.stderr)
+        results.append(result)
+    output = json.dumps(results, indent=2)
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Benchmarks tournament() against array_tournament() with a cheap comparison (random floats,
+standing in for e.g. cached scores), and prints the results as JSON.
+
+Run from the repository root, e.g.:
+
+    PYTHONPATH=src python benchmarks/tournament.py --n 1000 1000000 --k 10
+
+Each result records the configuration along with:
+- wall_seconds: time taken to find the top k
+- comparisons: comparisons made, counted by a ComparisonTracker (when --count is given, as
+  it is by default; counting adds its own overhead)
+- estimate: tournament_estimated_comparisons() for the configuration
+- exact: whether the true top k was found in the right order
+"""
+from argparse import ArgumentParser, BooleanOptionalAction
+from itertools import product
+from rank_files.algos import ComparisonTracker, array_tournament, tournament, tournament_estimated_comparisons
+import json
+import random
+import sys
+import time
+
+
+ENGINES = ["tournament", "array_tournament"]
+
+
+def run_benchmark(engine: str, n: int, k: int, count: bool, seed: int) -> dict:
+    """Runs one job and returns its configuration and measurements."""
+    rng = random.Random(seed)
+    items = [rng.random() for _ in range(n)]
+    tracker = ComparisonTracker()
+    start = time.perf_counter()
+    if engine == "tournament":
+        results = tracker.unwrap(tournament(k, tracker.wrap(items))) if count else tournament(k, items)
+    else:
+        results = array_tournament(k, items, tracker.comparator()) if count else array_tournament(k, items)
+    wall_seconds = time.perf_counter() - start
+    return {
+        "engine": engine,
+        "n": n,
+        "k": k,
+        "count": count,
+        "seed": seed,
+        "wall_seconds": wall_seconds,
+        "comparisons": tracker.total if count else None,
+        "estimate": tournament_estimated_comparisons(k, n),
+        "exact": results == sorted(items, reverse=True)[:k],
+    }
+
+
+def main() -> None:
+    parser = ArgumentParser(description="Benchmark the tournament engines with a cheap comparison.")
+    parser.add_argument("--engine", nargs="+", default=ENGINES, choices=ENGINES)
+    parser.add_argument("--n", nargs="+", type=int, default=[1000, 10000, 100000, 1000000])
+    parser.add_argument("--k", nargs="+", type=int, default=[10])
+    parser.add_argument("--count", action=BooleanOptionalAction, default=True, help="Count the comparisons")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-o", "--output", type=str, help="Write results to this file instead of stdout")
+    args = parser.parse_args()
+    results = []
+    for engine, n, k in product(args.engine, args.n, args.k):
+        result = run_benchmark(engine, n, k, args.count, args.seed)
+        print(f"{engine} n={n} k={k}: {result['wall_seconds']:.3f}s", file=sys.stderr)
+        results.append(result)
+    output = json.dumps(results, indent=2)
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
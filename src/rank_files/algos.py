@@ -1,7 +1,15 @@
+from collections.abc import Awaitable, Callable, Generator, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import AbstractContextManager, nullcontext
+from enum import StrEnum
 from functools import total_ordering
-from typing import Self, Optional
+from typing import NamedTuple, Self, Optional
+from rank_files.trace import Tracer
 from tqdm import tqdm
+import asyncio
 import math
+import operator
+import threading
 
 
 class MaxComparisonsExceededError(ValueError):
@@ -18,6 +26,8 @@ class ComparisonSpy:
     Used by ComparisonTracker to wrap arbitrary objects and report on the comparison operation
     invoked on them.
     """
+    __slots__ = ("val", "tracker")
+
     def __init__(self, val, tracker: "ComparisonTracker") -> None:
         self.val = val
         self.tracker = tracker
@@ -26,10 +36,15 @@ class ComparisonSpy:
         return self.val == other.val
     
     def __lt__(self, other) -> bool:
-        if self.tracker.max_comparisons is not None and self.tracker.total >= self.tracker.max_comparisons:
-            raise MaxComparisonsExceededError()
-        self.tracker.inc()
-        return self.val < other.val
+        self.tracker.count()
+        with self.tracker.trace():
+            return self.val < other.val
+
+    async def async_lt(self, other) -> bool:
+        """Like __lt__, but for values which implement async_lt() (e.g. AsyncPairwiseWrapper)."""
+        self.tracker.count()
+        with self.tracker.trace():
+            return await self.val.async_lt(other.val)
 
 
 class ComparisonTracker:
@@ -45,11 +60,18 @@ class ComparisonTracker:
     comparisons will raise a MaxComparisonsExceededError.
 
     If pbar is provided, it will be updated every time a comparison occurs.
+
+    If tracer is provided, each comparison is traced with it; see Tracer.
+
+    Wrapped objects may be compared from multiple threads at once (see tournament()'s
+    concurrency parameter); the tracker's state is guarded by a lock.
     """
-    def __init__(self, max_comparisons: Optional[int] = None, pbar: Optional[tqdm] = None) -> None:
+    def __init__(self, max_comparisons: Optional[int] = None, pbar: Optional[tqdm] = None, tracer: Optional[Tracer] = None) -> None:
         self.total = 0
         self.max_comparisons = max_comparisons
         self.pbar = pbar
+        self.tracer = tracer
+        self.lock = threading.Lock()
 
     def wrap(self, items: list) -> list[ComparisonSpy]:
         """
@@ -63,8 +85,49 @@ class ComparisonTracker:
         """Call this on the result of wrap() to get back the original objects."""
         return [x.val for x in wrapped]
     
+    def counted(self, best_of: Callable[[list], int]) -> Callable[[list], int]:
+        """
+        Wraps a function for choosing the best of a group of items (see multiway_tournament())
+        so that each call is tracked like a comparison.
+        """
+        def wrapper(group: list) -> int:
+            self.count()
+            with self.trace():
+                return best_of(group)
+        return wrapper
+
+    def comparator(self, less: Callable[[object, object], bool] = operator.lt) -> Callable[[object, object], bool]:
+        """
+        Wraps a less-than function (see array_tournament()) so that each call is tracked like
+        a comparison. Unlike wrap(), this doesn't create an object per item.
+        """
+        def wrapper(a, b) -> bool:
+            self.count()
+            with self.trace():
+                return less(a, b)
+        return wrapper
+
+    def trace(self) -> AbstractContextManager:
+        """Returns a context manager which traces the enclosed comparison, if there is a tracer."""
+        if self.tracer is None:
+            return nullcontext()
+        return self.tracer.comparison()
+
+    def count(self) -> None:
+        """
+        Records a new comparison, first raising MaxComparisonsExceededError if the maximum
+        has already been reached.
+        """
+        with self.lock:
+            if self.max_comparisons is not None and self.total >= self.max_comparisons:
+                raise MaxComparisonsExceededError()
+            self.inc()
+
     def inc(self) -> None:
-        """Used by ComparisonSpy to indicate that a new comparison should be recorded."""
+        """
+        Used by ComparisonSpy to indicate that a new comparison should be recorded.
+        The caller must hold self.lock.
+        """
         self.total += 1
         if self.pbar is not None:
             self.pbar.update(1)
@@ -72,47 +135,104 @@ class ComparisonTracker:
 
 class Node:
     """A binary tree node."""
+    __slots__ = ("val", "left", "right")
+
     def __init__(self, val, left: Self = None, right: Self = None) -> None:
         self.val = val
         self.left = left
         self.right = right
 
 
-def tournament(k: int, items: list) -> list:
+class TournamentState:
     """
-    This finds the top-k greatest items in the given list, sorted from greatest to least.
+    The progress of a tournament: the tree of matches, and the greatest items found so far,
+    in order. Passing the same state to a later call with a larger k (and the same items)
+    continues where the earlier call stopped, without repeating any comparisons.
 
-    This requires approximately (n-1)+(k-1)log(n) comparison operations.
+    The state can be converted to and from JSON-compatible data, in which items are represented
+    by their positions in the items list.
+    """
+    def __init__(self) -> None:
+        self.root: Optional[Node] = None
+        self.result: list = []
 
-    I compared it with a couple heap-based algorithms and a quickselect-based algorithm;
-    for small n (e.g. 10000 or less) and small k relative to n (e.g k=10) it seems to
-    require the fewest comparison operations. That's the usage pattern I expect for this
-    tool; for other projects, other algorithms would be more appropriate.
+    def to_json(self, items: list) -> dict:
+        """Returns JSON-compatible data describing the state of a tournament over the given items."""
+        positions = {id(item): i for i, item in enumerate(items)}
 
-    TODO: I don't think this is the same as Knuth's tournament algorithm, and I haven't
-    compared performance with that.
+        def encode(node: Node):
+            if node.left is None:
+                return positions[id(node.val)]
+            return [positions[id(node.val)], encode(node.left), encode(node.right)]
+
+        return {
+            "root": None if self.root is None else encode(self.root),
+            "result": [positions[id(item)] for item in self.result],
+        }
+
+    @classmethod
+    def from_json(cls, data: dict, items: list) -> Self:
+        """Creates a state from the output of to_json() and the same list of items (or equivalents)."""
+        def decode(encoded) -> Node:
+            if isinstance(encoded, int):
+                return Node(items[encoded])
+            return Node(items[encoded[0]], decode(encoded[1]), decode(encoded[2]))
+
+        state = cls()
+        state.root = None if data["root"] is None else decode(data["root"])
+        state.result = [items[i] for i in data["result"]]
+        return state
+
+
+# A generator that yields batches of (a, b) pairs which are independent of each other.
+# It must be sent back a list containing the result of a < b for each pair, in the same order.
+# Its return value is the final result of the algorithm.
+ComparisonSteps = Generator[list[tuple], list[bool], list]
+
+
+def tournament_steps(k: int, items: list, state: Optional[TournamentState] = None, checkpoint: Optional[Callable[[TournamentState], None]] = None) -> ComparisonSteps:
+    """
+    Implements the algorithm described in tournament() as a ComparisonSteps generator.
+
+    When building the initial tree, every match whose two children have already been decided
+    is yielded in the same batch, so the first-place phase takes about log2(n) batches.
+    Finding each runner-up requires a chain of comparisons that each depend on the previous
+    one, so those are yielded one at a time.
+
+    If state is provided, it is resumed from and updated as the algorithm progresses.
+    If checkpoint is provided, it is called with the state each time a new item is added to
+    the result; those are the only times the state is consistent while the algorithm runs.
     """
     k = min(k, len(items))
-    if k == 0:
-        return []
+    state = TournamentState() if state is None else state
+    if k <= len(state.result):
+        return state.result[:k]
 
-    def build_tree(array: list) -> Optional[Node]:
-        if len(array) == 1:
-            return Node(array[0])
-        mid = len(array) // 2
-        left = build_tree(array[:mid])
-        right = build_tree(array[mid:])
-        if left.val < right.val:
-            return Node(right.val, left, right)
-        return Node(left.val, right, left)
-    
-    def next_best(node: Node) -> Optional[Node]:
+    # levels[h] holds the internal nodes whose subtrees have height h+1; all the matches in
+    # one level depend only on matches in lower levels.
+    levels: list[list[Node]] = []
+
+    def build_tree(lo: int, hi: int) -> tuple[Node, int]:
+        if hi - lo == 1:
+            return Node(items[lo]), 0
+        mid = lo + (hi - lo) // 2
+        left, left_height = build_tree(lo, mid)
+        right, right_height = build_tree(mid, hi)
+        height = max(left_height, right_height) + 1
+        if len(levels) < height:
+            levels.append([])
+        node = Node(None, left, right)
+        levels[height - 1].append(node)
+        return node, height
+
+    def next_best(node: Node) -> Generator[list[tuple], list[bool], Optional[Node]]:
         if node is None:
             return None
-        right = next_best(node.right)
+        right = yield from next_best(node.right)
         if right is None:
             return node.left
-        if node.left.val < right.val:
+        [less] = yield [(node.left.val, right.val)]
+        if less:
             node.val = right.val
             node.right = right
         else:
@@ -121,21 +241,615 @@ def tournament(k: int, items: list) -> list:
             node.left = right
         return node
 
-    root = build_tree(items)
+    if state.root is None:
+        root, _ = build_tree(0, len(items))
+        for level in levels:
+            results = yield [(node.left.val, node.right.val) for node in level]
+            for node, less in zip(level, results):
+                if less:
+                    node.val = node.right.val
+                else:
+                    node.val = node.left.val
+                    node.left, node.right = node.right, node.left
+        state.root = root
+        state.result[:] = [root.val]
+        if checkpoint is not None:
+            checkpoint(state)
+    while len(state.result) < k:
+        state.root = yield from next_best(state.root)
+        state.result.append(state.root.val)
+        if checkpoint is not None:
+            checkpoint(state)
+    return list(state.result)
+
+
+def run_steps(steps: ComparisonSteps, compare_all: Callable[[list[tuple]], list[bool]]) -> list:
+    """
+    Drives a ComparisonSteps generator to completion, using compare_all to resolve each batch of
+    comparisons, and returns the generator's result.
+    """
+    try:
+        batch = next(steps)
+        while True:
+            batch = steps.send(compare_all(batch))
+    except StopIteration as stop:
+        return stop.value
+
+
+def iter_steps(steps: ComparisonSteps, compare_all: Callable[[list[tuple]], list[bool]], results: list, limit: int) -> Iterator:
+    """
+    Like run_steps(), but a generator: results must be a list to which the steps generator
+    appends its results as it progresses, and each one is yielded as soon as it has been
+    appended, up to limit results. Any further results in the generator's return value are
+    yielded at the end.
+    """
+    emitted = 0
+    try:
+        batch = next(steps)
+        while True:
+            while emitted < min(limit, len(results)):
+                yield results[emitted]
+                emitted += 1
+            batch = steps.send(compare_all(batch))
+    except StopIteration as stop:
+        final = stop.value
+    yield from final[emitted:limit]
+
+
+async def run_steps_async(steps: ComparisonSteps, compare_all: Callable[[list[tuple]], Awaitable[list[bool]]]) -> list:
+    """The asyncio counterpart of run_steps()."""
+    try:
+        batch = next(steps)
+        while True:
+            batch = steps.send(await compare_all(batch))
+    except StopIteration as stop:
+        return stop.value
+
+
+def tournament(k: int, items: list, concurrency: int = 1, prefetch: Optional[Callable[[list[tuple]], None]] = None, state: Optional[TournamentState] = None, checkpoint: Optional[Callable[[TournamentState], None]] = None, schedule: Optional[Callable[[list[tuple]], list[int]]] = None) -> list:
+    """
+    This finds the top-k greatest items in the given list, sorted from greatest to least.
+
+    This requires approximately (n-1)+(k-1)log(n) comparison operations.
+
+    I compared it with a couple heap-based algorithms and a quickselect-based algorithm;
+    for small n (e.g. 10000 or less) and small k relative to n (e.g k=10) it seems to
+    require the fewest comparison operations. That's the usage pattern I expect for this
+    tool; for other projects, other algorithms would be more appropriate.
+
+    If concurrency is greater than 1, independent comparisons are performed in parallel on
+    a pool of that many threads. The same comparisons are performed either way, so the
+    result and the number of comparisons do not depend on the concurrency.
+
+    If prefetch is provided, it is called with each batch of independent (a, b) pairs before
+    they are compared; see Ranker.prefetch().
+
+    If schedule is provided, it is called with each batch of independent (a, b) pairs and
+    should return the indices of the pairs in the order they should be compared; see
+    Ranker.schedule(). This doesn't change the result or the number of comparisons.
+
+    See tournament_steps() regarding state and checkpoint.
+
+    See select_top_k() for other algorithms (including Knuth's tournament), which can finish
+    sooner when comparisons run concurrently, and plan_top_k() for choosing between them.
+
+    To receive each item as soon as its place is known, use tournament_iter().
+
+    For many items with a cheap comparison (e.g. cached scores), array_tournament() does the
+    same comparisons with much less overhead.
+    """
+    return list(tournament_iter(k, items, concurrency, prefetch, state, checkpoint, schedule))
+
+
+def tournament_iter(k: int, items: list, concurrency: int = 1, prefetch: Optional[Callable[[list[tuple]], None]] = None, state: Optional[TournamentState] = None, checkpoint: Optional[Callable[[TournamentState], None]] = None, schedule: Optional[Callable[[list[tuple]], list[int]]] = None) -> Iterator:
+    """
+    Like tournament(), but a generator which yields the items from greatest to least as soon
+    as each is determined: the greatest once the initial tree has been built, and each
+    runner-up after the comparisons that find it. Items already found by a resumed state are
+    yielded immediately.
+    """
+    state = TournamentState() if state is None else state
+    steps = tournament_steps(k, items, state, checkpoint)
+    if prefetch is not None:
+        steps = _prefetching(steps, prefetch)
+    if schedule is not None:
+        steps = _scheduling(steps, schedule)
+    limit = min(k, len(items))
+    if concurrency <= 1:
+        yield from iter_steps(steps, lambda batch: [a < b for a, b in batch], state.result, limit)
+        return
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        yield from iter_steps(steps, lambda batch: list(executor.map(lambda pair: pair[0] < pair[1], batch)), state.result, limit)
+
+
+def _run_comparisons(steps: ComparisonSteps, concurrency: int, prefetch: Optional[Callable[[list[tuple]], None]], schedule: Optional[Callable[[list[tuple]], list[int]]] = None) -> list:
+    """Drives a ComparisonSteps generator using the < operator, as described in tournament()."""
+    if prefetch is not None:
+        steps = _prefetching(steps, prefetch)
+    if schedule is not None:
+        steps = _scheduling(steps, schedule)
+    if concurrency <= 1:
+        return run_steps(steps, lambda batch: [a < b for a, b in batch])
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return run_steps(steps, lambda batch: list(executor.map(lambda pair: pair[0] < pair[1], batch)))
+
+
+def _prefetching(steps: ComparisonSteps, prefetch: Callable[[list[tuple]], None]) -> ComparisonSteps:
+    """Wraps a ComparisonSteps generator so that prefetch is called on every batch it yields."""
+    try:
+        batch = next(steps)
+        while True:
+            prefetch(batch)
+            batch = steps.send((yield batch))
+    except StopIteration as stop:
+        return stop.value
+
+
+def _scheduling(steps: ComparisonSteps, schedule: Callable[[list[tuple]], list[int]]) -> ComparisonSteps:
+    """
+    Wraps a ComparisonSteps generator so that the pairs in every batch it yields are put in the
+    order given by schedule, and the results are put back in the original order.
+    """
+    try:
+        batch = next(steps)
+        while True:
+            order = schedule(batch)
+            results = yield [batch[i] for i in order]
+            unscheduled = [False] * len(batch)
+            for i, result in zip(order, results):
+                unscheduled[i] = result
+            batch = steps.send(unscheduled)
+    except StopIteration as stop:
+        return stop.value
+
+
+async def tournament_async(k: int, items: list, concurrency: Optional[int] = None, state: Optional[TournamentState] = None, checkpoint: Optional[Callable[[TournamentState], None]] = None) -> list:
+    """
+    The asyncio counterpart of tournament(). Items are compared by awaiting a.async_lt(b)
+    rather than with the < operator; see AsyncRanker.wrap_for_pairwise_comparison().
+
+    Independent comparisons run concurrently, at most concurrency at a time if it is set.
+    """
+    semaphore = asyncio.Semaphore(concurrency) if concurrency is not None else None
+
+    async def compare(a, b) -> bool:
+        if semaphore is None:
+            return await a.async_lt(b)
+        async with semaphore:
+            return await a.async_lt(b)
+
+    async def compare_all(batch: list[tuple]) -> list[bool]:
+        return list(await asyncio.gather(*(compare(a, b) for a, b in batch)))
+
+    return await run_steps_async(tournament_steps(k, items, state, checkpoint), compare_all)
+
+
+def array_tournament(k: int, items: list, less: Callable[[object, object], bool] = operator.lt) -> list:
+    """
+    Finds the top-k greatest items like tournament(), with at most as many comparisons (see
+    tournament_estimated_comparisons()), but for many items with a cheap comparison, such as
+    cached scores, for which tournament()'s objects and generators cost more than comparing.
+    less(a, b) is called for each comparison, and should return whether a is less than b; to
+    count the comparisons, use ComparisonTracker.comparator().
+
+    The tree is stored in a flat list of item indices, laid out like a binary heap: the leaves
+    (items[j]) are at n+j, and the node at i is the winner of the nodes at 2i and 2i+1, so the
+    winner is at 1. Each runner-up is found by marking the previous winner's leaf as removed
+    (-1) and replaying only the matches on its path to the root, without recursing.
+
+    Comparisons are made one at a time; there's no concurrency, prefetching or resuming.
+    """
+    n = len(items)
+    k = min(k, n)
+    if k <= 0:
+        return []
+    tree = [0] * n + list(range(n))
+    for i in range(n - 1, 0, -1):
+        a = tree[2 * i]
+        b = tree[2 * i + 1]
+        tree[i] = b if less(items[a], items[b]) else a
+    result = [tree[1]]
+    while len(result) < k:
+        pos = n + result[-1]
+        tree[pos] = -1
+        pos //= 2
+        while pos:
+            a = tree[2 * pos]
+            b = tree[2 * pos + 1]
+            if a < 0:
+                tree[pos] = b
+            elif b < 0:
+                tree[pos] = a
+            else:
+                tree[pos] = b if less(items[a], items[b]) else a
+            pos //= 2
+        result.append(tree[1])
+    return [items[i] for i in result]
+
+
+class GroupNode:
+    """A node in the tree used by multiway_tournament()."""
+    def __init__(self, val, children: Optional[list[Self]] = None) -> None:
+        self.val = val
+        self.children = [] if children is None else children
+        # The index of the child whose val is this node's val.
+        self.best = 0
+
+
+def multiway_tournament_steps(k: int, items: list, m: int) -> Generator[list[list], list[int], list]:
+    """
+    Implements the algorithm described in multiway_tournament(). Like tournament_steps(), this
+    yields batches of independent work; each element of a batch is a group of up to m items,
+    and the generator must be sent back the index of the greatest item in each group.
+    """
+    k = min(k, len(items))
+    if k == 0:
+        return []
+    level = [GroupNode(item) for item in items]
+    while len(level) > 1:
+        parents = [GroupNode(None, level[i:i + m]) for i in range(0, len(level), m)]
+        contested = [parent for parent in parents if len(parent.children) > 1]
+        choices = yield [[child.val for child in parent.children] for parent in contested]
+        for parent, choice in zip(contested, choices):
+            parent.best = choice
+        for parent in parents:
+            parent.val = parent.children[parent.best].val
+        level = parents
+
+    def remove_best(node: GroupNode) -> Generator[list[list], list[int], bool]:
+        child = node.children[node.best]
+        if not child.children or not (yield from remove_best(child)):
+            del node.children[node.best]
+        if not node.children:
+            return False
+        if len(node.children) == 1:
+            node.best = 0
+        else:
+            [node.best] = yield [[child.val for child in node.children]]
+        node.val = node.children[node.best].val
+        return True
+
+    root = level[0]
     result = [root.val]
     while len(result) < k:
-        root = next_best(root)
+        yield from remove_best(root)
         result.append(root.val)
     return result
 
 
-def tournament_estimated_comparisons(k: int, n: int) -> int:
+def multiway_tournament(k: int, items: list, m: int, best_of: Callable[[list], int], concurrency: int = 1) -> list:
     """
-    Returns an estimate of the number of less-than operations the tournament()
-    function will require when called with the given k and a list of size n.
+    Like tournament(), but instead of comparing two items at a time, this repeatedly calls
+    best_of with groups of up to m items, and best_of returns the index of the greatest item
+    in the group.
+
+    The items are arranged in an m-ary tree, so finding the greatest item requires about
+    (n-1)/(m-1) calls to best_of, and finding each runner-up requires at most log_m(n) more.
+    See multiway_estimated_comparisons().
+    """
+    steps = multiway_tournament_steps(k, items, m)
+    if concurrency <= 1:
+        return run_steps(steps, lambda batch: [best_of(group) for group in batch])
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return run_steps(steps, lambda batch: list(executor.map(best_of, batch)))
+
+
+def multiway_estimated_comparisons(k: int, n: int, m: int) -> int:
+    """
+    Returns an upper bound on the number of calls to best_of the multiway_tournament()
+    function will make when called with the given k and m and a list of size n.
     """
     if n <= 1 or k == 0:
         return 0
     k = min(k, n)
-    # TODO: is it possible to give a tighter bound than this?
-    return n-1 + (k-1)*(math.ceil(math.log2(n))-1)
+    calls = 0
+    height = 0
+    size = n
+    while size > 1:
+        calls += size // m + (1 if size % m > 1 else 0)
+        size = math.ceil(size / m)
+        height += 1
+    return calls + (k-1)*height
+
+
+def _in_parallel(all_steps: list[ComparisonSteps]) -> Generator[list[tuple], list[bool], list]:
+    """
+    Runs several independent ComparisonSteps generators in lockstep, combining the batches
+    they yield at the same time into one. Returns the list of their results.
+    """
+    results = [None] * len(all_steps)
+    batches = {}
+    for i, steps in enumerate(all_steps):
+        try:
+            batches[i] = next(steps)
+        except StopIteration as stop:
+            results[i] = stop.value
+    while batches:
+        answers = yield [pair for batch in batches.values() for pair in batch]
+        pos = 0
+        next_batches = {}
+        for i, batch in batches.items():
+            try:
+                next_batches[i] = all_steps[i].send(answers[pos:pos + len(batch)])
+            except StopIteration as stop:
+                results[i] = stop.value
+            pos += len(batch)
+        batches = next_batches
+    return results
+
+
+def _knockout_steps(items: list, indices: list[int], beaten: list[list[int]], losses: list[int]) -> Generator[list[tuple], list[bool], int]:
+    """
+    Plays a single-elimination tournament between the items at the given indices, one round per
+    batch, and returns the index of the winner. Every match is recorded in beaten and losses.
+    """
+    contenders = list(indices)
+    while len(contenders) > 1:
+        matches = [(contenders[i], contenders[i + 1]) for i in range(0, len(contenders) - 1, 2)]
+        results = yield [(items[a], items[b]) for a, b in matches]
+        winners = []
+        for (a, b), less in zip(matches, results):
+            winner, loser = (b, a) if less else (a, b)
+            beaten[winner].append(loser)
+            losses[loser] += 1
+            winners.append(winner)
+        if len(contenders) % 2:
+            winners.append(contenders[-1])
+        contenders = winners
+    return contenders[0]
+
+
+def knuth_tournament_steps(k: int, items: list) -> ComparisonSteps:
+    """
+    Finds the top-k greatest items, sorted from greatest to least, in the manner of the
+    tournament described by Knuth (TAOCP vol. 3, 5.3.3): each item remembers the items it
+    has beaten, and after the winner is removed, the next greatest item must be one of those
+    that lost only to already-removed items. The runner-up is found by a knockout among
+    those candidates; unlike in tournament_steps(), its matches are independent within each
+    round, so each runner-up takes about log2(log2(n)) batches rather than log2(n).
+    """
+    k = min(k, len(items))
+    if k == 0:
+        return []
+    beaten: list[list[int]] = [[] for _ in items]
+    losses = [0] * len(items)
+    selected = [False] * len(items)
+    best = yield from _knockout_steps(items, list(range(len(items))), beaten, losses)
+    result = [best]
+    while len(result) < k:
+        selected[best] = True
+        candidates = []
+        for loser in beaten[best]:
+            losses[loser] -= 1
+            if losses[loser] == 0 and not selected[loser]:
+                candidates.append(loser)
+        if not candidates:
+            # Only possible if the comparisons were inconsistent (e.g. a < b < c < a).
+            candidates = [i for i in range(len(items)) if not selected[i]]
+        best = yield from _knockout_steps(items, candidates, beaten, losses)
+        result.append(best)
+    return [items[i] for i in result]
+
+
+def _sift_down_steps(heap: list, pos: int) -> Generator[list[tuple], list[bool], None]:
+    """Restores the min-heap property below heap[pos], one comparison per batch."""
+    while 2 * pos + 1 < len(heap):
+        child = 2 * pos + 1
+        if child + 1 < len(heap):
+            [less] = yield [(heap[child + 1], heap[child])]
+            if less:
+                child += 1
+        [less] = yield [(heap[child], heap[pos])]
+        if not less:
+            return
+        heap[pos], heap[child] = heap[child], heap[pos]
+        pos = child
+
+
+def _sift_up_steps(heap: list, pos: int) -> Generator[list[tuple], list[bool], None]:
+    """Restores the min-heap property above heap[pos], one comparison per batch."""
+    while pos > 0:
+        parent = (pos - 1) // 2
+        [less] = yield [(heap[pos], heap[parent])]
+        if not less:
+            return
+        heap[pos], heap[parent] = heap[parent], heap[pos]
+        pos = parent
+
+
+def heap_select_steps(k: int, items: list, width: int = 1) -> ComparisonSteps:
+    """
+    Finds the top-k greatest items, sorted from greatest to least, by keeping the k greatest
+    items seen so far in a min-heap. Remaining items are compared against the least item in
+    the heap width at a time; those that lose are discarded, and the rest are added to the
+    heap in turn (after checking them against the heap's new minimum). Once most items have
+    been seen, most are discarded after a single comparison.
+    """
+    k = min(k, len(items))
+    if k == 0:
+        return []
+    heap = []
+    for item in items[:k]:
+        heap.append(item)
+        yield from _sift_up_steps(heap, len(heap) - 1)
+    rest = items[k:]
+    for i in range(0, len(rest), width):
+        chunk = rest[i:i + width]
+        results = yield [(heap[0], item) for item in chunk]
+        changed = False
+        for item, less in zip(chunk, results):
+            if less and changed:
+                [less] = yield [(heap[0], item)]
+            if less:
+                heap[0] = item
+                yield from _sift_down_steps(heap, 0)
+                changed = True
+    result = []
+    while heap:
+        result.append(heap[0])
+        heap[0] = heap[-1]
+        heap.pop()
+        yield from _sift_down_steps(heap, 0)
+    result.reverse()
+    return result
+
+
+def quickselect_steps(k: int, items: list) -> ComparisonSteps:
+    """
+    Finds the top-k greatest items, sorted from greatest to least, by partitioning the items
+    around a pivot, recursing into the part that contains the top k, and sorting the top k
+    the same way. All the comparisons against one pivot are independent, and so are the
+    recursions into the two parts, so this takes few batches (about 2ln(n)) at the cost of
+    more comparisons than the tournaments.
+    """
+    k = min(k, len(items))
+    if k == 0:
+        return []
+    if len(items) == 1:
+        return list(items)
+    p = len(items) // 2
+    pivot = items[p]
+    others = items[:p] + items[p + 1:]
+    results = yield [(item, pivot) for item in others]
+    greater = [item for item, less in zip(others, results) if not less]
+    lesser = [item for item, less in zip(others, results) if less]
+    if len(greater) >= k:
+        return (yield from quickselect_steps(k, greater))
+    top, rest = yield from _in_parallel([
+        quickselect_steps(len(greater), greater),
+        quickselect_steps(k - len(greater) - 1, lesser),
+    ])
+    return top + [pivot] + rest
+
+
+class TopKAlgorithm(StrEnum):
+    """The algorithms which select_top_k() can use."""
+    TOURNAMENT = "tournament"
+    """See tournament()."""
+    KNUTH = "knuth"
+    """See knuth_tournament_steps()."""
+    HEAP = "heap"
+    """See heap_select_steps()."""
+    QUICKSELECT = "quickselect"
+    """See quickselect_steps()."""
+
+
+def top_k_steps(algorithm: TopKAlgorithm, k: int, items: list, width: int = 1) -> ComparisonSteps:
+    """Returns a ComparisonSteps generator for the given algorithm. width is used by HEAP."""
+    if algorithm == TopKAlgorithm.TOURNAMENT:
+        return tournament_steps(k, items)
+    if algorithm == TopKAlgorithm.KNUTH:
+        return knuth_tournament_steps(k, items)
+    if algorithm == TopKAlgorithm.HEAP:
+        return heap_select_steps(k, items, width)
+    if algorithm == TopKAlgorithm.QUICKSELECT:
+        return quickselect_steps(k, items)
+    raise ValueError(f"Unsupported algorithm {algorithm}")
+
+
+def select_top_k(algorithm: TopKAlgorithm, k: int, items: list, concurrency: int = 1, prefetch: Optional[Callable[[list[tuple]], None]] = None, schedule: Optional[Callable[[list[tuple]], list[int]]] = None) -> list:
+    """
+    Finds the top-k greatest items in the given list, sorted from greatest to least, using the
+    given algorithm. Comparisons are made with the < operator, so ComparisonTracker works with
+    every algorithm. See tournament() regarding concurrency, prefetch and schedule.
+    """
+    return _run_comparisons(top_k_steps(algorithm, k, items, max(1, concurrency)), concurrency, prefetch, schedule)
+
+
+def run_interleaved(all_steps: list[ComparisonSteps], concurrency: int = 1, prefetch: Optional[Callable[[list[tuple]], None]] = None, schedule: Optional[Callable[[list[tuple]], list[int]]] = None) -> list:
+    """
+    Runs several independent ComparisonSteps generators (e.g. from top_k_steps() for different
+    criteria) at once, and returns the list of their results. The batches they yield at the
+    same time are combined and compared together, so with concurrency greater than 1 one job's
+    comparisons can run while another job is waiting on a single comparison. See tournament()
+    regarding concurrency, prefetch and schedule.
+    """
+    return _run_comparisons(_in_parallel(all_steps), concurrency, prefetch, schedule)
+
+
+class AlgorithmCost(NamedTuple):
+    """The estimated cost of running an algorithm."""
+    comparisons: int
+    """The number of comparisons."""
+    depth: int
+    """The number of batches, i.e. comparisons that must wait for earlier ones to finish."""
+
+
+def estimated_cost(algorithm: TopKAlgorithm, k: int, n: int, concurrency: int = 1) -> AlgorithmCost:
+    """
+    Estimates the cost of finding the top-k of n items with the given algorithm.
+    For TOURNAMENT, the number of comparisons is the most it can take (see
+    tournament_estimated_comparisons()), which random orders nearly reach; for the others,
+    it is the expected number when the items are in random order.
+    """
+    if n <= 1 or k == 0:
+        return AlgorithmCost(0, 0)
+    k = min(k, n)
+    height = math.ceil(math.log2(n))
+    if algorithm == TopKAlgorithm.TOURNAMENT:
+        return AlgorithmCost(tournament_estimated_comparisons(k, n), height + (k-1)*(height-1))
+    if algorithm == TopKAlgorithm.KNUTH:
+        # Each runner-up is chosen from about log2(n) candidates, a few more as k grows.
+        candidates = max(2, height + math.log2(k) / 4)
+        comparisons = n-1 + (k-1)*(candidates-1)
+        return AlgorithmCost(math.ceil(comparisons), height + (k-1)*math.ceil(math.log2(candidates)))
+    if algorithm == TopKAlgorithm.HEAP:
+        # Item i (for i > k) is accepted into the heap with probability k/i. Each acceptance,
+        # and each item removed while sorting the heap at the end, costs about 1.5log2(k)
+        # comparisons in sequence.
+        heap_cost = 1.5 * math.log2(k) if k > 1 else 1
+        accepted = k * math.log(n / k)
+        sequential = accepted * heap_cost + k * heap_cost
+        comparisons = n + sequential
+        depth = math.ceil((n - k) / max(1, concurrency)) + sequential
+        return AlgorithmCost(math.ceil(comparisons), math.ceil(depth))
+    if algorithm == TopKAlgorithm.QUICKSELECT:
+        # Expected comparisons to select the k-th greatest (Knuth), plus sorting the top k.
+        select = 2 * n + 2 * k * math.log(n / k) + (2 * (n - k) * math.log(n / (n - k)) if n > k else 0)
+        sort = 2 * k * math.log(k)
+        return AlgorithmCost(math.ceil(select + sort), math.ceil(math.log(n) + 2 * math.log(k)) + 1)
+    raise ValueError(f"Unsupported algorithm {algorithm}")
+
+
+def plan_top_k(k: int, n: int, concurrency: int = 1, cache_hit_rate: float = 0.0) -> TopKAlgorithm:
+    """
+    Chooses the algorithm which should finish soonest when finding the top-k of n items.
+
+    Each algorithm's time is modeled as the number of rounds of model calls: the comparisons
+    that miss the cache divided among the concurrent workers, plus the rounds in which workers
+    sit idle because a batch (one that doesn't entirely hit the cache) is smaller than the
+    concurrency. Ties are broken by the number of comparisons that miss the cache, since each
+    one costs money or compute.
+    """
+    concurrency = max(1, concurrency)
+
+    def score(algorithm: TopKAlgorithm) -> tuple[float, float]:
+        cost = estimated_cost(algorithm, k, n, concurrency)
+        misses = cost.comparisons * (1 - cache_hit_rate)
+        batch_size = cost.comparisons / cost.depth if cost.depth else 0
+        waits = cost.depth * (1 - cache_hit_rate ** batch_size)
+        return misses / concurrency + waits * (1 - 1 / concurrency), misses
+
+    return min(TopKAlgorithm, key=score)
+
+
+def tournament_estimated_comparisons(k: int, n: int) -> int:
+    """
+    Returns the most less-than operations the tournament() function (or array_tournament())
+    can require when called with the given k and a list of size n. Items in random order
+    usually require nearly this many.
+
+    Finding the best takes n-1 comparisons. The tree is balanced, so its leaves have depth
+    ceil(log2(n)) or one less, and 2n-2^ceil(log2(n)) of them have the greater depth. Each
+    runner-up takes a comparison for each ancestor of the previous winner's leaf except its
+    parent, skipping those where the rest of the subtree has already been taken: that's at
+    most depth-1, only for a leaf at the greater depth whose sibling leaf is still there, so
+    once per pair of those leaves, and otherwise at most depth-2. The last item, once all the
+    others have been taken, takes none.
+    """
+    if n <= 1 or k == 0:
+        return 0
+    runners_up = min(k, n-1) - 1
+    height = math.ceil(math.log2(n))
+    deep_pairs = n - 2**(height-1)
+    return n-1 + runners_up*(height-2) + min(runners_up, deep_pairs)
@@ -1,7 +1,44 @@
 import sqlite3
 import os
-from typing import Self, Optional
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Iterable
+from hashlib import sha256
+from typing import NamedTuple, Self, Optional
 from datetime import datetime, timezone
+import json
+
+
+# SQLite limits the number of parameters in one statement; stay well below it.
+_MAX_QUERY_PARAMS = 900
+
+
+COMPARISON_KEY_VERSION = 2
+
+
+class ComparisonKey(NamedTuple):
+    """
+    Identifies a pairwise comparison by the digests of everything that determines its outcome.
+    The document digests are in sorted order, so the key doesn't depend on which document was
+    presented first. The value cached for a comparison is the digest of the winning document.
+    """
+    provider: str
+    model: str
+    system_digest: str
+    criteria_digest: str
+    doc1_digest: str
+    doc2_digest: str
+
+    @classmethod
+    def build(cls, provider: str, model: str, system_digest: str, criteria_digest: str, doc_digest_a: str, doc_digest_b: str) -> Self:
+        """Creates a key, putting the document digests in the canonical order."""
+        low, high = sorted([doc_digest_a, doc_digest_b])
+        return cls(provider, model, system_digest, criteria_digest, low, high)
+
+    def entry_key(self) -> str:
+        """Returns the key under which the comparison's result is stored in the Cache."""
+        return sha256(json.dumps([COMPARISON_KEY_VERSION, *self]).encode()).hexdigest()
 
 
 class Cache:
@@ -9,48 +46,234 @@ class Cache:
     A simple key-value store implemented as a sqlite database.
 
     The database is opened, and created if necessary, in the constructor.
+    A Cache may be shared between threads; access to the database is serialized with a lock.
+
+    File-based databases use write-ahead logging, so several processes can share one cache file
+    with little lock contention. Writes are buffered in memory and committed together, at most
+    flush_interval seconds apart, and when flush() or close() is called (including by using the
+    Cache as a context manager). Up to memory_size recently used entries are also kept in memory.
+
+    Statistics are kept in these instance vars:
+    - total_hits and total_misses: lookups via fetch() or fetch_many() that did/didn't find an entry
+    - memory_hits: the subset of total_hits served from memory
+    - total_commits: how many times buffered writes were committed to the database
+    - total_seconds: time spent in fetch(), fetch_many(), put(), put_many() and flush()
+
+    Results of comparisons can be stored with put_comparison(), which also records the
+    components of the ComparisonKey in an index table so that they can be queried with
+    comparisons_involving().
     """
-    def __init__(self, path: str) -> None:
+    def __init__(self, path: str, flush_interval: float = 1.0, memory_size: int = 10000) -> None:
         self.path = path
+        self.flush_interval = flush_interval
+        self.memory_size = memory_size
         self.total_hits = 0
-        self.db = sqlite3.connect(self.path)
+        self.total_misses = 0
+        self.memory_hits = 0
+        self.total_commits = 0
+        self.total_seconds = 0.0
+        self.lock = threading.Lock()
+        self._memory: OrderedDict[str, str] = OrderedDict()
+        self._pending: dict[str, tuple[str, float]] = {}
+        self._pending_index: dict[str, ComparisonKey] = {}
+        self._last_flush = time.monotonic()
+        self.db = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
         self._init_db()
-    
+
     def __enter__(self) -> Self:
         return self
-    
+
     def __exit__(self, type, value, traceback) -> None:
         self.close()
-    
+
     def close(self) -> None:
-        """Close the underlying database."""
-        self.db.close()
-    
+        """Commit any buffered writes and close the underlying database."""
+        self.flush()
+        with self.lock:
+            self.db.close()
+
     def _init_db(self) -> None:
         cur = self.db.cursor()
+        if self.path != ":memory:":
+            cur.execute("PRAGMA journal_mode=WAL")
+            cur.execute("PRAGMA synchronous=NORMAL")
         cur.execute("CREATE TABLE IF NOT EXISTS cache_entry (entry_key TEXT PRIMARY KEY, entry_value TEXT, timestamp INTEGER)")
-    
-    def put(self, key: str, val: str) -> None:
-        """Create or update an entry for the given key, associating it with the given value."""
+        cur.execute("CREATE TABLE IF NOT EXISTS comparison_index (entry_key TEXT PRIMARY KEY, version INTEGER, provider TEXT, model TEXT, system_digest TEXT, criteria_digest TEXT, doc1_digest TEXT, doc2_digest TEXT)")
+        cur.execute("CREATE INDEX IF NOT EXISTS comparison_index_doc1 ON comparison_index (doc1_digest)")
+        cur.execute("CREATE INDEX IF NOT EXISTS comparison_index_doc2 ON comparison_index (doc2_digest)")
+        cur.execute("CREATE INDEX IF NOT EXISTS comparison_index_context ON comparison_index (criteria_digest, model, provider, system_digest)")
+
+    def _remember(self, key: str, val: str) -> None:
+        """Adds an entry to the in-memory tier. The caller must hold self.lock."""
+        self._memory[key] = val
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+    def _lookup(self, keys: Iterable[str]) -> tuple[dict[str, str], int]:
+        """
+        Finds entries in memory or the database, adding the latter to memory.
+        Returns the entries found and how many of them were found in memory.
+        The caller must hold self.lock.
+        """
+        found = {}
+        missing = []
+        for key in keys:
+            val = self._memory.get(key)
+            if val is not None:
+                self._memory.move_to_end(key)
+                found[key] = val
+            elif key in self._pending:
+                found[key] = self._pending[key][0]
+                self._remember(key, found[key])
+            else:
+                missing.append(key)
+        from_memory = len(found)
         cur = self.db.cursor()
-        cur.execute("INSERT OR REPLACE INTO cache_entry (entry_key, entry_value, timestamp) VALUES (?, ?, ?)", (key, val, datetime.now(timezone.utc).timestamp()))
-        self.db.commit()
-    
-    def fetch(self, key: str) -> Optional[str]:
-        """Retrieve the value for the given key, or None if it does not exist."""
+        for i in range(0, len(missing), _MAX_QUERY_PARAMS):
+            chunk = missing[i:i + _MAX_QUERY_PARAMS]
+            placeholders = ", ".join("?" * len(chunk))
+            for key, val in cur.execute(f"SELECT entry_key, entry_value FROM cache_entry WHERE entry_key IN ({placeholders})", chunk):
+                self._remember(key, val)
+                found[key] = val
+        return found, from_memory
+
+    def _maybe_flush(self) -> None:
+        """Commits buffered writes if flush_interval has elapsed. The caller must hold self.lock."""
+        if time.monotonic() - self._last_flush >= self.flush_interval:
+            self._flush()
+
+    def _flush(self) -> None:
+        """Commits buffered writes. The caller must hold self.lock."""
+        self._last_flush = time.monotonic()
+        if not self._pending:
+            return
         cur = self.db.cursor()
-        results = cur.execute("SELECT entry_value FROM cache_entry WHERE entry_key = ?", (key,))
-        result = results.fetchone()
-        if result is None:
-            return None
-        self.total_hits += 1
-        return result[0]
+        cur.executemany(
+            "INSERT OR REPLACE INTO cache_entry (entry_key, entry_value, timestamp) VALUES (?, ?, ?)",
+            [(key, val, timestamp) for key, (val, timestamp) in self._pending.items()],
+        )
+        cur.executemany(
+            "INSERT OR REPLACE INTO comparison_index (entry_key, version, provider, model, system_digest, criteria_digest, doc1_digest, doc2_digest) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [(key, COMPARISON_KEY_VERSION, *components) for key, components in self._pending_index.items()],
+        )
+        self.db.commit()
+        self._pending = {}
+        self._pending_index = {}
+        self.total_commits += 1
+
+    def flush(self) -> None:
+        """Commit any buffered writes to the database."""
+        start = time.perf_counter()
+        with self.lock:
+            self._flush()
+            self.total_seconds += time.perf_counter() - start
+
+    def put(self, key: str, val: str) -> None:
+        """Create or update an entry for the given key, associating it with the given value."""
+        self.put_many({key: val})
+
+    def put_many(self, entries: dict[str, str]) -> None:
+        """Create or update an entry for each key in the dict."""
+        start = time.perf_counter()
+        timestamp = datetime.now(timezone.utc).timestamp()
+        with self.lock:
+            for key, val in entries.items():
+                self._pending[key] = (val, timestamp)
+                self._remember(key, val)
+            self._maybe_flush()
+            self.total_seconds += time.perf_counter() - start
+
+    def put_comparison(self, key: ComparisonKey, winner_digest: str) -> None:
+        """Store the digest of the document that won the given comparison."""
+        entry_key = key.entry_key()
+        with self.lock:
+            self._pending_index[entry_key] = key
+        self.put(entry_key, winner_digest)
+
+    def comparisons_involving(self, doc_digest: str) -> list[tuple[ComparisonKey, str]]:
+        """
+        Returns every stored comparison in which the document with the given digest took part,
+        along with the digest of the winner.
+        """
+        with self.lock:
+            self._flush()
+            cur = self.db.cursor()
+            rows = cur.execute(
+                "SELECT provider, model, system_digest, criteria_digest, doc1_digest, doc2_digest, entry_value FROM comparison_index JOIN cache_entry USING (entry_key) WHERE doc1_digest = ? OR doc2_digest = ?",
+                (doc_digest, doc_digest),
+            ).fetchall()
+        return [(ComparisonKey(*row[:6]), row[6]) for row in rows]
+
+    def comparisons_matching(self, provider: str, model: str, system_digest: str, criteria_digest: str) -> list[tuple[ComparisonKey, str]]:
+        """
+        Returns every stored comparison made with the given provider, model, system prompt and
+        criteria, along with the digest of the winner.
+        """
+        with self.lock:
+            self._flush()
+            cur = self.db.cursor()
+            rows = cur.execute(
+                "SELECT provider, model, system_digest, criteria_digest, doc1_digest, doc2_digest, entry_value FROM comparison_index JOIN cache_entry USING (entry_key) WHERE criteria_digest = ? AND model = ? AND provider = ? AND system_digest = ?",
+                (criteria_digest, model, provider, system_digest),
+            ).fetchall()
+        return [(ComparisonKey(*row[:6]), row[6]) for row in rows]
+
+    def contains(self, key: str) -> bool:
+        """Check whether an entry exists for the given key. This does not count as a hit."""
+        with self.lock:
+            return key in self._lookup([key])[0]
+
+    def preload(self, keys: Iterable[str]) -> int:
+        """
+        Load any entries that exist for the given keys into memory, using as few queries as
+        possible, so that fetching them later is fast. This does not count as hits or misses.
+        Returns the number of entries found.
+        """
+        with self.lock:
+            return len(self._lookup(keys)[0])
+
+    def fetch(self, key: str, count: bool = True) -> Optional[str]:
+        """
+        Retrieve the value for the given key, or None if it does not exist.
+        If count is False, the lookup isn't included in the hit/miss statistics.
+        """
+        return self.fetch_many([key], count).get(key)
+
+    def fetch_many(self, keys: Iterable[str], count: bool = True) -> dict[str, str]:
+        """
+        Retrieve the values for all of the given keys that exist.
+        If count is False, the lookups aren't included in the hit/miss statistics.
+        """
+        start = time.perf_counter()
+        keys = list(keys)
+        with self.lock:
+            found, from_memory = self._lookup(keys)
+            if count:
+                self.total_hits += len(found)
+                self.memory_hits += from_memory
+                self.total_misses += len(keys) - len(found)
+            self.total_seconds += time.perf_counter() - start
+        return found
+
+    def count_lookup(self, found: bool) -> None:
+        """Record a hit or miss for a lookup that was done with count=False."""
+        with self.lock:
+            if found:
+                self.total_hits += 1
+            else:
+                self.total_misses += 1
+
+    def summary(self) -> str:
+        """Returns a human-readable description of the statistics."""
+        return f"Cache hits: {self.total_hits} ({self.memory_hits} from memory). Misses: {self.total_misses}. Commits: {self.total_commits}. Time in cache: {self.total_seconds:.3f}s"
+
+
+def default_cache_path() -> str:
+    """Returns the path in the RANK_FILES_CACHE env var, or a default in the current working directory."""
+    return os.getenv("RANK_FILES_CACHE", "rank-files-cache.sqlite3")
 
 
 def default_cache() -> Cache:
-    """
-    Create a Cache instance using the path in the RANK_FILES_CACHE env var,
-    or a default in the current working directory.
-    """
-    path = os.getenv("RANK_FILES_CACHE", "rank-files-cache.sqlite3")
-    return Cache(path)
+    """Create a Cache instance using default_cache_path()."""
+    return Cache(default_cache_path())
@@ -1,42 +1,541 @@
-from argparse import ArgumentParser
+from argparse import ArgumentParser, Namespace
 from pathlib import Path
-from rank_files.cache import default_cache
-from rank_files.document import FileDocument
-from rank_files.ranker import build_ranker
-from rank_files.algos import tournament, tournament_estimated_comparisons, ComparisonTracker, MaxComparisonsExceededError
+from typing import NamedTuple, Optional, TextIO
+from rank_files.cache import Cache, default_cache, default_cache_path
+from rank_files.client import run_on_server
+from rank_files.discovery import DiscoveryReport, discover_files, remove_duplicates
+from rank_files.dryrun import DryRunRanker, score_tokens
+from rank_files.document import DigestMemo, Document, FileDocument, TextBudget
+from rank_files.prefilter import LEXICAL_SCORER_ID, Prefilter, Selection, lexical_score, stability_report
+from rank_files.ranker import LISTWISE_SYSTEM_PROMPT, PAIRWISE_SYSTEM_PROMPT, POINTWISE_SYSTEM_PROMPT_DIGEST, BudgetExceededError, CallBudget, Ranker, build_ranker, default_model, default_provider, estimate_prompt_tokens, listwise_group_size, parse_keep_alive, tournament_state_key
+from rank_files.scheduler import RequestScheduler
+from rank_files.sizing import DocumentReducer, ReducedDocument, ReductionStrategy
+from rank_files.trace import Tracer
+from rank_files.workqueue import QueueRanker, WorkQueue
+from rank_files.algos import estimated_cost, multiway_tournament, multiway_tournament_steps, multiway_estimated_comparisons, plan_top_k, run_interleaved, select_top_k, top_k_steps, tournament_iter, tournament_steps, ComparisonSteps, ComparisonTracker, MaxComparisonsExceededError, TopKAlgorithm, TournamentState
+from collections.abc import Callable, Iterator
+from contextlib import AbstractContextManager
+from hashlib import sha256
 from tqdm import tqdm
+import json
 import os
+import sys
 
 
 MAX_COMPARISONS = int(os.getenv("RANK_FILES_MAX_COMPARISONS", "1000"))
-MAX_COMPARISONS_MESSAGE = f"To protect against excessively slow and/or expensive jobs, the limit is {MAX_COMPARISONS}. You can override this limit by setting the RANK_FILES_MAX_COMPARISONS env var."
+MAX_TEXT_MEMORY = int(os.getenv("RANK_FILES_MAX_TEXT_MEMORY", str(512 * 1024 * 1024)))
+MAX_DOC_TOKENS = int(os.environ["RANK_FILES_MAX_DOC_TOKENS"]) if "RANK_FILES_MAX_DOC_TOKENS" in os.environ else None
+MAX_NUM_CTX = int(os.environ["RANK_FILES_MAX_NUM_CTX"]) if "RANK_FILES_MAX_NUM_CTX" in os.environ else None
+KEEP_ALIVE = os.getenv("RANK_FILES_KEEP_ALIVE")
+PRICE = float(os.getenv("RANK_FILES_PRICE", "0"))
+SECONDS_PER_CALL = float(os.getenv("RANK_FILES_SECONDS_PER_CALL", "2"))
+REQUESTS_PER_MINUTE = float(os.environ["RANK_FILES_REQUESTS_PER_MINUTE"]) if "RANK_FILES_REQUESTS_PER_MINUTE" in os.environ else None
+TOKENS_PER_MINUTE = float(os.environ["RANK_FILES_TOKENS_PER_MINUTE"]) if "RANK_FILES_TOKENS_PER_MINUTE" in os.environ else None
 
 
-def main() -> None:
+def max_comparisons_message(limit: int, jobs: int) -> str:
+    """Explains the limit on model calls for a run of this many jobs, for errors about exceeding it."""
+    shared = f", counted together for the run's {jobs} criteria ({limit * jobs} in total, however they're divided)" if jobs > 1 else ""
+    return f"To protect against excessively slow and/or expensive jobs, the limit is {limit} model calls per criteria{shared} (results from the cache don't count). You can override this limit by setting the RANK_FILES_MAX_COMPARISONS env var."
+
+
+class Job(NamedTuple):
+    """One ranking to perform: finding the top_k documents by the criteria. name labels its results."""
+    criteria: str
+    top_k: int
+    name: Optional[str] = None
+
+
+class JobPlan(NamedTuple):
+    """How a Job will be run; see plan_job()."""
+    docs: list[Document]
+    group_size: int
+    algorithm: Optional[TopKAlgorithm]
+    state_key: str
+    estimate: int
+
+
+def load_jobs(args: Namespace) -> list[Job]:
+    """
+    Returns the jobs given by the criteria argument, --criteria options and --jobs file. The
+    file must contain a JSON list, each element of which is either a criteria string or an
+    object with a "criteria" string and optionally "top_k" and "name".
+    """
+    criteria = ([] if args.criteria is None else [args.criteria]) + args.extra_criteria
+    jobs = [Job(c, args.top_k) for c in criteria]
+    if args.jobs is not None:
+        with open(args.jobs) as f:
+            for entry in json.load(f):
+                if isinstance(entry, str):
+                    entry = {"criteria": entry}
+                jobs.append(Job(entry["criteria"], entry.get("top_k", args.top_k), entry.get("name")))
+    return jobs
+
+
+def load_tournament_state(cache: Cache, key: str, docs: list[Document], items: list) -> TournamentState:
+    """
+    Loads the state saved by save_tournament_state(), if there is one for the same documents in
+    the same order; otherwise returns a new state.
+    """
+    data = cache.fetch(key, count=False)
+    if data is not None:
+        data = json.loads(data)
+        if data["digests"] == [doc.digest() for doc in docs]:
+            return TournamentState.from_json(data, items)
+    return TournamentState()
+
+
+def save_tournament_state(cache: Cache, key: str, docs: list[Document], items: list, state: TournamentState) -> None:
+    """Saves the state of a tournament over the given documents (items are the wrapped documents)."""
+    data = state.to_json(items)
+    data["digests"] = [doc.digest() for doc in docs]
+    cache.put(key, json.dumps(data))
+    cache.flush()
+
+
+def choose_algorithm(cache: Cache, state_key: str, ranker: Ranker, criteria: str, docs: list[Document], k: int, concurrency: int, resume: bool) -> TopKAlgorithm:
+    """
+    Picks an algorithm with plan_top_k(), estimating the cache hit rate from the number of
+    comparisons between the documents that are already cached. If progress was saved by an
+    earlier tournament over the same documents and resume is True, that tournament is
+    continued instead.
+    """
+    if resume and cache.contains(state_key):
+        return TopKAlgorithm.TOURNAMENT
+    cached = 0 if ranker.records is None else ranker.records.count_cached(criteria, docs)
+    expected = estimated_cost(TopKAlgorithm.TOURNAMENT, k, len(docs)).comparisons
+    hit_rate = min(1.0, cached / expected) if expected else 0.0
+    return plan_top_k(k, len(docs), concurrency, hit_rate)
+
+
+def plan_job(args: Namespace, cache: Cache, ranker: Ranker, provider: str, model: str, job: Job, docs: list[Document]) -> JobPlan:
+    """Decides how many documents to compare at once and which algorithm to use, and estimates the comparisons required."""
+    if args.group_size == "auto":
+        group_size = listwise_group_size(docs, ranker.context_tokens())
+    else:
+        group_size = int(args.group_size)
+    state_key = tournament_state_key(provider, model, job.criteria, docs)
+    if group_size > 2:
+        return JobPlan(docs, group_size, None, state_key, multiway_estimated_comparisons(job.top_k, len(docs), group_size))
+    if args.algorithm == "auto":
+        algorithm = choose_algorithm(cache, state_key, ranker, job.criteria, docs, job.top_k, args.concurrency, not args.restart)
+    else:
+        algorithm = TopKAlgorithm(args.algorithm)
+    return JobPlan(docs, group_size, algorithm, state_key, estimated_cost(algorithm, job.top_k, len(docs), args.concurrency).comparisons)
+
+
+def _batch_hooks(ranker: Ranker) -> tuple[Callable[[list[tuple]], None], Callable[[list[tuple]], list[int]]]:
+    """Returns the prefetch and schedule functions for batches of tracked, wrapped documents."""
+    prefetch = lambda batch: ranker.prefetch_wrapped([(a.val, b.val) for a, b in batch])
+    schedule = lambda batch: ranker.schedule_wrapped([(a.val, b.val) for a, b in batch])
+    return prefetch, schedule
+
+
+def find_top_k(args: Namespace, cache: Cache, ranker: Ranker, tracker: ComparisonTracker, job: Job, plan: JobPlan) -> Iterator[Document]:
+    """
+    Finds the top documents with the multiway tournament (if the group size is over 2) or the
+    planned algorithm, yielding them from best to worst. The tournament yields each document
+    as soon as it's found; the other algorithms yield them all at the end.
+    """
+    if plan.group_size > 2:
+        def best_of(group: list[Document]) -> int:
+            best = ranker.choose_best(job.criteria, group)
+            return next(i for i, doc in enumerate(group) if doc is best)
+        yield from multiway_tournament(job.top_k, plan.docs, plan.group_size, tracker.counted(best_of), concurrency=args.concurrency)
+        return
+    items = tracker.wrap(ranker.wrap_for_pairwise_comparison(job.criteria, plan.docs))
+    prefetch, schedule = _batch_hooks(ranker)
+    if plan.algorithm == TopKAlgorithm.TOURNAMENT:
+        state = TournamentState() if args.restart else load_tournament_state(cache, plan.state_key, plan.docs, items)
+        checkpoint = lambda state: save_tournament_state(cache, plan.state_key, plan.docs, items, state)
+        results = tournament_iter(job.top_k, items, concurrency=args.concurrency, prefetch=prefetch, state=state, checkpoint=checkpoint, schedule=schedule)
+    else:
+        results = select_top_k(plan.algorithm, job.top_k, items, concurrency=args.concurrency, prefetch=prefetch, schedule=schedule)
+    for item in results:
+        yield item.val.wrapped
+
+
+def job_steps(args: Namespace, cache: Cache, ranker: Ranker, tracker: ComparisonTracker, job: Job, plan: JobPlan, on_done: Callable[[Job, list[Document]], None]) -> ComparisonSteps:
+    """
+    Returns a ComparisonSteps generator which finds the top documents for a pairwise job with
+    the planned algorithm, and passes them to on_done as soon as the job is finished. Used to
+    run several jobs together with run_interleaved().
+    """
+    items = tracker.wrap(ranker.wrap_for_pairwise_comparison(job.criteria, plan.docs))
+    if plan.algorithm == TopKAlgorithm.TOURNAMENT:
+        state = TournamentState() if args.restart else load_tournament_state(cache, plan.state_key, plan.docs, items)
+        checkpoint = lambda state: save_tournament_state(cache, plan.state_key, plan.docs, items, state)
+        steps = tournament_steps(job.top_k, items, state, checkpoint)
+    else:
+        steps = top_k_steps(plan.algorithm, job.top_k, items, max(1, args.concurrency))
+    results = yield from steps
+    on_done(job, [item.val.wrapped for item in results])
+    return results
+
+
+def run_jobs(args: Namespace, cache: Cache, ranker: Ranker, tracker: ComparisonTracker, jobs: list[Job], plans: list[JobPlan], on_done: Callable[[Job, list[Document]], None]) -> None:
+    """
+    Runs several jobs, passing each one's results to on_done when it finishes. The pairwise
+    jobs run together, sharing the pool of concurrent comparisons; multiway jobs then run one
+    at a time.
+    """
+    pairwise = [job_steps(args, cache, ranker, tracker, job, plan, on_done) for job, plan in zip(jobs, plans) if plan.group_size <= 2]
+    prefetch, schedule = _batch_hooks(ranker)
+    run_interleaved(pairwise, args.concurrency, prefetch, schedule)
+    for job, plan in zip(jobs, plans):
+        if plan.group_size > 2:
+            on_done(job, list(find_top_k(args, cache, ranker, tracker, job, plan)))
+
+
+def dry_run(args: Namespace, cache: Cache, ranker: Ranker, job: Job, plan: JobPlan) -> DryRunRanker:
+    """
+    Simulates the job as planned with a DryRunRanker, which counts the comparisons that would
+    need the model, without calling it or saving the tournament's progress.
+    """
+    dry = DryRunRanker(ranker.records)
+    concurrency = max(1, args.concurrency)
+    if plan.group_size > 2:
+        def best_of(group: list[Document]) -> int:
+            best = dry.choose_best(job.criteria, group)
+            return next(i for i, doc in enumerate(group) if doc is best)
+        dry.run_steps(multiway_tournament_steps(job.top_k, plan.docs, plan.group_size), lambda batch: [best_of(group) for group in batch], concurrency)
+        return dry
+    items = dry.wrap_for_pairwise_comparison(job.criteria, plan.docs)
+    if plan.algorithm == TopKAlgorithm.TOURNAMENT:
+        state = TournamentState() if args.restart else load_tournament_state(cache, plan.state_key, plan.docs, items)
+        steps = tournament_steps(job.top_k, items, state)
+    else:
+        steps = top_k_steps(plan.algorithm, job.top_k, items, concurrency)
+    dry.run_steps(steps, lambda batch: [a < b for a, b in batch], concurrency)
+    return dry
+
+
+def print_dry_run(args: Namespace, job: Job, plan: JobPlan, dry: DryRunRanker, budget: CallBudget, out: TextIO, selection: Optional[Selection] = None) -> None:
+    """
+    Prints what dry_run() found about the job, and what the prefilter's selection is if one was
+    used: as a JSON object with --json, or otherwise as a line of text.
+    """
+    algorithm = f"multiway tournament of {plan.group_size}" if plan.group_size > 2 else str(plan.algorithm)
+    seconds = dry.total_rounds * args.seconds_per_call
+    if args.json:
+        data = {
+            "criteria": job.criteria, "job": job.name, "algorithm": algorithm,
+            "cached": dry.total_cached, "inferred": dry.total_inferred, "model_calls": dry.total_uncached, "summaries": dry.total_summaries, "scores": dry.total_scores,
+            "input_tokens": dry.total_tokens, "cost": budget.cost(dry.total_tokens), "rounds": dry.total_rounds, "seconds": seconds,
+        }
+        if selection is not None:
+            data.update(prefilter_kept=len(selection.docs), prefilter_total=selection.total, prefilter_unscored=selection.uncached)
+        print(json.dumps(data), file=out)
+        return
+    cost = f", about ${budget.cost(dry.total_tokens):.2f}" if budget.price else ""
+    kept = ""
+    if selection is not None:
+        unscored = f" ({selection.uncached} not scored yet, so which are kept is uncertain)" if selection.uncached else ""
+        kept = f" Prefilter keeps {len(selection.docs)} of {selection.total} documents{unscored}."
+    summaries = "".join(f", plus {count} documents to {verb}" for count, verb in ((dry.total_summaries, "summarize"), (dry.total_scores, "score")) if count)
+    print(f"{job.name or job.criteria}:{kept} {algorithm}. Comparisons: {dry.total_cached} cached, {dry.total_inferred} inferred, {dry.total_uncached} needing the model{summaries} (about {dry.total_tokens} input tokens{cost}, {dry.total_rounds} rounds of calls, about {seconds:.0f}s)", file=out)
+
+
+def build_reducer(args: Namespace, cache: Cache, ranker: Ranker, provider: str, model: str, criteria: str) -> DocumentReducer:
+    """
+    Creates a DocumentReducer for the --max-doc-tokens and --reduce options. Summaries are
+    written with the given criteria in mind, by the ranker, which must support them.
+    """
+    strategy = ReductionStrategy(args.reduce)
+    if strategy != ReductionStrategy.SUMMARY:
+        return DocumentReducer(args.max_doc_tokens, strategy, cache)
+    if not ranker.supports_summarize:
+        raise ValueError(f"--reduce summary is not supported by {type(ranker).__name__}")
+    criteria_digest = sha256(criteria.encode()).hexdigest()
+    return DocumentReducer(
+        args.max_doc_tokens,
+        strategy,
+        cache,
+        summarize=lambda text, max_tokens: ranker.summarize(criteria, text, max_tokens),
+        summarizer_id=f"{provider}:{model}:{criteria_digest}",
+        summary_input_tokens=max(args.max_doc_tokens, (ranker.context_tokens() or 8192) // 2),
+    )
+
+
+def build_prefilter(args: Namespace, cache: Cache, provider: str, budget: CallBudget) -> Prefilter:
+    """
+    Creates a Prefilter for the --prefilter options, scoring documents with the provider's
+    --prefilter-model (charging each score to the budget), or else with lexical_score().
+    """
+    if args.prefilter_model is None:
+        return Prefilter(args.prefilter, lambda criteria, doc: lexical_score(criteria, doc.read_text()), LEXICAL_SCORER_ID, cache, args.prefilter_concurrency)
+    scheduler = build_scheduler(args, args.prefilter_concurrency)
+    scorer = build_ranker(provider, args.prefilter_model, cache=cache, keep_alive=parse_keep_alive(args.keep_alive), scheduler=scheduler)
+    if not scorer.supports_score:
+        raise ValueError(f"--prefilter-model is not supported by {type(scorer).__name__}")
+    if scorer.records is not None:
+        scorer.records.budget = budget
+    return Prefilter(args.prefilter, scorer.score, f"{provider}:{args.prefilter_model}:{POINTWISE_SYSTEM_PROMPT_DIGEST}", cache, args.prefilter_concurrency)
+
+
+def warm_up_tokens(criteria: str, docs: list[Document], group_size: int) -> int:
+    """Estimates the number of tokens in the longest prompt a job could send: the one with the largest documents."""
+    sizes = sorted((doc.byte_size() for doc in docs), reverse=True)[:group_size]
+    system_prompt = PAIRWISE_SYSTEM_PROMPT if group_size <= 2 else LISTWISE_SYSTEM_PROMPT
+    return estimate_prompt_tokens(system_prompt, criteria, sizes)
+
+
+def print_result(doc: Document, rank: int, as_json: bool, root: Path, report: DiscoveryReport, job: Optional[Job] = None, out: Optional[TextIO] = None) -> None:
+    """
+    Prints one ranked document to out (by default stdout), as its path relative to root or as
+    a JSON object (which also lists any duplicates of it that were removed, and the job's
+    criteria and name if a job is given), and flushes it.
+    """
+    out = sys.stdout if out is None else out
+    if isinstance(doc, ReducedDocument):
+        doc = doc.original
+    name = doc.path.relative_to(root).as_posix()
+    if as_json:
+        data = {"rank": rank, "name": name, "path": str(doc.path), "duplicates": [str(dup.path) for dup in report.duplicates_of(doc)]}
+        if job is not None:
+            data.update(criteria=job.criteria, job=job.name)
+        line = json.dumps(data)
+    else:
+        line = name
+    tqdm.write(line, file=out)
+    out.flush()
+
+
+def print_job_results(job: Job, docs: list[Document], as_json: bool, root: Path, report: DiscoveryReport, out: Optional[TextIO] = None) -> None:
+    """Prints the results of one of several jobs; without as_json, they're preceded by a heading with the job's name or criteria."""
+    out = sys.stdout if out is None else out
+    if not as_json:
+        tqdm.write(f"# {job.name or job.criteria}", file=out)
+    for rank, doc in enumerate(docs, 1):
+        print_result(doc, rank, as_json, root, report, job, out)
+    if not as_json:
+        tqdm.write("", file=out)
+
+
+def print_duplicates(report: DiscoveryReport, root: Path, file) -> None:
+    """Prints each file that was kept, followed by the duplicates of it that were removed."""
+    for dups in report.duplicates.values():
+        kept = dups[0]
+        print(f"Duplicates of {kept.path.relative_to(root).as_posix()}: " + ", ".join(dup.path.relative_to(root).as_posix() for dup in dups[1:]), file=file)
+
+
+def build_parser() -> ArgumentParser:
     parser = ArgumentParser()
-    parser.add_argument("criteria", type=str, help="Ranking criteria, e.g. 'The best document is the one with the most elegant prose.'")
+    parser.add_argument("criteria", type=str, nargs="?", help="Ranking criteria, e.g. 'The best document is the one with the most elegant prose.' May be omitted if --criteria or --jobs is used")
     parser.add_argument("input_dir", type=str, help="Path to directory containing files to rank")
+    parser.add_argument("--criteria", type=str, action="append", default=[], dest="extra_criteria", metavar="CRITERIA", help="Also rank the files by these criteria, in the same run; may be repeated")
+    parser.add_argument("--jobs", type=str, metavar="FILE", help="Also rank the files by each criteria in this JSON file, in the same run: a list of criteria strings, or objects with 'criteria' and optionally 'top_k' and 'name'")
+    parser.add_argument("-r", "--recursive", action="store_true", default=False, help="Also rank files in subdirectories of input_dir")
+    parser.add_argument("--include", type=str, action="append", default=[], metavar="GLOB", help="Only rank files whose path (relative to input_dir) or name matches this pattern; may be repeated")
+    parser.add_argument("--exclude", type=str, action="append", default=[], metavar="GLOB", help="Skip files and directories whose path (relative to input_dir) or name matches this pattern; may be repeated")
+    parser.add_argument("--min-size", type=int, default=0, metavar="BYTES", help="Skip files smaller than this")
+    parser.add_argument("--max-size", type=int, metavar="BYTES", help="Skip files larger than this")
+    parser.add_argument("--keep-duplicates", action="store_true", default=False, help="Rank files with identical content separately, instead of keeping only the first")
+    parser.add_argument("--list-duplicates", action="store_true", default=False, help="Print each set of identical files found, with the statistics")
     parser.add_argument("-k", "--top-k", type=int, default=10, help="How many top documents to find")
+    parser.add_argument("-c", "--concurrency", type=int, default=1, help="How many comparisons to send to the model at once")
+    parser.add_argument("--batch", action="store_true", default=False, help="Submit comparisons using the Anthropic Message Batches API (slower but cheaper)")
+    parser.add_argument("--distributed", action="store_true", default=False, help="Don't invoke the model; instead queue comparisons in the cache file for rank-files-worker processes to answer")
+    parser.add_argument("--no-inference", action="store_true", default=False, help="Always ask the model, even when earlier results imply the answer (e.g. A beat B and B beat C implies A beats C)")
+    parser.add_argument("-m", "--group-size", type=str, default="2", help="How many documents to compare per model call, or 'auto' to fit as many as the model's context length allows (at most 8)")
+    parser.add_argument("-a", "--algorithm", type=str, default="auto", choices=["auto", *TopKAlgorithm], help="Algorithm for finding the top documents; 'auto' picks the one expected to finish soonest given the concurrency")
+    parser.add_argument("--max-doc-tokens", type=int, default=MAX_DOC_TOKENS, help="Shorten documents with more than this many tokens before comparing them (default: no limit, or the RANK_FILES_MAX_DOC_TOKENS env var)")
+    parser.add_argument("--reduce", type=str, default=ReductionStrategy.HEAD_TAIL, choices=list(ReductionStrategy), help="How to shorten documents over --max-doc-tokens: keep the head, keep the head and tail, or have the model summarize them")
+    parser.add_argument("--keep-alive", type=str, default=KEEP_ALIVE, help="Ollama only: how long the model stays loaded after each request, in seconds or as a duration like '30m'; negative means forever (default: Ollama's default, or the RANK_FILES_KEEP_ALIVE env var)")
+    parser.add_argument("--max-num-ctx", type=int, default=MAX_NUM_CTX, help="Ollama only: the largest context length to load the model with (default: based on available memory and the model, or the RANK_FILES_MAX_NUM_CTX env var)")
+    parser.add_argument("--prefilter", type=int, metavar="M", help="Score every document on its own with a cheap scorer first, and only rank the M best-scoring documents with the model")
+    parser.add_argument("--prefilter-model", type=str, metavar="MODEL", help="Score documents for --prefilter by asking this (smaller) model of the same provider for a score from 1 to 10, instead of counting the criteria's words in them")
+    parser.add_argument("--prefilter-concurrency", type=int, default=4, metavar="N", help="How many documents to score for --prefilter at once")
+    parser.add_argument("--warm-up", action="store_true", default=False, help="Ollama only: load the model with a context length big enough for the largest documents before starting, so it isn't reloaded during the job")
+    parser.add_argument("--requests-per-minute", type=float, default=REQUESTS_PER_MINUTE, metavar="N", help="Send at most this many requests to the model per minute (default: no limit, or the RANK_FILES_REQUESTS_PER_MINUTE env var)")
+    parser.add_argument("--tokens-per-minute", type=float, default=TOKENS_PER_MINUTE, metavar="N", help="Send at most about this many input tokens to the model per minute (default: no limit, or the RANK_FILES_TOKENS_PER_MINUTE env var)")
+    parser.add_argument("--max-attempts", type=int, default=5, metavar="N", help="How many times to try a request that fails because the model is busy, rate-limited or unreachable; malformed responses are asked again up to 3 times")
+    parser.add_argument("--dry-run", action="store_true", default=False, help="Don't call the model; instead, simulate the job against the cache and print how many comparisons would be cached, inferred or need the model, with estimates of their input tokens, cost and time")
+    parser.add_argument("--max-tokens", type=int, metavar="N", help="Don't start, or stop, a job whose model calls would exceed about N input tokens in total (estimated from document sizes)")
+    parser.add_argument("--max-cost", type=float, metavar="DOLLARS", help="Don't start, or stop, a job whose model calls would cost more than this; requires --price")
+    parser.add_argument("--price", type=float, default=PRICE, metavar="DOLLARS", help="The model's price per million input tokens, for --max-cost and cost estimates (default: the RANK_FILES_PRICE env var, or 0)")
+    parser.add_argument("--seconds-per-call", type=float, default=SECONDS_PER_CALL, metavar="SECONDS", help="How long a model call takes, for --dry-run's time estimates (default: the RANK_FILES_SECONDS_PER_CALL env var, or 2)")
+    parser.add_argument("--restart", action="store_true", default=False, help="Don't resume from the progress saved by an earlier run with the same files and criteria")
+    parser.add_argument("--trace", type=str, metavar="FILE", help="Record the time spent in each stage of each comparison, and details such as prompt sizes, in FILE: in Chrome trace event format if FILE ends with .json, or else as JSON lines")
+    parser.add_argument("--json", action="store_true", default=False, help="Print each result as a JSON object with its rank, name, path and removed duplicates")
+    parser.add_argument("--no-server", action="store_true", default=False, help="Run the job in this process even if a 'rank-files serve' daemon is running")
     parser.add_argument("-q", "--quiet", action="store_true", default=False, help="Only print final rankings, no stats or progress bar")
-    args = parser.parse_args()
-    docs = [FileDocument(p) for p in Path(args.input_dir).iterdir()]
-    estimate = tournament_estimated_comparisons(args.top_k, len(docs))
-    if estimate > MAX_COMPARISONS:
-        raise MaxComparisonsExceededError(f"This job could require {estimate} pairwise comparisons. {MAX_COMPARISONS_MESSAGE}")
+    # Not an option, but part of the arguments so that a job sent to a server is held to the
+    # limit in the environment it was started from, rather than the server's.
+    parser.set_defaults(max_comparisons=MAX_COMPARISONS)
+    return parser
+
+
+def check_args(parser: ArgumentParser, args: Namespace) -> None:
+    """Exits with an error message (via parser.error()) if the arguments can't be used together."""
+    if not load_jobs(args):
+        parser.error("no criteria given")
+    if args.distributed and args.batch:
+        parser.error("--distributed and --batch can't be used together")
+    if args.distributed and args.reduce == ReductionStrategy.SUMMARY and not QueueRanker.supports_summarize:
+        parser.error("--reduce summary can't be used with --distributed")
+    if args.prefilter is not None and args.prefilter < 1:
+        parser.error("--prefilter must be at least 1")
+    if args.prefilter_model is not None and args.prefilter is None:
+        parser.error("--prefilter-model requires --prefilter")
+    if args.max_attempts < 1:
+        parser.error("--max-attempts must be at least 1")
+    if args.max_cost is not None and not args.price:
+        parser.error("--max-cost requires --price")
+    if args.distributed and default_cache_path() == ":memory:":
+        parser.error("--distributed requires a cache file shared with the workers; set RANK_FILES_CACHE")
+
+
+def build_scheduler(args: Namespace, concurrency: int) -> RequestScheduler:
+    """
+    Creates a RequestScheduler with the rate limits and attempts given by the arguments, which
+    lets up to concurrency requests run at once.
+    """
+    return RequestScheduler(args.requests_per_minute, args.tokens_per_minute, max_concurrency=max(1, concurrency), max_attempts=args.max_attempts)
+
+
+def create_ranker(args: Namespace, cache: Cache, provider: str, model: str) -> Ranker:
+    """Creates the Ranker for the provider and model, configured by the arguments."""
+    if args.distributed:
+        return QueueRanker(provider, model, cache, WorkQueue(cache.path), infer=not args.no_inference)
+    return build_ranker(provider, model, cache=cache, batch=args.batch, infer=not args.no_inference, keep_alive=parse_keep_alive(args.keep_alive), max_num_ctx=args.max_num_ctx, scheduler=build_scheduler(args, args.concurrency))
+
+
+def run(args: Namespace, cache: Cache, ranker: Ranker, provider: str, model: str, budget: TextBudget, out: TextIO, err: TextIO, digests: Optional[DigestMemo] = None, progress: Optional[Callable[[int], AbstractContextManager]] = None) -> None:
+    """
+    Runs the jobs given by the arguments (see load_jobs()), printing results to out and
+    statistics to out or err. This is the body of main(); it's also used by the server, which
+    keeps the cache, ranker, budget and digests (see FileDocument) from one run to the next.
+    progress is called with the estimated number of comparisons and should return a context
+    manager giving an object whose update() is called after each comparison; by default it's a
+    tqdm progress bar on stderr.
+    """
+    if progress is None:
+        progress = lambda total: tqdm(total=total, disable=args.quiet)
+    jobs = load_jobs(args)
+    root = Path(args.input_dir)
+    report = DiscoveryReport()
+    paths = discover_files(root, args.recursive, args.include, args.exclude, args.min_size, args.max_size, report)
+    docs = [FileDocument(p, budget, digests=digests) for p in paths]
     docs.sort(key=lambda d: d.cheap_sort_key())
-    cache = default_cache()
-    ranker = build_ranker(cache=cache)
-    docs = ranker.wrap_for_pairwise_comparison(args.criteria, docs)
-    with tqdm(total=estimate, disable=args.quiet) as pbar:
-        tracker = ComparisonTracker(max_comparisons=MAX_COMPARISONS, pbar=pbar)
-        docs = tracker.wrap(docs)
+    if not args.keep_duplicates:
+        docs = remove_duplicates(docs, report)
+    # Every job uses the same documents, so they're only read and hashed once. Summaries are
+    # specific to the criteria, though.
+    job_docs = [docs] * len(jobs)
+    if args.max_doc_tokens is not None:
+        if args.reduce == ReductionStrategy.SUMMARY:
+            job_docs = [build_reducer(args, cache, ranker, provider, model, job.criteria).wrap(docs) for job in jobs]
+        else:
+            job_docs = [build_reducer(args, cache, ranker, provider, model, jobs[0].criteria).wrap(docs)] * len(jobs)
+    # Everything the model is asked is charged to the budget, including summaries and scores.
+    call_budget = CallBudget(args.max_comparisons * len(jobs), args.max_tokens, args.max_cost, args.price)
+    if ranker.records is not None:
+        ranker.records.budget = call_budget
+    prefilter = None
+    selections: list[Optional[Selection]] = [None] * len(jobs)
+    unscored: list[list[Document]] = [[] for _ in jobs]
+    if args.prefilter is not None:
+        prefilter = build_prefilter(args, cache, provider, call_budget)
+        # Lexical scores cost nothing, so a dry run computes them, but not the scorer model's.
+        if args.prefilter_model is not None:
+            unscored = [prefilter.pending(job.criteria, d) for job, d in zip(jobs, job_docs)]
+            if not args.dry_run:
+                tokens = sum(score_tokens(job.criteria, d) for job, d in zip(jobs, unscored))
+                try:
+                    call_budget.check(0, tokens)
+                except BudgetExceededError as exc:
+                    raise BudgetExceededError(f"Scoring {sum(map(len, unscored))} documents for --prefilter would take about {tokens} input tokens. {exc}.", exc.limit) from exc
+        cached_only = args.dry_run and args.prefilter_model is not None
+        selections = [prefilter.select(job.criteria, d, cached_only) for job, d in zip(jobs, job_docs)]
+        job_docs = [selection.docs for selection in selections]
+    plans = [plan_job(args, cache, ranker, provider, model, job, d) for job, d in zip(jobs, job_docs)]
+    # A dry run is only needed if the plan's estimates, which ignore the cache, could exceed the budget.
+    if args.dry_run or args.max_tokens is not None or args.max_cost is not None or any(plan.estimate > args.max_comparisons for plan in plans):
+        dry_runs = [dry_run(args, cache, ranker, job, plan) for job, plan in zip(jobs, plans)]
+        if args.dry_run:
+            for job, dry, docs_to_score in zip(jobs, dry_runs, unscored):
+                dry.count_scores(job.criteria, docs_to_score)
+        # Scores and summaries made so far have already been charged.
+        calls = call_budget.total_calls + sum(dry.total_uncached for dry in dry_runs)
+        tokens = call_budget.total_tokens + sum(dry.total_tokens for dry in dry_runs)
+        if args.dry_run:
+            for job, plan, dry, selection in zip(jobs, plans, dry_runs, selections):
+                print_dry_run(args, job, plan, dry, call_budget, out, selection)
+            try:
+                call_budget.check(calls, tokens)
+            except BudgetExceededError as exc:
+                print(f"Over budget: {exc}.", file=err if args.json else out)
+            return
+        try:
+            call_budget.check(calls, tokens)
+        except BudgetExceededError as exc:
+            extra = f" {max_comparisons_message(args.max_comparisons, len(jobs))}" if exc.limit == "calls" else ""
+            raise BudgetExceededError(f"This job would probably make {calls} model calls with about {tokens} input tokens. {exc}.{extra}", exc.limit) from exc
+    if args.warm_up:
+        ranker.warm_up(max(warm_up_tokens(job.criteria, plan.docs, plan.group_size) for job, plan in zip(jobs, plans)))
+    with progress(sum(plan.estimate for plan in plans)) as pbar:
+        tracer = None if args.trace is None else Tracer()
+        # The budget limits model calls, but rankers that don't cache results don't use one.
+        max_comparisons = args.max_comparisons * len(jobs) if ranker.records is None else None
+        tracker = ComparisonTracker(max_comparisons=max_comparisons, pbar=pbar, tracer=tracer)
+        results: list[list[Document]] = [[] for _ in jobs]
+        def on_done(job: Job, docs: list[Document]) -> None:
+            results[next(i for i, j in enumerate(jobs) if j is job)] = docs
+            print_job_results(job, docs, args.json, root, report, out)
         try:
-            docs = tournament(args.top_k, docs)
+            if len(jobs) == 1:
+                for rank, doc in enumerate(find_top_k(args, cache, ranker, tracker, jobs[0], plans[0]), 1):
+                    results[0].append(doc)
+                    print_result(doc, rank, args.json, root, report, out=out)
+            else:
+                run_jobs(args, cache, ranker, tracker, jobs, plans, on_done)
         except MaxComparisonsExceededError as exc:
-            raise MaxComparisonsExceededError(f"This job attempted to use more than the allowed number of pairwise comparisons. {MAX_COMPARISONS_MESSAGE}") from exc
-        docs = tracker.unwrap(docs)
-        docs = ranker.unwrap(docs)
+            raise MaxComparisonsExceededError(f"This job attempted to use more than the allowed number of comparisons. {max_comparisons_message(args.max_comparisons, len(jobs))}") from exc
+        except BudgetExceededError as exc:
+            extra = f" {max_comparisons_message(args.max_comparisons, len(jobs))}" if exc.limit == "calls" else ""
+            raise BudgetExceededError(f"The job was stopped: {exc}.{extra}", exc.limit) from exc
+        finally:
+            if tracer is not None:
+                tracer.write(args.trace)
         if not args.quiet:
-            print(f"(Total comparisons: {tracker.total}. Cache hits: {cache.total_hits})")
-        for doc in docs:
-            print(doc)
+            # Keep stdout parseable as JSON lines when --json is used.
+            stats_file = err if args.json else out
+            inferred = "" if ranker.records is None else f" Inferred: {ranker.records.total_inferred}."
+            print(f"(Total comparisons: {tracker.total}.{inferred} {cache.summary()})", file=stats_file)
+            print(f"({report.summary()})", file=stats_file)
+            if args.list_duplicates:
+                print_duplicates(report, root, stats_file)
+            if ranker.records is not None:
+                print(call_budget.summary(), file=stats_file)
+            if prefilter is not None:
+                print(f"Prefilter scores computed: {prefilter.total_scored}.", file=stats_file)
+                for job, selection, docs in zip(jobs, selections, results):
+                    label = f"{job.name or job.criteria}: " if len(jobs) > 1 else ""
+                    print(label + stability_report(selection, docs), file=stats_file)
+            if ranker.scheduler is not None:
+                print(ranker.scheduler.summary(), file=stats_file)
+            if ranker.summary() is not None:
+                print(ranker.summary(), file=stats_file)
+            if tracer is not None:
+                print(tracer.summary(), file=stats_file)
+
+
+def main() -> None:
+    if sys.argv[1:2] == ["serve"]:
+        # Imported here since rank_files.server depends on this module.
+        from rank_files.server import serve_main
+        serve_main(sys.argv[2:])
+        return
+    parser = build_parser()
+    args = parser.parse_args()
+    check_args(parser, args)
+    provider = default_provider()
+    model = default_model(provider)
+    if not args.no_server:
+        status = run_on_server(args, provider, model, default_cache_path(), sys.stdout, sys.stderr)
+        if status is not None:
+            sys.exit(status)
+    with default_cache() as cache:
+        ranker = create_ranker(args, cache, provider, model)
+        run(args, cache, ranker, provider, model, TextBudget(MAX_TEXT_MEMORY), sys.stdout, sys.stderr)
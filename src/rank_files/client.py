@@ -0,0 +1,172 @@
+from argparse import Namespace
+from collections.abc import Iterator
+from http.client import HTTPConnection, HTTPException
+from tqdm import tqdm
+from typing import Optional, TextIO
+from urllib.parse import quote
+import json
+import os
+import socket
+
+
+DEFAULT_SOCKET_PATH = "rank-files-server.sock"
+
+
+class ServerError(Exception):
+    """Raised when a 'rank-files serve' daemon can't be reached or rejects a request."""
+    pass
+
+
+def default_socket_path() -> str:
+    """Returns the path in the RANK_FILES_SERVER env var, or a default in the current working directory."""
+    return os.getenv("RANK_FILES_SERVER", DEFAULT_SOCKET_PATH)
+
+
+def cache_id(path: str) -> str:
+    """Identifies a cache file, so that a client and server can check they use the same one."""
+    return path if path == ":memory:" else os.path.abspath(path)
+
+
+class UnixHTTPConnection(HTTPConnection):
+    """An HTTPConnection to a server listening on a Unix socket."""
+    def __init__(self, socket_path: str, timeout: Optional[float] = None) -> None:
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self) -> None:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+
+class ServerClient:
+    """
+    Talks to a 'rank-files serve' daemon over its Unix socket. See rank_files.server for the API.
+    Requests other than streaming time out after timeout seconds.
+    """
+    def __init__(self, socket_path: str, timeout: float = 10.0) -> None:
+        self.socket_path = socket_path
+        self.timeout = timeout
+
+    def _connect(self, method: str, url: str, body: Optional[dict] = None, timeout: Optional[float] = None) -> tuple[UnixHTTPConnection, object]:
+        conn = UnixHTTPConnection(self.socket_path, timeout)
+        try:
+            conn.request(method, url, body=None if body is None else json.dumps(body), headers={"Content-Type": "application/json"})
+            resp = conn.getresponse()
+        except (OSError, HTTPException) as exc:
+            conn.close()
+            raise ServerError(f"Couldn't reach the server at {self.socket_path}: {exc}") from exc
+        if resp.status >= 400:
+            try:
+                message = json.loads(resp.read())["error"]
+            except (OSError, HTTPException, ValueError, KeyError, TypeError):
+                message = f"HTTP status {resp.status}"
+            conn.close()
+            raise ServerError(message)
+        return conn, resp
+
+    def _request(self, method: str, url: str, body: Optional[dict] = None) -> dict:
+        conn, resp = self._connect(method, url, body, self.timeout)
+        try:
+            return json.loads(resp.read())
+        except (OSError, HTTPException, ValueError) as exc:
+            raise ServerError(f"Invalid response from the server at {self.socket_path}: {exc}") from exc
+        finally:
+            conn.close()
+
+    def status(self) -> dict:
+        """Returns the server's cache_id() and job counts."""
+        return self._request("GET", "/status")
+
+    def submit(self, args: dict, provider: str, model: str, cache: str) -> str:
+        """
+        Submits a job, given the rank-files arguments (see job_args()), and returns its ID.
+        cache is the client's cache_id(); the server rejects the job if it uses another cache.
+        """
+        return self._request("POST", "/jobs", {"args": args, "provider": provider, "model": model, "cache": cache})["id"]
+
+    def poll(self, job_id: str, since: int = 0) -> dict:
+        """Returns the job's status, error (if it failed) and events, starting with the event numbered since."""
+        return self._request("GET", f"/jobs/{quote(job_id)}?since={since}")
+
+    def stream(self, job_id: str, since: int = 0) -> Iterator[dict]:
+        """
+        Yields the job's events, starting with the event numbered since, as they happen. The
+        last one has the job's final status (and error, if it failed).
+        """
+        conn, resp = self._connect("GET", f"/jobs/{quote(job_id)}/stream?since={since}")
+        try:
+            for line in resp:
+                yield json.loads(line)
+        except (OSError, HTTPException, ValueError) as exc:
+            raise ServerError(f"Lost the connection to the server at {self.socket_path}: {exc}") from exc
+        finally:
+            conn.close()
+
+    def cancel(self, job_id: str) -> dict:
+        """Asks the server to stop the job; it stops before its next comparison."""
+        return self._request("DELETE", f"/jobs/{quote(job_id)}")
+
+
+def job_args(args: Namespace) -> dict:
+    """
+    Returns the rank-files arguments as JSON, with paths made absolute for the server. They
+    include max_comparisons, so the server applies this process's limit on model calls.
+    """
+    data = dict(vars(args))
+    for name in ("input_dir", "jobs", "trace"):
+        if data[name] is not None:
+            data[name] = os.path.abspath(data[name])
+    return data
+
+
+def run_on_server(args: Namespace, provider: str, model: str, cache_path: str, out: TextIO, err: TextIO) -> Optional[int]:
+    """
+    If a 'rank-files serve' daemon is listening on default_socket_path() and uses the same cache,
+    runs the job there, printing its output and progress as if it ran in this process, and
+    returns the exit status. Otherwise returns None, and the job should be run locally.
+    Interrupting this cancels the job.
+    """
+    socket_path = default_socket_path()
+    if not hasattr(socket, "AF_UNIX") or not os.path.exists(socket_path):
+        return None
+    client = ServerClient(socket_path)
+    try:
+        if client.status()["cache"] != cache_id(cache_path):
+            return None
+        job_id = client.submit(job_args(args), provider, model, cache_id(cache_path))
+    except ServerError:
+        # E.g. a socket left behind by a server that has stopped.
+        return None
+    pbar = None
+    try:
+        for event in client.stream(job_id):
+            if "out" in event or "err" in event:
+                file = out if "out" in event else err
+                with tqdm.external_write_mode(file=file):
+                    file.write(event.get("out", event.get("err")))
+                    file.flush()
+            elif "total" in event:
+                pbar = tqdm(total=event["total"], disable=args.quiet, file=err)
+            elif "progress" in event and pbar is not None:
+                pbar.update(event["progress"] - pbar.n)
+            elif "status" in event:
+                if event["status"] == "done":
+                    return 0
+                print(f"rank-files: error: {event.get('error') or 'the job was ' + event['status']}", file=err)
+                return 1
+    except KeyboardInterrupt:
+        try:
+            client.cancel(job_id)
+        except ServerError:
+            pass
+        raise
+    except ServerError as exc:
+        print(f"rank-files: error: {exc}", file=err)
+        return 1
+    finally:
+        if pbar is not None:
+            pbar.close()
+    print("rank-files: error: the server stopped before the job finished", file=err)
+    return 1
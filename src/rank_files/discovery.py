@@ -0,0 +1,159 @@
+from codecs import getincrementaldecoder
+from collections.abc import Iterable
+from enum import StrEnum
+from fnmatch import fnmatch
+from pathlib import Path
+from rank_files.document import Document
+from typing import Optional
+import os
+
+
+SNIFF_BYTES = 8192
+
+
+class SkipReason(StrEnum):
+    """Why discover_files() left out a file."""
+    EXCLUDED = "excluded"
+    """It matched an exclude pattern."""
+    NOT_INCLUDED = "not included"
+    """Include patterns were given and it matched none of them."""
+    TOO_SMALL = "too small"
+    TOO_LARGE = "too large"
+    BINARY = "binary"
+    """It doesn't look like UTF-8 text; see is_probably_text()."""
+    UNREADABLE = "unreadable"
+    """It couldn't be opened or stat'd, e.g. because of its permissions."""
+
+
+class DiscoveryReport:
+    """
+    Describes what discover_files() and remove_duplicates() found. Statistics are kept in these
+    instance vars:
+    - total_found: files that were kept by discover_files()
+    - skipped: how many files were left out, by reason
+    - duplicates: for each set of documents with identical content found by
+      remove_duplicates(), maps their digest to the documents, starting with the one kept
+    """
+    def __init__(self) -> None:
+        self.total_found = 0
+        self.skipped: dict[SkipReason, int] = {}
+        self.duplicates: dict[str, list[Document]] = {}
+
+    def skip(self, reason: SkipReason) -> None:
+        self.skipped[reason] = self.skipped.get(reason, 0) + 1
+
+    def duplicates_of(self, doc: Document) -> list[Document]:
+        """Returns the documents that were removed as duplicates of the given one."""
+        return self.duplicates.get(doc.digest(), [doc])[1:]
+
+    def total_duplicates(self) -> int:
+        return sum(len(docs) - 1 for docs in self.duplicates.values())
+
+    def summary(self) -> str:
+        """Returns a human-readable description of the statistics."""
+        skipped = ", ".join(f"{count} {reason}" for reason, count in self.skipped.items()) or "none"
+        return f"Files found: {self.total_found}. Skipped: {skipped}. Duplicates removed: {self.total_duplicates()}."
+
+
+def _matches(patterns: Iterable[str], rel_path: str, name: str) -> bool:
+    return any(fnmatch(rel_path, pattern) or fnmatch(name, pattern) for pattern in patterns)
+
+
+def is_probably_text(path: Path, sniff_bytes: int = SNIFF_BYTES) -> bool:
+    """
+    Returns whether the file looks like UTF-8 text: its first sniff_bytes bytes contain no NUL
+    bytes and are valid UTF-8 (except that, in a longer file, a character may be cut off at the
+    end). Files that pass this check can still fail to decode later, if invalid bytes come
+    after the sniffed part.
+    """
+    with path.open("rb") as f:
+        head = f.read(sniff_bytes + 1)
+    if b"\0" in head:
+        return False
+    try:
+        getincrementaldecoder("utf8")().decode(head[:sniff_bytes], final=len(head) <= sniff_bytes)
+    except UnicodeDecodeError:
+        return False
+    return True
+
+
+def discover_files(root: Path, recursive: bool = False, include: Iterable[str] = (), exclude: Iterable[str] = (), min_size: int = 0, max_size: Optional[int] = None, report: Optional[DiscoveryReport] = None) -> list[Path]:
+    """
+    Returns the paths of the files to rank in the root directory, sorted, using os.scandir() so
+    that directories with many entries can be listed quickly.
+
+    If recursive is True, subdirectories are searched too; symlinks to directories aren't
+    followed, to avoid loops. Glob patterns in include and exclude are matched against each
+    path relative to the root (with / as the separator) and against its name alone. If include
+    patterns are given, only files matching one of them are kept. Files and directories
+    matching an exclude pattern are left out. Files smaller than min_size or larger than
+    max_size bytes, and those that don't look like text (see is_probably_text()), are left out
+    too. The number left out for each reason is recorded in the report, if given.
+    """
+    report = DiscoveryReport() if report is None else report
+    include = list(include)
+    exclude = list(exclude)
+    found = []
+    pending = [(root, "")]
+    while pending:
+        directory, prefix = pending.pop()
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                rel_path = prefix + entry.name
+                if _matches(exclude, rel_path, entry.name):
+                    report.skip(SkipReason.EXCLUDED)
+                    continue
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if recursive:
+                            pending.append((Path(entry.path), rel_path + "/"))
+                        continue
+                    if not entry.is_file():
+                        continue
+                    if include and not _matches(include, rel_path, entry.name):
+                        report.skip(SkipReason.NOT_INCLUDED)
+                        continue
+                    size = entry.stat().st_size
+                    if size < min_size:
+                        report.skip(SkipReason.TOO_SMALL)
+                        continue
+                    if max_size is not None and size > max_size:
+                        report.skip(SkipReason.TOO_LARGE)
+                        continue
+                    if not is_probably_text(Path(entry.path)):
+                        report.skip(SkipReason.BINARY)
+                        continue
+                except OSError:
+                    report.skip(SkipReason.UNREADABLE)
+                    continue
+                found.append(Path(entry.path))
+    found.sort()
+    report.total_found += len(found)
+    return found
+
+
+def remove_duplicates(docs: list[Document], report: Optional[DiscoveryReport] = None) -> list[Document]:
+    """
+    Returns the documents with only the first of each set of documents with identical content,
+    keeping their order. The removed documents are recorded in the report, if given.
+
+    Documents of different sizes can't be identical, so only documents that share their size
+    with another are hashed here.
+    """
+    by_size: dict[int, list[Document]] = {}
+    for doc in docs:
+        by_size.setdefault(doc.byte_size(), []).append(doc)
+    removed: set[int] = set()
+    for same_size in by_size.values():
+        if len(same_size) < 2:
+            continue
+        first: dict[str, Document] = {}
+        for doc in same_size:
+            digest = doc.digest()
+            if digest in first:
+                removed.add(id(doc))
+                if report is not None:
+                    report.duplicates.setdefault(digest, [first[digest]]).append(doc)
+            else:
+                first[digest] = doc
+    return [doc for doc in docs if id(doc) not in removed]
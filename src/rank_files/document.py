@@ -1,15 +1,28 @@
 from abc import ABC, abstractmethod
+from collections import OrderedDict
+from collections.abc import Callable
+from hashlib import file_digest, sha256
 from pathlib import Path
-from typing import Self
+from typing import Optional, Self
+from rank_files.trace import stage
+import mmap
+import threading
 
 
 class Document(ABC):
-    """Represents a document that we want to rank."""
+    """
+    Represents a document that we want to rank.
+
+    Documents are compared for equality by the digest of their content.
+    """
+    def __init__(self) -> None:
+        self._memo: dict[str, str] = {}
+
     @abstractmethod
     def read_text(self) -> str:
         """Get the full content of the document as text."""
         ...
-    
+
     @abstractmethod
     def read_bytes(self) -> bytes:
         """Get the full content of the document as bytes."""
@@ -23,22 +36,182 @@ class Document(ABC):
         """
         ...
 
+    def byte_size(self) -> int:
+        """Return the size of the document's content in bytes."""
+        return len(self.read_bytes())
+
+    def digest(self) -> str:
+        """Return a hex SHA-256 digest of the document's content."""
+        return sha256(self.read_bytes()).hexdigest()
+
+    def memoized_text(self, name: str, transform: Callable[[str], str]) -> str:
+        """
+        Return transform(self.read_text()). The result is remembered under the given name,
+        for as long as the document keeps its text in memory.
+        """
+        text = self.read_text()
+        result = self._memo.get(name)
+        if result is None:
+            result = transform(text)
+            self._memo[name] = result
+        return result
+
     def __eq__(self, other: Self) -> bool:
-        return self.read_bytes() == other.read_bytes()
+        return self.digest() == other.digest()
+
+    def __hash__(self) -> int:
+        return hash(self.digest())
+
+
+class TextBudget:
+    """
+    Limits how much document content FileDocuments keep in memory.
+
+    Documents register their content here when they load it. Once the total size exceeds
+    max_bytes, the least recently used documents are told to release their content (they will
+    reload it from disk if it's needed again). In a tournament, documents that have been
+    knocked out stop being used, so they are the first to be released.
+    """
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        # Maps id(doc) to (doc, size), since documents with equal content are equal and hash alike.
+        self._sizes: OrderedDict[int, tuple["FileDocument", int]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def touch(self, doc: "FileDocument", size: int) -> None:
+        """Record that the document holds content of the given size and has just been used."""
+        with self._lock:
+            if id(doc) in self._sizes:
+                self._sizes.move_to_end(id(doc))
+                return
+            self._sizes[id(doc)] = (doc, size)
+            self.total_bytes += size
+            evicted = []
+            while self.total_bytes > self.max_bytes and len(self._sizes) > 1:
+                _, (old, old_size) = self._sizes.popitem(last=False)
+                self.total_bytes -= old_size
+                evicted.append(old)
+        for old in evicted:
+            old.release()
+
+    def forget(self, doc: "FileDocument") -> None:
+        """Record that the document no longer holds any content."""
+        with self._lock:
+            entry = self._sizes.pop(id(doc), None)
+            if entry is not None:
+                self.total_bytes -= entry[1]
+
+
+class DigestMemo:
+    """
+    Remembers the digests of files, so that a long-running process (see rank_files.server)
+    doesn't hash an unchanged file again each time it creates a FileDocument for it. Files are
+    identified by path, size and modification time. At most max_entries digests are kept,
+    dropping the least recently used.
+    """
+    def __init__(self, max_entries: int = 100000) -> None:
+        self.max_entries = max_entries
+        self.total_hits = 0
+        self._digests: OrderedDict[tuple, str] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def stamp(self, path: Path) -> tuple:
+        """Returns the key identifying the current content of the file."""
+        st = path.stat()
+        return (str(path.resolve()), st.st_size, st.st_mtime_ns)
+
+    def get(self, stamp: tuple) -> Optional[str]:
+        with self._lock:
+            digest = self._digests.get(stamp)
+            if digest is not None:
+                self._digests.move_to_end(stamp)
+                self.total_hits += 1
+            return digest
+
+    def put(self, stamp: tuple, digest: str) -> None:
+        with self._lock:
+            self._digests[stamp] = digest
+            self._digests.move_to_end(stamp)
+            while len(self._digests) > self.max_entries:
+                self._digests.popitem(last=False)
 
 
 class FileDocument(Document):
-    """The main Document implementation."""
-    def __init__(self, path: Path):
+    """
+    The main Document implementation.
+
+    The file is read lazily, at most once for as long as its content is held in memory.
+    Its digest is computed without holding on to the content, and is kept for the life of the
+    object, so it can be used (e.g. for cache lookups) without keeping the content in memory. Files of at least mmap_threshold
+    bytes are memory-mapped, so hashing and decoding them doesn't require an extra copy.
+    If digests is given, digests are looked up in and added to it.
+    """
+    def __init__(self, path: Path, budget: Optional[TextBudget] = None, mmap_threshold: int = 1024 * 1024, digests: Optional[DigestMemo] = None):
         super().__init__()
         self.path = path
-    
+        self.budget = budget
+        self.digests = digests
+        self.mmap_threshold = mmap_threshold
+        self._text: Optional[str] = None
+        self._digest: Optional[str] = None
+
     def read_text(self) -> str:
-        return self.path.read_text("utf8")
-    
+        text = self._text
+        if text is None:
+            text = self._load()
+        if self.budget is not None:
+            self.budget.touch(self, len(text))
+        return text
+
     def read_bytes(self) -> bytes:
         return self.path.read_bytes()
-    
+
+    def byte_size(self) -> int:
+        return self.path.stat().st_size
+
+    def digest(self) -> str:
+        if self._digest is None:
+            if self.digests is None:
+                self._digest = self._hash()
+            else:
+                # The stamp is taken before hashing, so if the file is modified meanwhile, the
+                # stored digest won't match it later.
+                stamp = self.digests.stamp(self.path)
+                digest = self.digests.get(stamp)
+                if digest is None:
+                    digest = self._hash()
+                    self.digests.put(stamp, digest)
+                self._digest = digest
+        return self._digest
+
+    def _hash(self) -> str:
+        with stage("digest"), self.path.open("rb") as f:
+            return file_digest(f, "sha256").hexdigest()
+
+    def release(self) -> None:
+        """Drop the cached content of the file. It will be reread if it's needed again."""
+        self._text = None
+        self._memo = {}
+        if self.budget is not None:
+            self.budget.forget(self)
+
+    def _load(self) -> str:
+        with stage("read"), self.path.open("rb") as f:
+            size = self.path.stat().st_size
+            if size >= self.mmap_threshold:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    if self._digest is None:
+                        self._digest = sha256(mapped).hexdigest()
+                    text = str(mapped, "utf8")
+            else:
+                data = f.read()
+                if self._digest is None:
+                    self._digest = sha256(data).hexdigest()
+                text = data.decode("utf8")
+        self._text = text
+        return text
+
     def cheap_sort_key(self) -> str:
         return str(self.path)
 
@@ -51,15 +224,15 @@ class StrDocument(Document):
     def __init__(self, text: str):
         super().__init__()
         self.text = text
-    
+
     def read_text(self) -> str:
         return self.text
-    
+
     def read_bytes(self) -> bytes:
         return self.text.encode("utf8")
-    
+
     def cheap_sort_key(self) -> str:
         return self.read_text()
-    
+
     def __str__(self) -> str:
         return self.text
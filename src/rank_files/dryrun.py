@@ -0,0 +1,103 @@
+from collections.abc import Callable
+from rank_files.algos import ComparisonSteps, run_steps
+from rank_files.document import Document
+from rank_files.graph import ComparisonGraph
+from rank_files.ranker import LISTWISE_SYSTEM_PROMPT, PAIRWISE_SYSTEM_PROMPT, POINTWISE_SYSTEM_PROMPT, SUMMARIZE_SYSTEM_PROMPT, ComparisonRecords, Ranker, estimate_prompt_tokens, listwise_key
+from rank_files.sizing import ReducedDocument
+from typing import Optional
+import math
+
+
+def score_tokens(criteria: str, docs: list[Document]) -> int:
+    """Estimates the input tokens of asking a model to score each of the documents (see Ranker.supports_score)."""
+    return sum(estimate_prompt_tokens(POINTWISE_SYSTEM_PROMPT, criteria, [doc.byte_size()]) for doc in docs)
+
+
+class DryRunRanker(Ranker):
+    """
+    A Ranker which simulates a job without calling the model, to find out what it would cost.
+    Each comparison is counted as cached, inferred (from cached results, or from the assumed
+    results of earlier comparisons in the dry run, if source infers results) or requiring a
+    model call. The result of a model call can't be known in advance, so the document that
+    comes first (in canonical_order(), or in a group passed to choose_best()) is assumed to
+    win; the counts after the first such comparison are therefore estimates.
+
+    source is the ComparisonRecords of the ranker that would run the job; the cache is only
+    read. If it's None, every comparison counts as requiring a model call.
+
+    Counts are kept in these instance vars:
+    - total_cached, total_inferred and total_uncached: comparisons of each kind
+    - total_summaries: documents which the model would summarize (see DocumentReducer) to
+      make the uncached comparisons
+    - total_scores: documents which a model would score, as counted by count_scores()
+    - total_tokens: the estimated input tokens of the uncached comparisons, summaries and
+      scores (see estimate_prompt_tokens())
+    - total_rounds: rounds of model calls, when driven by run_steps(); see there
+    """
+    def __init__(self, source: Optional[ComparisonRecords]) -> None:
+        self.source = source
+        self.total_cached = 0
+        self.total_inferred = 0
+        self.total_uncached = 0
+        self.total_summaries = 0
+        self.total_scores = 0
+        self.total_tokens = 0
+        self.total_rounds = 0
+        self._graphs: dict[str, ComparisonGraph] = {}
+        self._summarized: set[str] = set()
+
+    def _call(self, system_prompt: str, criteria: str, docs: list[Document]) -> None:
+        self.total_uncached += 1
+        self.total_tokens += estimate_prompt_tokens(system_prompt, criteria, [doc.byte_size() for doc in docs])
+        for doc in docs:
+            if isinstance(doc, ReducedDocument) and doc.digest() not in self._summarized and doc.pending_summary():
+                self._summarized.add(doc.digest())
+                self.total_summaries += 1
+                self.total_tokens += estimate_prompt_tokens(SUMMARIZE_SYSTEM_PROMPT, criteria, [doc.summary_input_size()])
+
+    def count_scores(self, criteria: str, docs: list[Document]) -> None:
+        """Counts the model calls to score the documents, e.g. those Prefilter.pending() returns."""
+        self.total_scores += len(docs)
+        self.total_tokens += score_tokens(criteria, docs)
+
+    def _choose_better(self, criteria: str, doc1: Document, doc2: Document) -> Document:
+        if self.source is None:
+            self._call(PAIRWISE_SYSTEM_PROMPT, criteria, [doc1, doc2])
+            return doc1
+        key = self.source.key(criteria, doc1, doc2)
+        graph = self._graphs.get(key.criteria_digest)
+        if graph is None:
+            graph = self._graphs[key.criteria_digest] = self.source.load_graph(key.criteria_digest)
+        winner = self.source.peek(criteria, doc1, doc2)
+        if winner is not None:
+            self.total_cached += 1
+        elif self.source.infer and (winner := graph.infer(doc1.digest(), doc2.digest())) is not None:
+            self.total_inferred += 1
+        else:
+            self._call(PAIRWISE_SYSTEM_PROMPT, criteria, [doc1, doc2])
+            winner = doc1.digest()
+            graph.add(doc1.digest(), doc2.digest())
+        return doc1 if winner == doc1.digest() else doc2
+
+    def _choose_best(self, criteria: str, docs: list[Document]) -> Document:
+        if len(docs) <= 2:
+            return super()._choose_best(criteria, docs)
+        if self.source is not None:
+            best = self.source.cache.fetch(listwise_key(self.source.provider, self.source.model, criteria, docs), count=False)
+            if best is not None:
+                self.total_cached += 1
+                return next(doc for doc in docs if doc.digest() == best)
+        self._call(LISTWISE_SYSTEM_PROMPT, criteria, docs)
+        return docs[0]
+
+    def run_steps(self, steps: ComparisonSteps, compare_all: Callable[[list], list], concurrency: int = 1) -> list:
+        """
+        Like rank_files.algos.run_steps(), but also counts the rounds of model calls: the
+        uncached comparisons in each batch are divided among concurrency workers.
+        """
+        def counted(batch: list) -> list:
+            before = self.total_uncached
+            results = compare_all(batch)
+            self.total_rounds += math.ceil((self.total_uncached - before) / max(1, concurrency))
+            return results
+        return run_steps(steps, counted)
@@ -0,0 +1,65 @@
+from collections import deque
+from enum import StrEnum
+from typing import Optional
+import threading
+
+
+class CyclePolicy(StrEnum):
+    """What ComparisonGraph.infer() does when earlier results imply both possible answers."""
+    ASK = "ask"
+    """Infer nothing, so that the model is asked."""
+    SHORTER = "shorter"
+    """Use the answer implied by the shorter chain of results, if there is one."""
+
+
+class ComparisonGraph:
+    """
+    Records which documents (identified by digest) have beaten which others, under a single
+    model and criteria, so that the result of a new comparison can sometimes be inferred:
+    if A beat B and B beat C, then presumably A would beat C.
+
+    Models don't always judge consistently, so the recorded results may contain cycles
+    (A beat B, B beat C, C beat A); the cycle_policy determines what is inferred in that case.
+    """
+    def __init__(self, cycle_policy: CyclePolicy = CyclePolicy.ASK) -> None:
+        self.cycle_policy = cycle_policy
+        self._beaten: dict[str, set[str]] = {}
+        self._lock = threading.Lock()
+
+    def add(self, winner: str, loser: str) -> None:
+        """Record that the document with digest winner beat the document with digest loser."""
+        if winner == loser:
+            return
+        with self._lock:
+            self._beaten.setdefault(winner, set()).add(loser)
+
+    def chain_length(self, winner: str, loser: str) -> Optional[int]:
+        """
+        Returns the length of the shortest chain of results through which winner beat loser,
+        or None if there isn't one.
+        """
+        with self._lock:
+            distances = {winner: 0}
+            queue = deque([winner])
+            while queue:
+                current = queue.popleft()
+                for beaten in self._beaten.get(current, ()):
+                    if beaten in distances:
+                        continue
+                    if beaten == loser:
+                        return distances[current] + 1
+                    distances[beaten] = distances[current] + 1
+                    queue.append(beaten)
+            return None
+
+    def infer(self, digest1: str, digest2: str) -> Optional[str]:
+        """Returns the digest of the document that the recorded results imply is better, or None."""
+        forward = self.chain_length(digest1, digest2)
+        backward = self.chain_length(digest2, digest1)
+        if backward is None:
+            return None if forward is None else digest1
+        if forward is None:
+            return digest2
+        if self.cycle_policy == CyclePolicy.SHORTER and forward != backward:
+            return digest1 if forward < backward else digest2
+        return None
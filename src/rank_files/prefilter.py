@@ -0,0 +1,154 @@
+from collections import Counter
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
+from rank_files.cache import Cache
+from rank_files.document import Document
+from typing import NamedTuple, Optional
+import json
+import re
+
+
+# Increment this if lexical_score() changes, so that scores cached by the old version aren't reused.
+LEXICAL_VERSION = 1
+LEXICAL_SCORER_ID = f"lexical:{LEXICAL_VERSION}"
+
+# The usual BM25 parameters, and the document length (in words) at which no length
+# normalization is applied.
+BM25_K1 = 1.2
+BM25_B = 0.75
+REFERENCE_LENGTH = 500
+
+_WORD_PATTERN = re.compile(r"\w+")
+
+# Words which are common in criteria but say nothing about what the best documents contain.
+_STOPWORDS = frozenset("""
+    a about all an and any are as at be best better by do does document documents for from
+    has have how if in is it its more most not of on one or should than that the their them
+    then these this those to was what when which who with would
+""".split())
+
+
+def _words(text: str) -> list[str]:
+    return [word.casefold() for word in _WORD_PATTERN.findall(text)]
+
+
+def lexical_score(criteria: str, text: str) -> float:
+    """
+    A cheap local estimate of how well the text matches the criteria: each word of the criteria
+    (other than common ones) that occurs in the text adds to the score, with repeats counting
+    for less and long texts scaled down, as in BM25 with every word weighted alike. It only
+    helps when the criteria say what the best documents are about (e.g. "the best document
+    explains how tides work"); criteria about style or quality need a scorer model.
+    """
+    terms = {word for word in _words(criteria) if word not in _STOPWORDS}
+    words = _words(text)
+    if not terms or not words:
+        return 0.0
+    counts = Counter(word for word in words if word in terms)
+    norm = BM25_K1 * (1 - BM25_B + BM25_B * len(words) / REFERENCE_LENGTH)
+    return sum(tf * (BM25_K1 + 1) / (tf + norm) for tf in counts.values())
+
+
+class Selection(NamedTuple):
+    """
+    The result of Prefilter.select(). docs are the documents kept, in their original order;
+    ranks maps the digest of each document to its rank by score (1 is the best); total is the
+    number of documents scored; and uncached is how many of them had no score in the cache.
+    """
+    docs: list[Document]
+    ranks: dict[str, int]
+    total: int
+    uncached: int
+
+
+class Prefilter:
+    """
+    The first stage of a cascade: scores each document against the criteria on its own, with
+    a cheap scorer, and keeps only the m best-scoring documents to be ranked pairwise by the
+    (more expensive) model.
+
+    score is called with the criteria and a document and returns a number, higher being better:
+    e.g. lexical_score() of the document's text, or the score() of a Ranker with supports_score, using a small model.
+    Documents are scored by up to concurrency threads at once. Scores are stored in the Cache,
+    keyed by scorer_id (which identifies the scorer, e.g. its provider and model), the criteria
+    and the digest of the document's content, so a document is only scored once per criteria,
+    and a cache hit doesn't require reading it.
+
+    total_scored counts the scores computed (i.e. not found in the cache).
+    """
+    def __init__(self, m: int, score: Callable[[str, Document], float], scorer_id: str, cache: Optional[Cache] = None, concurrency: int = 1) -> None:
+        self.m = m
+        self.score = score
+        self.scorer_id = scorer_id
+        self.cache = cache if cache is not None else Cache(":memory:")
+        self.concurrency = concurrency
+        self.total_scored = 0
+
+    def key(self, criteria: str, doc: Document) -> str:
+        """Returns the cache key for the document's score."""
+        criteria_digest = sha256(criteria.encode()).hexdigest()
+        return "score:" + sha256(json.dumps([self.scorer_id, criteria_digest, doc.digest()]).encode()).hexdigest()
+
+    def scores(self, criteria: str, docs: list[Document], cached_only: bool = False) -> list[Optional[float]]:
+        """
+        Returns the score of each document, from the cache if possible. With cached_only, no
+        scores are computed, and those that aren't cached are None.
+        """
+        keys = [self.key(criteria, doc) for doc in docs]
+        found = self.cache.fetch_many(keys, count=False)
+        scores: list[Optional[float]] = [None if key not in found else float(found[key]) for key in keys]
+        missing = [i for i, score in enumerate(scores) if score is None]
+        if missing and not cached_only:
+            def compute(i: int) -> float:
+                score = float(self.score(criteria, docs[i]))
+                self.cache.put(keys[i], str(score))
+                return score
+            with ThreadPoolExecutor(max(1, self.concurrency)) as pool:
+                for i, score in zip(missing, pool.map(compute, missing)):
+                    scores[i] = score
+            self.total_scored += len(missing)
+        return scores
+
+    def pending(self, criteria: str, docs: list[Document]) -> list[Document]:
+        """Returns the documents whose scores aren't cached, which scores() would compute."""
+        keys = [self.key(criteria, doc) for doc in docs]
+        found = self.cache.fetch_many(keys, count=False)
+        return [doc for doc, key in zip(docs, keys) if key not in found]
+
+    def select(self, criteria: str, docs: list[Document], cached_only: bool = False) -> Selection:
+        """
+        Scores the documents and returns the m best. Ties are broken by the documents' order,
+        and with cached_only, documents without a cached score rank below the rest.
+        """
+        scores = self.scores(criteria, docs, cached_only)
+        order = sorted(range(len(docs)), key=lambda i: (scores[i] is None, -(scores[i] or 0.0)))
+        ranks: dict[str, int] = {}
+        for rank, i in enumerate(order, 1):
+            ranks.setdefault(docs[i].digest(), rank)
+        kept = sorted(order[:self.m])
+        return Selection([docs[i] for i in kept], ranks, len(docs), scores.count(None))
+
+
+def stability_report(selection: Selection, results: list[Document]) -> str:
+    """
+    Describes how much the results of ranking the documents a Prefilter kept depend on m, using
+    each result's rank by score. With a smaller m, the results ranked below it would have been
+    dropped, so the top documents would have changed. If some results were ranked close to m,
+    documents just below the cutoff probably compete with them, and a larger m may change the
+    results too.
+    """
+    m = len(selection.docs)
+    ranks = [selection.ranks[doc.digest()] for doc in results]
+    lines = [f"Prefilter kept {m} of {selection.total} documents. Ranks of the results by score: {', '.join(map(str, ranks)) or 'none'}."]
+    smaller = []
+    cut = m // 2
+    while cut >= max(1, len(results)):
+        smaller.append(f"{cut}: {sum(rank <= cut for rank in ranks)} of {len(ranks)}")
+        cut //= 2
+    if smaller:
+        lines.append(f"Results that would have been kept with a smaller m: {'; '.join(smaller)}.")
+    worst = max(ranks, default=0)
+    if worst > m // 2 and m < selection.total:
+        lines.append(f"The result ranked {worst} by score was in the bottom half of those kept, so a larger m may change the results.")
+    return " ".join(lines)
@@ -1,24 +1,47 @@
-from anthropic import Anthropic
 from abc import ABC, abstractmethod
 from enum import StrEnum
 from functools import total_ordering
 from hashlib import sha256
 from pathlib import Path
-from rank_files.cache import Cache, default_cache
+from rank_files.cache import Cache, ComparisonKey, default_cache
 from rank_files.document import Document
-from typing import Optional, Self
+from rank_files.graph import ComparisonGraph, CyclePolicy
+from rank_files.scheduler import InvalidLlmResponseError, RateLimitedError, RequestScheduler
+from rank_files.trace import annotate, stage
+from collections.abc import Callable
+from typing import TYPE_CHECKING, Optional, Self
+import asyncio
 import json
+import math
 import os
-import ollama
+import random
+import threading
+import time
 
+# The provider SDKs are slow to import, so they're only imported when a ranker for that
+# provider is created.
+if TYPE_CHECKING:
+    from anthropic import Anthropic, AsyncAnthropic
+    import ollama
 
 
 PAIRWISE_SYSTEM_PROMPT = Path(__file__).parent.joinpath("prompts", "pairwise-system.txt").read_text("utf8")
+PAIRWISE_SYSTEM_PROMPT_DIGEST = sha256(PAIRWISE_SYSTEM_PROMPT.encode()).hexdigest()
+LISTWISE_SYSTEM_PROMPT = Path(__file__).parent.joinpath("prompts", "listwise-system.txt").read_text("utf8")
+LISTWISE_SYSTEM_PROMPT_DIGEST = sha256(LISTWISE_SYSTEM_PROMPT.encode()).hexdigest()
+SUMMARIZE_SYSTEM_PROMPT = Path(__file__).parent.joinpath("prompts", "summarize-system.txt").read_text("utf8")
+POINTWISE_SYSTEM_PROMPT = Path(__file__).parent.joinpath("prompts", "pointwise-system.txt").read_text("utf8")
+POINTWISE_SYSTEM_PROMPT_DIGEST = sha256(POINTWISE_SYSTEM_PROMPT.encode()).hexdigest()
 
 
-class InvalidLlmResponseError(Exception):
-    """Raised when an LLM does not follow instructions and its output cannot be understood."""
-    pass
+class BudgetExceededError(Exception):
+    """
+    Raised instead of making a model call that would exceed a CallBudget. limit is the name of
+    the limit that would be exceeded: "calls", "tokens" or "cost".
+    """
+    def __init__(self, message: str, limit: str) -> None:
+        super().__init__(message)
+        self.limit = limit
 
 
 class ModelProvider(StrEnum):
@@ -65,11 +88,47 @@ def pairwise_user_prompt(criteria: str, doc1: Document, doc2: Document) -> str:
     Returns a prompt containing the given criteria and contents of the given documents.
     Meant to be used in conjunction with the PAIRWISE_SYSTEM_PROMPT.
     """
+    return "".join(pairwise_user_prompt_parts(criteria, doc1, doc2))
+
+
+def pairwise_user_prompt_parts(criteria: str, doc1: Document, doc2: Document) -> tuple[str, str]:
+    """
+    Returns pairwise_user_prompt() split in two: the part containing the criteria and doc1,
+    which is shared by every prompt comparing doc1 to something else, and the remainder.
+    """
     c = escape_prompt_part(criteria)
-    t1 = escape_prompt_part(doc1.read_text())
-    t2 = escape_prompt_part(doc2.read_text())
+    t1 = doc1.memoized_text("escaped", escape_prompt_part)
+    t2 = doc2.memoized_text("escaped", escape_prompt_part)
     extra = "\nRemember, you must respond with \"1\" or \"2\" and nothing else."
-    return f"<criteria>{c}</criteria>\n<document-1>{t1}</document-1>\n<document-2>{t2}</document-2>{extra}"
+    return f"<criteria>{c}</criteria>\n<document-1>{t1}</document-1>\n", f"<document-2>{t2}</document-2>{extra}"
+
+
+def summarize_user_prompt(criteria: str, text: str, max_tokens: int) -> str:
+    """
+    Returns a prompt asking for a summary of the text of at most max_tokens tokens.
+    Meant to be used in conjunction with the SUMMARIZE_SYSTEM_PROMPT.
+    """
+    c = escape_prompt_part(criteria)
+    t = escape_prompt_part(text)
+    return f"<criteria>{c}</criteria>\n<document>{t}</document>\nRemember, the summary must be shorter than {max_tokens * 3 // 4} words."
+
+
+def pointwise_user_prompt(criteria: str, doc: Document) -> str:
+    """
+    Returns a prompt asking for a score from 1 to 10 for the document.
+    Meant to be used in conjunction with the POINTWISE_SYSTEM_PROMPT.
+    """
+    c = escape_prompt_part(criteria)
+    t = doc.memoized_text("escaped", escape_prompt_part)
+    return f"<criteria>{c}</criteria>\n<document>{t}</document>\nRemember, you must respond with a number from 1 to 10 and nothing else."
+
+
+def extract_pointwise_response(doc: Document, resp_content: str) -> int:
+    """Given the response from invoking a model with pointwise_user_prompt, returns the score it gave."""
+    score = resp_content.strip()
+    if score.isdigit() and 1 <= int(score) <= 10:
+        return int(score)
+    raise InvalidLlmResponseError(f"Model was instructed to respond with a number from 1 to 10 for {doc} but got: {resp_content}")
 
 
 def extract_pairwise_response(doc1: Document, doc2: Document, resp_content: str) -> Document:
@@ -84,12 +143,70 @@ def extract_pairwise_response(doc1: Document, doc2: Document, resp_content: str)
     raise InvalidLlmResponseError(f"Model was instructed to respond '1' for {doc1} or '2' for {doc2} but got: {resp_content}")
 
 
+def listwise_user_prompt(criteria: str, docs: list[Document]) -> str:
+    """
+    Returns a prompt containing the given criteria and contents of the given documents.
+    Meant to be used in conjunction with the LISTWISE_SYSTEM_PROMPT.
+    """
+    parts = [f"<criteria>{escape_prompt_part(criteria)}</criteria>\n"]
+    for i, doc in enumerate(docs, 1):
+        parts.append(f"<document-{i}>{doc.memoized_text('escaped', escape_prompt_part)}</document-{i}>\n")
+    parts.append(f"Remember, you must respond with a number from 1 to {len(docs)} and nothing else.")
+    return "".join(parts)
+
+
+def extract_listwise_response(docs: list[Document], resp_content: str) -> Document:
+    """
+    Given the response from invoking a model with listwise_user_prompt, determines which document
+    the model chose as best.
+    """
+    choice = resp_content.strip()
+    if choice.isdigit() and 1 <= int(choice) <= len(docs):
+        return docs[int(choice) - 1]
+    raise InvalidLlmResponseError(f"Model was instructed to respond with a number from 1 to {len(docs)} but got: {resp_content}")
+
+
+def estimate_tokens(text: str) -> int:
+    """A rough, deliberately generous estimate of the number of tokens in the text."""
+    return len(text) // 2 + 1
+
+
+def listwise_group_size(docs: list[Document], context_tokens: Optional[int], max_group_size: int = 8) -> int:
+    """
+    Returns how many documents can be compared per call to Ranker.choose_best(), such that the
+    prompt fits in context_tokens even if it contains the longest of the given documents.
+    The result is between 2 and max_group_size.
+    """
+    if context_tokens is None or not docs:
+        return max_group_size
+    overhead = estimate_tokens(LISTWISE_SYSTEM_PROMPT) + 100
+    longest = max(estimate_tokens(doc.read_text()) for doc in docs)
+    return max(2, min(max_group_size, (context_tokens - overhead) // longest))
+
+
+def _group_by_criteria(pairs: list[tuple["PairwiseWrapper", "PairwiseWrapper"]]) -> dict[str, list[int]]:
+    """Returns the indices of the pairs of wrapped documents, grouped by their criteria (in order of appearance)."""
+    groups: dict[str, list[int]] = {}
+    for i, (a, _) in enumerate(pairs):
+        groups.setdefault(a.criteria, []).append(i)
+    return groups
+
+
+def canonical_order(doc1: Document, doc2: Document) -> tuple[Document, Document]:
+    """Returns the pair sorted by cheap_sort_key(), which is the order used for cache keys."""
+    if doc1.cheap_sort_key() > doc2.cheap_sort_key():
+        return doc2, doc1
+    return doc1, doc2
+
+
 @total_ordering
 class PairwiseWrapper:
     """
     An object which determines whether it is less-than/greater-than other objects by invoking
     a Ranker. Instances are created by Ranker.wrap_for_pairwise_comparison().
     """
+    __slots__ = ("wrapped", "ranker", "criteria")
+
     def __init__(self, wrapped: Document, ranker: "Ranker", criteria: str) -> None:
         self.wrapped = wrapped
         self.ranker = ranker
@@ -106,17 +223,32 @@ class PairwiseWrapper:
 
 
 class Ranker(ABC):
-    """Base class for document rankers."""
+    """
+    Base class for document rankers.
+
+    Rankers which cache their results set records to a ComparisonRecords instance, and those
+    which call a model through a RequestScheduler set scheduler to it.
+
+    Rankers which set supports_summarize implement summarize(criteria, text, max_tokens),
+    returning a summary of the text of at most about max_tokens tokens that preserves what's
+    relevant to the criteria; it's used by DocumentReducer with ReductionStrategy.SUMMARY.
+    Those which set supports_score implement score(criteria, doc), returning a score from 1
+    to 10 for how well the document meets the criteria, judged on its own; it's used by
+    Prefilter, typically with a smaller model than the one comparing documents.
+    """
+    records: Optional["ComparisonRecords"] = None
+    scheduler: Optional[RequestScheduler] = None
+    supports_summarize: bool = False
+    supports_score: bool = False
 
     def choose_better(self, criteria: str, doc1: Document, doc2: Document) -> Document:
         """
         Given some criteria and a pair of documents, returns the document which seems better
         according to the given criteria.
         """
-        if doc1.cheap_sort_key() > doc2.cheap_sort_key():
-            # This ensures we'll use the same cache entry regardless of the order of arguments.
-            return self.choose_better(criteria, doc2, doc1)
-        return self._choose_better(criteria, doc1, doc2)
+        annotate(doc1=str(doc1), doc2=str(doc2))
+        # This ensures we'll use the same cache entry regardless of the order of arguments.
+        return self._choose_better(criteria, *canonical_order(doc1, doc2))
 
     @abstractmethod
     def _choose_better(self, criteria: str, doc1: Document, doc2: Document) -> Document:
@@ -125,6 +257,81 @@ class Ranker(ABC):
         Subclasses should implement logic for determining the better document in this method.
         """
         ...
+
+    def choose_best(self, criteria: str, docs: list[Document]) -> Document:
+        """
+        Given some criteria and a list of documents, returns the document which seems best
+        according to the given criteria.
+        """
+        annotate(docs=[str(doc) for doc in docs])
+        # This ensures we'll use the same cache entry regardless of the order of arguments.
+        return self._choose_best(criteria, sorted(docs, key=lambda doc: doc.cheap_sort_key()))
+
+    def _choose_best(self, criteria: str, docs: list[Document]) -> Document:
+        """
+        Called by choose_best(). The default implementation makes len(docs)-1 calls to
+        choose_better(); subclasses may override it to compare all the documents at once.
+        """
+        best = docs[0]
+        for doc in docs[1:]:
+            best = self.choose_better(criteria, best, doc)
+        return best
+
+    def context_tokens(self) -> Optional[int]:
+        """
+        Returns the number of tokens the model can accept in one prompt, or None if unknown
+        or unlimited. Used with listwise_group_size() to decide how many documents to pass
+        to choose_best() at once.
+        """
+        return None
+
+    def schedule(self, criteria: str, pairs: list[tuple[Document, Document]]) -> list[int]:
+        """
+        Called with a group of independent comparisons that are about to be requested via
+        choose_better(), and returns the indices of the pairs in the order they should be
+        requested. Rankers whose model runs faster when similar requests are made together can
+        use this to group them. The default implementation keeps the original order.
+        """
+        return list(range(len(pairs)))
+
+    def schedule_wrapped(self, pairs: list[tuple[PairwiseWrapper, PairwiseWrapper]]) -> list[int]:
+        """
+        Calls schedule() for pairs of objects created by wrap_for_pairwise_comparison().
+        If the pairs have different criteria, each criteria's pairs are scheduled separately
+        and requested one criteria after another.
+        """
+        order = []
+        for criteria, indices in _group_by_criteria(pairs).items():
+            scheduled = self.schedule(criteria, [(pairs[i][0].wrapped, pairs[i][1].wrapped) for i in indices])
+            order.extend(indices[j] for j in scheduled)
+        return order
+
+    def warm_up(self, prompt_tokens: int) -> None:
+        """
+        Prepares the model for prompts of up to about prompt_tokens tokens before the first
+        comparison, e.g. by loading it into memory. The default implementation does nothing.
+        """
+        pass
+
+    def summary(self) -> Optional[str]:
+        """Returns a human-readable description of statistics kept by the ranker, if any."""
+        return None
+
+    def prefetch(self, criteria: str, pairs: list[tuple[Document, Document]]) -> None:
+        """
+        Called with a group of comparisons that are about to be requested via choose_better(),
+        so that rankers which can process many comparisons more efficiently at once have the
+        opportunity to do so and cache the results. The default implementation does nothing.
+        """
+        pass
+
+    def prefetch_wrapped(self, pairs: list[tuple[PairwiseWrapper, PairwiseWrapper]]) -> None:
+        """
+        Calls prefetch() for pairs of objects created by wrap_for_pairwise_comparison(), once
+        for each criteria among them.
+        """
+        for criteria, indices in _group_by_criteria(pairs).items():
+            self.prefetch(criteria, [(pairs[i][0].wrapped, pairs[i][1].wrapped) for i in indices])
     
     def wrap_for_pairwise_comparison(self, criteria: str, docs: list[Document]) -> list[PairwiseWrapper]:
         """
@@ -140,90 +347,1078 @@ class Ranker(ABC):
 
 class FakeRanker(Ranker):
     """A Ranker for testing purposes. It compares document text lexicographically."""
+    supports_summarize = True
+    supports_score = True
+
     def _choose_better(self, criteria: str, doc1: Document, doc2: Document) -> Document:
         if doc1.read_text() < doc2.read_text():
             return doc1
         return doc2
 
+    def summarize(self, criteria: str, text: str, max_tokens: int) -> str:
+        """Keeps the first max_tokens words of the text."""
+        return " ".join(text.split()[:max_tokens])
+
+    def score(self, criteria: str, doc: Document) -> int:
+        """
+        Scores documents by the first character of their text, so that those compared as better
+        score at least as high (ASCII characters get scores from 10 down to 1).
+        """
+        text = doc.read_text()
+        return 10 - min(9, ord(text[0]) * 10 // 128) if text else 10
+
+
+class SimulatedRanker(Ranker):
+    """
+    A Ranker for benchmarking, which behaves somewhat like a real model: it prefers the
+    document whose text has the smaller sort_key(text) (by default, like FakeRanker, the
+    lexicographically smaller text), but it can also be slow, wrong, biased and rate-limited.
+
+    - Each call sleeps for latency seconds, multiplied by a log-normally distributed factor
+      whose spread (the sigma of its logarithm) is latency_spread.
+    - With probability position_bias, the first document is chosen regardless of content.
+      Otherwise, with probability error_rate, the worse document is chosen.
+    - With probability rate_limit_rate, a call raises RateLimitedError instead of answering.
+
+    Whether a comparison is affected by bias or error is decided by hashing the seed and the
+    documents, so asking the same question twice gets the same answer, as from a model with
+    temperature 0. If a cache is provided, results are cached like a real model's. If a
+    scheduler is provided, calls are made through it, like a real model's.
+
+    The number of calls that answered or raised RateLimitedError is kept in total_calls and
+    total_rate_limited.
+    """
+    def __init__(self, latency: float = 0.0, latency_spread: float = 0.0, error_rate: float = 0.0, position_bias: float = 0.0, rate_limit_rate: float = 0.0, cache: Optional[Cache] = None, seed: int = 0, sort_key: Callable[[str], str] = lambda text: text, scheduler: Optional[RequestScheduler] = None) -> None:
+        self.sort_key = sort_key
+        self.latency = latency
+        self.latency_spread = latency_spread
+        self.error_rate = error_rate
+        self.position_bias = position_bias
+        self.rate_limit_rate = rate_limit_rate
+        self.seed = seed
+        self.total_calls = 0
+        self.total_rate_limited = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.cache = cache
+        self.scheduler = scheduler
+        if cache is not None:
+            self.records = ComparisonRecords(cache, ModelProvider.FAKE, f"simulated-{seed}", None, infer=False)
+
+    def _choose_better(self, criteria: str, doc1: Document, doc2: Document) -> Document:
+        if self.records is not None:
+            key, choice = self.records.lookup(criteria, doc1, doc2)
+            if choice is not None:
+                return choice
+        if self.scheduler is None:
+            choice = self._call(criteria, doc1, doc2, False)
+        else:
+            choice = self.scheduler.call(lambda swap: self._call(criteria, doc1, doc2, swap))
+        if self.records is not None:
+            self.records.record(key, doc1, doc2, choice)
+        return choice
+
+    def _call(self, criteria: str, doc1: Document, doc2: Document, swap: bool) -> Document:
+        """Simulates a model call, with the documents presented in the other order if swap is set."""
+        with self._lock:
+            self.total_calls += 1
+            limited = self._random.random() < self.rate_limit_rate
+            delay = self.latency * math.exp(self._random.gauss(0, self.latency_spread))
+            if limited:
+                self.total_rate_limited += 1
+        if limited:
+            raise RateLimitedError("Simulated rate limit")
+        with stage("model"):
+            time.sleep(delay)
+        judgment = random.Random(f"{self.seed}:{criteria}:{doc1.digest()}:{doc2.digest()}")
+        if judgment.random() < self.position_bias:
+            return doc2 if swap else doc1
+        choice, worse = (doc1, doc2) if self.sort_key(doc1.read_text()) < self.sort_key(doc2.read_text()) else (doc2, doc1)
+        if judgment.random() < self.error_rate:
+            return worse
+        return choice
+
+
+class PromptOrder:
+    """
+    Decides which document of a pair to present first in the prompt.
+
+    Providers can skip reprocessing a prompt prefix they have recently seen (Anthropic's prompt
+    caching, Ollama's KV cache). The document that was in the previous comparison is often in
+    the next one too: in a tournament, the winner of each match goes on to the next match. So
+    whichever document was just seen is put first, right after the system prompt and criteria.
+    """
+    def __init__(self) -> None:
+        self._recent: tuple[str, ...] = ()
+
+    def arrange(self, doc1: Document, doc2: Document) -> tuple[Document, Document]:
+        """Returns the pair in the order in which they should appear in the prompt."""
+        recent = self._recent
+        d1, d2 = doc1.digest(), doc2.digest()
+        if d2 in recent and (d1 not in recent or recent[0] == d2):
+            doc1, doc2, d1, d2 = doc2, doc1, d2, d1
+        self._recent = (d1, d2)
+        return doc1, doc2
+
+
+def comparison_key(provider: ModelProvider, model: str, criteria: str, doc1: Document, doc2: Document) -> ComparisonKey:
+    """Returns the key for caching the result of comparing the documents with PAIRWISE_SYSTEM_PROMPT."""
+    criteria_digest = sha256(criteria.encode()).hexdigest()
+    return ComparisonKey.build(provider, model, PAIRWISE_SYSTEM_PROMPT_DIGEST, criteria_digest, doc1.digest(), doc2.digest())
+
+
+def listwise_key(provider: ModelProvider, model: str, criteria: str, docs: list[Document]) -> str:
+    """
+    Returns the cache key for the result of choosing the best of the documents with
+    LISTWISE_SYSTEM_PROMPT. The value cached is the digest of the best document.
+    """
+    digests = sorted(doc.digest() for doc in docs)
+    criteria_digest = sha256(criteria.encode()).hexdigest()
+    return "listwise:" + sha256(json.dumps([provider, model, LISTWISE_SYSTEM_PROMPT_DIGEST, criteria_digest, digests]).encode()).hexdigest()
+
+
+def tournament_state_key(provider: ModelProvider, model: str, criteria: str, docs: list[Document]) -> str:
+    """
+    Returns the cache key under which the progress of a tournament over the given documents
+    is saved. The key doesn't depend on the order of the documents.
+    """
+    digests = sorted(doc.digest() for doc in docs)
+    criteria_digest = sha256(criteria.encode()).hexdigest()
+    return "tournament-state:" + sha256(json.dumps([provider, model, PAIRWISE_SYSTEM_PROMPT_DIGEST, criteria_digest, digests]).encode()).hexdigest()
+
+
+class CallBudget:
+    """
+    Limits the model calls made for a job: at most max_calls comparisons, with at most
+    max_tokens input tokens in total and at most max_cost dollars, given a price in dollars
+    per million input tokens. Tokens are estimated from document sizes with
+    estimate_prompt_tokens(), so they can be charged before each call is made. Results from
+    the cache, or inferred from earlier results, are free. Other calls (e.g. summaries and
+    prefilter scores, of which there's at most one per document) are charged with
+    comparison=False: their tokens count towards the limits, but they don't count against
+    max_calls.
+
+    The comparisons, other calls and tokens charged so far are kept in total_calls,
+    total_other_calls and total_tokens.
+    """
+    def __init__(self, max_calls: Optional[int] = None, max_tokens: Optional[int] = None, max_cost: Optional[float] = None, price: float = 0.0) -> None:
+        self.max_calls = max_calls
+        self.max_tokens = max_tokens
+        self.max_cost = max_cost
+        self.price = price
+        self.total_calls = 0
+        self.total_other_calls = 0
+        self.total_tokens = 0
+        self._lock = threading.Lock()
+
+    def cost(self, tokens: int) -> float:
+        """Returns the cost in dollars of the given number of input tokens."""
+        return tokens * self.price / 1_000_000
+
+    def check(self, calls: int, tokens: int) -> None:
+        """Raises BudgetExceededError if the given number of calls and tokens exceed the budget."""
+        if self.max_calls is not None and calls > self.max_calls:
+            raise BudgetExceededError(f"The limit of {self.max_calls} model calls would be exceeded", "calls")
+        if self.max_tokens is not None and tokens > self.max_tokens:
+            raise BudgetExceededError(f"The limit of {self.max_tokens} input tokens would be exceeded", "tokens")
+        if self.max_cost is not None and self.cost(tokens) > self.max_cost:
+            raise BudgetExceededError(f"The limit of ${self.max_cost:.2f} would be exceeded", "cost")
+
+    def charge(self, tokens: int, comparison: bool = True) -> None:
+        """Records a model call with the given number of input tokens, unless it would exceed the budget."""
+        with self._lock:
+            self.check(self.total_calls + comparison, self.total_tokens + tokens)
+            if comparison:
+                self.total_calls += 1
+            else:
+                self.total_other_calls += 1
+            self.total_tokens += tokens
+
+    def summary(self) -> str:
+        """Returns a human-readable description of the statistics."""
+        cost = f" Estimated cost: ${self.cost(self.total_tokens):.2f}." if self.price else ""
+        other = f" (and {self.total_other_calls} other calls)" if self.total_other_calls else ""
+        return f"Model calls: {self.total_calls}{other}. Estimated input tokens: {self.total_tokens}.{cost}"
+
+
+class ComparisonRecords:
+    """
+    Looks up and records the results of comparisons made with one provider and model.
+
+    Results are stored in the Cache under ComparisonKeys. legacy_key computes the key used by
+    older versions of this tool (see lookup()), or is None if there isn't one. If infer is True, the cached results
+    for each criteria are also loaded into a ComparisonGraph, which is used to infer the
+    results of comparisons that haven't been made yet, when possible. The number of results
+    that were inferred is counted in total_inferred.
+
+    If budget is set, each model call is charged to it before it's made: lookup() and
+    lookup_best() do this when they find no result, and rankers that call the model after
+    lookups with count=False (e.g. to prefetch a batch) call prepay() themselves, so that
+    lookup() doesn't charge again for comparisons that the call failed to answer.
+    """
+    def __init__(self, cache: Cache, provider: ModelProvider, model: str, legacy_key: Optional[Callable[[str, str, Document, Document], str]], infer: bool = True, cycle_policy: CyclePolicy = CyclePolicy.ASK) -> None:
+        self.cache = cache
+        self.provider = provider
+        self.model = model
+        self.legacy_key = legacy_key
+        self.infer = infer
+        self.cycle_policy = cycle_policy
+        self.total_inferred = 0
+        self.budget: Optional[CallBudget] = None
+        self._graphs: dict[str, ComparisonGraph] = {}
+        self._prepaid: set[str] = set()
+        self._lock = threading.Lock()
+
+    def key(self, criteria: str, doc1: Document, doc2: Document) -> ComparisonKey:
+        """Returns the key for caching the result of comparing the documents."""
+        return comparison_key(self.provider, self.model, criteria, doc1, doc2)
+
+    def load_graph(self, criteria_digest: str) -> ComparisonGraph:
+        """Returns a new graph of the cached results for the criteria."""
+        graph = ComparisonGraph(self.cycle_policy)
+        for key, winner in self.cache.comparisons_matching(self.provider, self.model, PAIRWISE_SYSTEM_PROMPT_DIGEST, criteria_digest):
+            graph.add(winner, key.doc2_digest if winner == key.doc1_digest else key.doc1_digest)
+        return graph
+
+    def graph(self, criteria_digest: str) -> ComparisonGraph:
+        """Returns the graph of cached results for the criteria, loading it if necessary."""
+        with self._lock:
+            graph = self._graphs.get(criteria_digest)
+            if graph is None:
+                graph = self.load_graph(criteria_digest)
+                self._graphs[criteria_digest] = graph
+            return graph
+
+    def charge(self, system_prompt: str, criteria: str, docs: list[Document]) -> None:
+        """Charges a call comparing the documents to the budget, if there is one; see CallBudget."""
+        if self.budget is not None:
+            self.budget.charge(estimate_prompt_tokens(system_prompt, criteria, [doc.byte_size() for doc in docs]))
+
+    def prepay(self, key: ComparisonKey, criteria: str, doc1: Document, doc2: Document) -> None:
+        """Charges a call comparing the documents that's made outside lookup(); see above."""
+        self.charge(PAIRWISE_SYSTEM_PROMPT, criteria, [doc1, doc2])
+        with self._lock:
+            self._prepaid.add(key.entry_key())
+
+    def charge_other(self, tokens: int) -> None:
+        """Charges a call that isn't a comparison (e.g. a summary) to the budget, if there is one."""
+        if self.budget is not None:
+            self.budget.charge(tokens, comparison=False)
+
+    def count_cached(self, criteria: str, docs: list[Document]) -> int:
+        """Returns how many comparisons between the given documents have cached results."""
+        digests = {doc.digest() for doc in docs}
+        criteria_digest = sha256(criteria.encode()).hexdigest()
+        matching = self.cache.comparisons_matching(self.provider, self.model, PAIRWISE_SYSTEM_PROMPT_DIGEST, criteria_digest)
+        return sum(1 for key, _ in matching if key.doc1_digest in digests and key.doc2_digest in digests)
+
+    def _fetch_legacy(self, criteria: str, doc1: Document, doc2: Document) -> Optional[Document]:
+        """Returns the winner of the comparison if it's cached under the legacy key (see lookup())."""
+        if self.legacy_key is None:
+            return None
+        content = self.cache.fetch(self.legacy_key(self.model, criteria, doc1, doc2), count=False)
+        if content not in ("1", "2"):
+            return None
+        return extract_pairwise_response(doc1, doc2, content)
+
+    def peek(self, criteria: str, doc1: Document, doc2: Document) -> Optional[str]:
+        """
+        Returns the digest of the winner of the comparison if it's cached, under its key or the
+        legacy one, like lookup() but without inferring, counting, charging or copying anything.
+        """
+        winner = self.cache.fetch(self.key(criteria, doc1, doc2).entry_key(), count=False)
+        if winner is None:
+            choice = self._fetch_legacy(criteria, doc1, doc2)
+            winner = None if choice is None else choice.digest()
+        return winner
+
+    def lookup(self, criteria: str, doc1: Document, doc2: Document, count: bool = True) -> tuple[ComparisonKey, Optional[Document]]:
+        """
+        Returns the key for the comparison, and the winner if it is cached or can be inferred.
+        If count is False, the lookup isn't included in the statistics. Otherwise, if there's no
+        winner, the model is about to be asked, so the call is charged to the budget.
+
+        Caches created by older versions of this tool used a hash of the full prompt as the key
+        (in canonical_order()) and the model's raw response as the value. If the comparison isn't
+        found under its ComparisonKey, the legacy key is tried, and a result found that way is
+        copied to the new key. Computing the legacy key requires building the prompt, but that's
+        only done when there's a cache miss, in which case the prompt is about to be needed anyway.
+        """
+        with stage("cache"):
+            key = self.key(criteria, doc1, doc2)
+            winner = self.cache.fetch(key.entry_key(), count=False)
+            if winner is None and (choice := self._fetch_legacy(criteria, doc1, doc2)) is not None:
+                self.record(key, doc1, doc2, choice)
+                winner = choice.digest()
+            if count:
+                self.cache.count_lookup(winner is not None)
+                annotate(cache_hit=winner is not None)
+        if winner is None and self.infer:
+            with stage("infer"):
+                winner = self.graph(key.criteria_digest).infer(doc1.digest(), doc2.digest())
+            if winner is not None and count:
+                annotate(inferred=True)
+                with self._lock:
+                    self.total_inferred += 1
+        if winner is None:
+            if count:
+                with self._lock:
+                    prepaid = key.entry_key() in self._prepaid
+                    self._prepaid.discard(key.entry_key())
+                if not prepaid:
+                    self.charge(PAIRWISE_SYSTEM_PROMPT, criteria, [doc1, doc2])
+            return key, None
+        return key, doc1 if winner == doc1.digest() else doc2
+
+    def record(self, key: ComparisonKey, doc1: Document, doc2: Document, choice: Document) -> None:
+        """Store the result of a comparison between doc1 and doc2."""
+        loser = doc2 if choice is doc1 else doc1
+        with stage("cache"):
+            self.cache.put_comparison(key, choice.digest())
+        with self._lock:
+            self._prepaid.discard(key.entry_key())
+            graph = self._graphs.get(key.criteria_digest)
+        if graph is not None:
+            graph.add(choice.digest(), loser.digest())
+
+    def lookup_best(self, criteria: str, docs: list[Document]) -> tuple[str, Optional[Document]]:
+        """
+        Returns the key for choosing the best of the documents, and the best one if it is cached.
+        If it isn't, the call is charged to the budget.
+        """
+        with stage("cache"):
+            key = listwise_key(self.provider, self.model, criteria, docs)
+            best = self.cache.fetch(key)
+        annotate(cache_hit=best is not None)
+        if best is None:
+            self.charge(LISTWISE_SYSTEM_PROMPT, criteria, docs)
+            return key, None
+        return key, next(doc for doc in docs if doc.digest() == best)
+
+    def record_best(self, key: str, choice: Document) -> None:
+        """Store the result of choosing the best of several documents."""
+        with stage("cache"):
+            self.cache.put(key, choice.digest())
+
+
+def _ollama_messages(criteria: str, doc1: Document, doc2: Document) -> list[dict]:
+    return [
+        {"role": "system", "content": PAIRWISE_SYSTEM_PROMPT},
+        {"role": "user", "content": pairwise_user_prompt(criteria, doc1, doc2)}
+    ]
+
+
+def _ollama_legacy_cache_key(model: str, criteria: str, doc1: Document, doc2: Document) -> str:
+    """Returns the cache key used for Ollama comparisons before ComparisonKey was introduced."""
+    messages = _ollama_messages(criteria, doc1, doc2)
+    return sha256(json.dumps({"provider": "ollama", "model": model, "messages": messages}).encode()).hexdigest()
+
+
+MIN_NUM_CTX = 2048
+
+# Ollama reports how long each request spent loading the model; when the model is already
+# loaded this is a few milliseconds, so anything longer is counted as a (re)load.
+RELOAD_THRESHOLD_SECONDS = 0.1
+
+# The fraction of available memory that the automatic num_ctx cap allows the KV cache to use.
+KV_CACHE_MEMORY_FRACTION = 0.5
+
+
+def parse_keep_alive(value: Optional[str]) -> Optional[float | str]:
+    """Converts a --keep-alive value to seconds if it's a number; otherwise it's passed to Ollama as a duration string."""
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+
+def num_ctx_bucket(tokens: int, max_num_ctx: Optional[int] = None) -> int:
+    """
+    Rounds tokens up to a power of two of at least MIN_NUM_CTX, so that prompts of similar
+    lengths use the same num_ctx, and caps the result at max_num_ctx if given.
+    """
+    bucket = MIN_NUM_CTX
+    while bucket < tokens:
+        bucket *= 2
+    return bucket if max_num_ctx is None else min(bucket, max_num_ctx)
+
+
+def available_memory() -> Optional[int]:
+    """Returns the number of bytes of physical memory currently available, if the OS reports it."""
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def ollama_max_num_ctx(modelinfo: dict, memory: Optional[int]) -> Optional[int]:
+    """
+    Returns the largest num_ctx that makes sense for a model, given the modelinfo reported by
+    Ollama's show API and the bytes of memory available: at most the model's context length,
+    and small enough that the KV cache (estimated from the model's layer and attention head
+    counts, at 16 bits per value) takes at most KV_CACHE_MEMORY_FRACTION of the memory. The
+    memory-based cap is a power of two, so it's one of the buckets num_ctx_bucket() returns.
+    Returns None if neither limit can be determined.
+
+    This assumes Ollama is running on the same machine, and ignores GPU memory.
+    """
+    info = {name.split(".", 1)[-1]: value for name, value in modelinfo.items()}
+    limits = []
+    if info.get("context_length"):
+        limits.append(info["context_length"])
+    layers = info.get("block_count")
+    kv_heads = info.get("attention.head_count_kv")
+    head_dim = info.get("attention.key_length")
+    if head_dim is None and info.get("embedding_length") and info.get("attention.head_count"):
+        head_dim = info["embedding_length"] // info["attention.head_count"]
+    if memory is not None and layers and kv_heads and head_dim:
+        bytes_per_token = 2 * layers * kv_heads * head_dim * 2
+        affordable = int(memory * KV_CACHE_MEMORY_FRACTION) // bytes_per_token
+        bucket = MIN_NUM_CTX
+        while bucket * 2 <= affordable:
+            bucket *= 2
+        limits.append(bucket)
+    return min(limits) if limits else None
+
+
+class OllamaContext:
+    """
+    Chooses num_ctx for Ollama requests, and counts how often the model had to be loaded.
+
+    Initial testing suggested that whatever Ollama does for prompts that exceed the context
+    length (I think it trims the beginning?) leads to poor results, so num_ctx is set to hold
+    the whole prompt. But Ollama reloads the model whenever num_ctx changes, which can take
+    seconds, so num_ctx is rounded up with num_ctx_bucket() and is never lowered: once the model
+    has been loaded with a larger context, shorter prompts use it too. It's capped at
+    max_num_ctx, if set.
+
+    Statistics are kept in these instance vars:
+    - total_loads and total_load_seconds: requests for which Ollama reported spending at least
+      RELOAD_THRESHOLD_SECONDS loading the model, and the total time spent loading
+    - total_resizes: how many times num_ctx was raised after the first request
+    """
+    # TODO The prompt length in tokens is a rough heuristic (see estimate_tokens()).
+    #      It would be nice to calculate this more exactly; see https://github.com/ollama/ollama/issues/3582
+    #      Oversized documents can be shortened beforehand with a DocumentReducer (see --max-doc-tokens).
+    def __init__(self, max_num_ctx: Optional[int] = None) -> None:
+        self.max_num_ctx = max_num_ctx
+        self.num_ctx = 0
+        self.total_loads = 0
+        self.total_load_seconds = 0.0
+        self.total_resizes = 0
+        self._lock = threading.Lock()
+
+    def bucket(self, tokens: int) -> int:
+        """Returns the num_ctx that a prompt of this many tokens would use, without choosing it."""
+        return max(self.num_ctx, num_ctx_bucket(tokens, self.max_num_ctx))
+
+    def choose(self, tokens: int) -> int:
+        """Returns the num_ctx to use for a prompt of this many tokens, raising it if necessary."""
+        with self._lock:
+            bucket = self.bucket(tokens)
+            if bucket != self.num_ctx:
+                if self.num_ctx:
+                    self.total_resizes += 1
+                self.num_ctx = bucket
+            return bucket
+
+    def record(self, resp) -> None:
+        """Records the model load time reported in a response from Ollama."""
+        nanos = getattr(resp, "load_duration", None)
+        if nanos is None or nanos / 1e9 < RELOAD_THRESHOLD_SECONDS:
+            return
+        with self._lock:
+            self.total_loads += 1
+            self.total_load_seconds += nanos / 1e9
+        annotate(model_loaded=True)
+
+    def summary(self) -> str:
+        return f"Model loads: {self.total_loads} ({self.total_load_seconds:.3f}s). num_ctx: {self.num_ctx} (raised {self.total_resizes} times)."
+
+
+def _ollama_prompt_tokens(messages: list[dict]) -> int:
+    return len(str(messages)) // 2
+
+
+def estimate_prompt_tokens(system_prompt: str, criteria: str, doc_sizes: list[int]) -> int:
+    """
+    Estimates the number of tokens, as counted for num_ctx, in a prompt containing documents of
+    the given sizes in bytes, without reading them.
+    """
+    return (len(system_prompt) + len(criteria) + sum(doc_sizes) + 100 * (len(doc_sizes) + 1)) // 2
+
+
+def _prompt_tokens(system_prompt: str, criteria: str, docs: list[Document]) -> int:
+    """Estimates the input tokens of a prompt comparing the documents, for a RequestScheduler's rate limits."""
+    return estimate_prompt_tokens(system_prompt, criteria, [doc.byte_size() for doc in docs])
+
+
+def _ollama_request(criteria: str, doc1: Document, doc2: Document, context: OllamaContext) -> tuple[list[dict], dict]:
+    """Returns the messages and options for asking Ollama to compare the documents."""
+    messages = _ollama_messages(criteria, doc1, doc2)
+    options = {
+        "num_predict": 1,
+        "num_ctx": context.choose(_ollama_prompt_tokens(messages)),
+        "temperature": 0,
+    }
+    return messages, options
+
+
+def _ollama_listwise_request(criteria: str, docs: list[Document], context: OllamaContext) -> tuple[list[dict], dict]:
+    """Returns the messages and options for asking Ollama to choose the best of the documents."""
+    messages = [
+        {"role": "system", "content": LISTWISE_SYSTEM_PROMPT},
+        {"role": "user", "content": listwise_user_prompt(criteria, docs)}
+    ]
+    options = {
+        "num_predict": 2,
+        "num_ctx": context.choose(_ollama_prompt_tokens(messages)),
+        "temperature": 0,
+    }
+    return messages, options
+
+
+def _ollama_schedule(context: OllamaContext, criteria: str, pairs: list[tuple[Document, Document]]) -> list[int]:
+    """Orders comparisons by the num_ctx they're expected to need, so that it's raised as few times as possible."""
+    buckets = [context.bucket(estimate_prompt_tokens(PAIRWISE_SYSTEM_PROMPT, criteria, [doc1.byte_size(), doc2.byte_size()])) for doc1, doc2 in pairs]
+    return sorted(range(len(pairs)), key=lambda i: buckets[i])
+
+
+def _annotate_ollama_call(messages: list[dict], options: dict, resp) -> None:
+    """Records the size of an Ollama request and the timings Ollama reports in the current trace."""
+    prompt_chars = sum(len(message["content"]) for message in messages)
+    prompt_tokens = getattr(resp, "prompt_eval_count", None)
+    annotate(
+        prompt_chars=prompt_chars,
+        prompt_tokens=estimate_tokens("".join(message["content"] for message in messages)) if prompt_tokens is None else prompt_tokens,
+        num_ctx=options["num_ctx"],
+    )
+    for name in ("load_duration", "prompt_eval_duration", "eval_duration"):
+        nanos = getattr(resp, name, None)
+        if nanos is not None:
+            annotate(**{name.replace("_duration", "_seconds"): nanos / 1e9})
+
+
+def _anthropic_legacy_cache_key(model: str, criteria: str, doc1: Document, doc2: Document) -> str:
+    """Returns the cache key used for Anthropic comparisons before ComparisonKey was introduced."""
+    user_prompt = pairwise_user_prompt(criteria, doc1, doc2)
+    return sha256(json.dumps({"provider": "anthropic", "model": model, "system_prompt": PAIRWISE_SYSTEM_PROMPT, "user_prompt": user_prompt}).encode()).hexdigest()
+
+
+def _annotate_anthropic_call(params: dict, resp) -> None:
+    """Records the size of an Anthropic request, and how much of it was read from the prompt cache, in the current trace."""
+    content = params["messages"][0]["content"]
+    texts = [content] if isinstance(content, str) else [block["text"] for block in content]
+    annotate(prompt_chars=len(params["system"]) + sum(len(text) for text in texts))
+    usage = getattr(resp, "usage", None)
+    if usage is None:
+        annotate(prompt_tokens=estimate_tokens(params["system"] + "".join(texts)))
+    else:
+        cache_read = getattr(usage, "cache_read_input_tokens", None) or 0
+        cache_creation = getattr(usage, "cache_creation_input_tokens", None) or 0
+        annotate(prompt_tokens=usage.input_tokens + cache_read + cache_creation, prompt_cache_read_tokens=cache_read)
+
+
+def _anthropic_listwise_params(model: str, criteria: str, docs: list[Document]) -> dict:
+    """Returns the messages.create() arguments for asking Claude to choose the best of the documents."""
+    return {
+        "model": model,
+        "max_tokens": 10,
+        "system": LISTWISE_SYSTEM_PROMPT,
+        "messages": [{"role": "user", "content": listwise_user_prompt(criteria, docs)}],
+    }
+
+
+def _anthropic_params(model: str, criteria: str, doc1: Document, doc2: Document) -> dict:
+    """
+    Returns the messages.create() arguments for asking Claude to compare the documents.
+    The system prompt, criteria and doc1 are marked as a cacheable prefix.
+    """
+    prefix, rest = pairwise_user_prompt_parts(criteria, doc1, doc2)
+    content = [
+        {"type": "text", "text": prefix, "cache_control": {"type": "ephemeral"}},
+        {"type": "text", "text": rest},
+    ]
+    return {
+        "model": model,
+        "max_tokens": 10, # I tried 1, but for some reason that results in an empty content array in the response,
+        "system": PAIRWISE_SYSTEM_PROMPT,
+        "messages": [{"role": "user", "content": content}],
+    }
+
 
 class OllamaRanker(Ranker):
     """
     A Ranker that invokes Ollama.
 
-    Responses are cached using the model name and a hash of the prompt.
+    Results are cached using a ComparisonKey, so a cache hit doesn't require reading the
+    documents or building the prompt. See ComparisonRecords regarding infer and cycle_policy.
+
+    See OllamaContext regarding the choice of num_ctx. If max_num_ctx isn't given, it's
+    determined with ollama_max_num_ctx() from the model's info and the available memory.
+    keep_alive is passed to Ollama with each request: it's how long the model stays loaded
+    afterwards, in seconds or as a duration string such as "30m" (a negative value means
+    forever). If it's None, Ollama's default applies.
+
+    Model calls are made through the scheduler (by default, a RequestScheduler without rate
+    limits), which retries them if Ollama is busy or gives a malformed response.
     """
-    def __init__(self, model: str, cache: Optional[Cache] = None, client: Optional[ollama.Client] = None) -> None:
+    supports_summarize = True
+    supports_score = True
+
+    def __init__(self, model: str, cache: Optional[Cache] = None, client: Optional["ollama.Client"] = None, infer: bool = True, cycle_policy: CyclePolicy = CyclePolicy.ASK, keep_alive: Optional[float | str] = None, max_num_ctx: Optional[int] = None, scheduler: Optional[RequestScheduler] = None) -> None:
         self.cache = cache if cache is not None else Cache(":memory:")
         self.model = model
-        self.client = ollama.Client() if client is None else client
+        if client is None:
+            import ollama
+            client = ollama.Client()
+        self.client = client
+        self.scheduler = scheduler if scheduler is not None else RequestScheduler()
+        self.prompt_order = PromptOrder()
+        self.records = ComparisonRecords(self.cache, ModelProvider.OLLAMA, model, _ollama_legacy_cache_key, infer, cycle_policy)
+        self.keep_alive = keep_alive
+        self.context = OllamaContext(max_num_ctx)
+        self._context_capped = max_num_ctx is not None
+        self._modelinfo: Optional[dict] = None
+
+    def _model_info(self) -> dict:
+        if self._modelinfo is None:
+            self._modelinfo = self.client.show(self.model).modelinfo or {}
+        return self._modelinfo
+
+    def _cap_context(self) -> None:
+        if not self._context_capped:
+            self.context.max_num_ctx = ollama_max_num_ctx(self._model_info(), available_memory())
+            self._context_capped = True
+
+    def _chat(self, messages: list[dict], options: dict):
+        with stage("model"):
+            resp = self.client.chat(model=self.model, messages=messages, options=options, keep_alive=self.keep_alive)
+        self.context.record(resp)
+        return resp
+
+    def prefetch(self, criteria: str, pairs: list[tuple[Document, Document]]) -> None:
+        self.cache.preload(self.records.key(criteria, doc1, doc2).entry_key() for doc1, doc2 in pairs)
+
+    def schedule(self, criteria: str, pairs: list[tuple[Document, Document]]) -> list[int]:
+        return _ollama_schedule(self.context, criteria, pairs)
+
+    def warm_up(self, prompt_tokens: int) -> None:
+        """Loads the model with the num_ctx that prompts of up to prompt_tokens tokens need."""
+        self._cap_context()
+        self._chat([], {"num_ctx": self.context.choose(prompt_tokens)})
+
+    def summary(self) -> Optional[str]:
+        return self.context.summary()
 
     def _choose_better(self, criteria: str, doc1: Document, doc2: Document) -> Document:
-        user_prompt = pairwise_user_prompt(criteria, doc1, doc2)
+        key, choice = self.records.lookup(criteria, doc1, doc2)
+        if choice is None:
+            first, second = self.prompt_order.arrange(doc1, doc2)
+            self._cap_context()
+            def ask(swap: bool) -> Document:
+                a, b = (second, first) if swap else (first, second)
+                with stage("prompt"):
+                    messages, options = _ollama_request(criteria, a, b, self.context)
+                resp = self._chat(messages, options)
+                _annotate_ollama_call(messages, options, resp)
+                return extract_pairwise_response(a, b, resp.message.content)
+            choice = self.scheduler.call(ask, _prompt_tokens(PAIRWISE_SYSTEM_PROMPT, criteria, [doc1, doc2]))
+            self.records.record(key, doc1, doc2, choice)
+        return choice
+
+    def _choose_best(self, criteria: str, docs: list[Document]) -> Document:
+        if len(docs) <= 2:
+            return super()._choose_best(criteria, docs)
+        key, choice = self.records.lookup_best(criteria, docs)
+        if choice is None:
+            self._cap_context()
+            def ask(swap: bool) -> Document:
+                order = docs[::-1] if swap else docs
+                with stage("prompt"):
+                    messages, options = _ollama_listwise_request(criteria, order, self.context)
+                resp = self._chat(messages, options)
+                _annotate_ollama_call(messages, options, resp)
+                return extract_listwise_response(order, resp.message.content)
+            choice = self.scheduler.call(ask, _prompt_tokens(LISTWISE_SYSTEM_PROMPT, criteria, docs))
+            self.records.record_best(key, choice)
+        return choice
+
+    def summarize(self, criteria: str, text: str, max_tokens: int) -> str:
         messages = [
-            {"role": "system", "content": PAIRWISE_SYSTEM_PROMPT},
-            {"role": "user", "content": user_prompt}
+            {"role": "system", "content": SUMMARIZE_SYSTEM_PROMPT},
+            {"role": "user", "content": summarize_user_prompt(criteria, text, max_tokens)},
         ]
+        self._cap_context()
+        options = {"num_predict": max_tokens, "num_ctx": self.context.choose(_ollama_prompt_tokens(messages) + max_tokens), "temperature": 0}
+        self.records.charge_other(_ollama_prompt_tokens(messages))
+        return self.scheduler.call(lambda swap: self._chat(messages, options).message.content, _ollama_prompt_tokens(messages))
 
-        cache_key = sha256(json.dumps({"provider": "ollama", "model": self.model, "messages": messages}).encode()).hexdigest()
-        content = self.cache.fetch(cache_key)
-        if content is None:
-            # Initial testing suggested that whatever Ollama does for prompts that exceed the default context length
-            # (I think it trims the beginning?) leads to poor results. So I try to make the context length long enough.
-            # TODO Currently I'm using a rough heuristic to make sure the context length is long enough
-            #      to hold the full prompt.
-            #      It would be nice to calculate this more exactly; see https://github.com/ollama/ollama/issues/3582
-            #      Ideally I'd also avoid setting it higher than the machine's memory can handle, and do something else
-            #      (error out? partially replace the documents with summaries? some other technique?) in that case.
-            options = {
-                "num_predict": 1,
-                "num_ctx": len(str(messages)) // 2,
-                "temperature": 0,
-            }
-            resp = self.client.chat(model=self.model, messages=messages, options=options)
-            content = resp.message.content
-            self.cache.put(cache_key, content)
-        return extract_pairwise_response(doc1, doc2, content)
+    def score(self, criteria: str, doc: Document) -> int:
+        messages = [
+            {"role": "system", "content": POINTWISE_SYSTEM_PROMPT},
+            {"role": "user", "content": pointwise_user_prompt(criteria, doc)},
+        ]
+        self._cap_context()
+        options = {"num_predict": 2, "num_ctx": self.context.choose(_ollama_prompt_tokens(messages)), "temperature": 0}
+        self.records.charge_other(_ollama_prompt_tokens(messages))
+        return self.scheduler.call(lambda swap: extract_pointwise_response(doc, self._chat(messages, options).message.content), _ollama_prompt_tokens(messages))
+
+    def context_tokens(self) -> Optional[int]:
+        """Returns the model's context length as reported by Ollama, or 8192 if it isn't reported."""
+        for name, value in self._model_info().items():
+            if name.endswith(".context_length"):
+                return value
+        return 8192
 
 
 class AnthropicRanker(Ranker):
     """
     A Ranker that invokes the Anthropic API.
 
-    Responses are cached using the model name and a hash of the prompt.
+    Results are cached using a ComparisonKey, so a cache hit doesn't require reading the
+    documents or building the prompt. See ComparisonRecords regarding infer and cycle_policy.
+
+    Requests are made through the scheduler (by default, a RequestScheduler without rate
+    limits), which retries them if they're throttled or get a malformed response. If no
+    client is given, the one created doesn't retry requests itself, so that the scheduler
+    sees every throttled request and can adapt to it.
     """
-    def __init__(self, model: str, cache: Cache, client: Optional[Anthropic] = None) -> None:
+    supports_summarize = True
+    supports_score = True
+
+    def __init__(self, model: str, cache: Cache, client: Optional["Anthropic"] = None, infer: bool = True, cycle_policy: CyclePolicy = CyclePolicy.ASK, scheduler: Optional[RequestScheduler] = None) -> None:
         self.cache = cache if cache is not None else Cache(":memory:")
         self.model = model
-        self.client = Anthropic() if client is None else client
+        if client is None:
+            from anthropic import Anthropic
+            client = Anthropic(max_retries=0)
+        self.client = client
+        self.scheduler = scheduler if scheduler is not None else RequestScheduler()
+        self.prompt_order = PromptOrder()
+        self.records = ComparisonRecords(self.cache, ModelProvider.ANTHROPIC, model, _anthropic_legacy_cache_key, infer, cycle_policy)
+
+    def prefetch(self, criteria: str, pairs: list[tuple[Document, Document]]) -> None:
+        self.cache.preload(self.records.key(criteria, doc1, doc2).entry_key() for doc1, doc2 in pairs)
+
     
     def _choose_better(self, criteria: str, doc1: Document, doc2: Document) -> Document:
-        user_prompt = pairwise_user_prompt(criteria, doc1, doc2)
-        cache_key = sha256(json.dumps({"provider": "anthropic", "model": self.model, "system_prompt": PAIRWISE_SYSTEM_PROMPT, "user_prompt": user_prompt}).encode()).hexdigest()
-        content = self.cache.fetch(cache_key)
-        if content is None:
-            resp = self.client.messages.create(
-                model=self.model,
-                max_tokens=10, # I tried 1, but for some reason that results in an empty content array in the response,
-                system=PAIRWISE_SYSTEM_PROMPT,
-                messages=[{"role": "user", "content": user_prompt}]
+        key, choice = self.records.lookup(criteria, doc1, doc2)
+        if choice is None:
+            first, second = self.prompt_order.arrange(doc1, doc2)
+            def ask(swap: bool) -> Document:
+                a, b = (second, first) if swap else (first, second)
+                with stage("prompt"):
+                    params = _anthropic_params(self.model, criteria, a, b)
+                with stage("model"):
+                    resp = self.client.messages.create(**params)
+                _annotate_anthropic_call(params, resp)
+                return extract_pairwise_response(a, b, resp.content[0].text)
+            choice = self.scheduler.call(ask, _prompt_tokens(PAIRWISE_SYSTEM_PROMPT, criteria, [doc1, doc2]))
+            self.records.record(key, doc1, doc2, choice)
+        return choice
+
+    def _choose_best(self, criteria: str, docs: list[Document]) -> Document:
+        if len(docs) <= 2:
+            return super()._choose_best(criteria, docs)
+        key, choice = self.records.lookup_best(criteria, docs)
+        if choice is None:
+            def ask(swap: bool) -> Document:
+                order = docs[::-1] if swap else docs
+                with stage("prompt"):
+                    params = _anthropic_listwise_params(self.model, criteria, order)
+                with stage("model"):
+                    resp = self.client.messages.create(**params)
+                _annotate_anthropic_call(params, resp)
+                return extract_listwise_response(order, resp.content[0].text)
+            choice = self.scheduler.call(ask, _prompt_tokens(LISTWISE_SYSTEM_PROMPT, criteria, docs))
+            self.records.record_best(key, choice)
+        return choice
+
+    def summarize(self, criteria: str, text: str, max_tokens: int) -> str:
+        prompt = summarize_user_prompt(criteria, text, max_tokens)
+        def ask(swap: bool) -> str:
+            with stage("model"):
+                resp = self.client.messages.create(
+                    model=self.model,
+                    max_tokens=max_tokens,
+                    system=SUMMARIZE_SYSTEM_PROMPT,
+                    messages=[{"role": "user", "content": prompt}],
+                )
+            return resp.content[0].text
+        self.records.charge_other(estimate_tokens(SUMMARIZE_SYSTEM_PROMPT + prompt))
+        return self.scheduler.call(ask, estimate_tokens(SUMMARIZE_SYSTEM_PROMPT + prompt))
+
+    def score(self, criteria: str, doc: Document) -> int:
+        prompt = pointwise_user_prompt(criteria, doc)
+        def ask(swap: bool) -> int:
+            with stage("model"):
+                resp = self.client.messages.create(
+                    model=self.model,
+                    max_tokens=2,
+                    system=POINTWISE_SYSTEM_PROMPT,
+                    messages=[{"role": "user", "content": prompt}],
+                )
+            return extract_pointwise_response(doc, resp.content[0].text)
+        self.records.charge_other(estimate_tokens(POINTWISE_SYSTEM_PROMPT + prompt))
+        return self.scheduler.call(ask, estimate_tokens(POINTWISE_SYSTEM_PROMPT + prompt))
+
+    def context_tokens(self) -> Optional[int]:
+        return 200000
+
+
+class AnthropicBatchRanker(AnthropicRanker):
+    """
+    An AnthropicRanker which, when prefetch() is called, submits all the uncached comparisons
+    as a single Message Batch and waits for it to finish. This is slow, but cheaper than
+    sending the requests individually.
+
+    The ID of each submitted batch is saved in the cache, so if the process is interrupted
+    while waiting, rerunning the same job resumes waiting on the same batch rather than
+    submitting a new one. Any comparisons that the batch fails to answer are retried
+    individually when choose_better() is called; each is only charged to the budget once.
+
+    Fewer than min_batch_size uncached comparisons aren't worth waiting at least a
+    poll_interval for, so they're left to choose_better() to request directly. In particular,
+    after the first place is found, a tournament compares one pair at a time.
+    """
+    def __init__(self, model: str, cache: Cache, client: Optional["Anthropic"] = None, poll_interval: float = 60, infer: bool = True, cycle_policy: CyclePolicy = CyclePolicy.ASK, scheduler: Optional[RequestScheduler] = None, min_batch_size: int = 2) -> None:
+        super().__init__(model, cache, client, infer, cycle_policy, scheduler)
+        self.poll_interval = poll_interval
+        self.min_batch_size = min_batch_size
+
+    def prefetch(self, criteria: str, pairs: list[tuple[Document, Document]]) -> None:
+        super().prefetch(criteria, pairs)
+        requests = {}
+        for doc1, doc2 in pairs:
+            doc1, doc2 = canonical_order(doc1, doc2)
+            key, choice = self.records.lookup(criteria, doc1, doc2, count=False)
+            if choice is None:
+                requests[key.entry_key()] = (key, doc1, doc2)
+        if len(requests) < self.min_batch_size:
+            return
+        batch_key = "anthropic-batch:" + sha256(json.dumps(sorted(requests)).encode()).hexdigest()
+        batch_id = self.cache.fetch(batch_key)
+        if batch_id is None:
+            for key, doc1, doc2 in requests.values():
+                self.records.prepay(key, criteria, doc1, doc2)
+            batch = self.client.messages.batches.create(
+                requests=[
+                    {"custom_id": entry_key, "params": _anthropic_params(self.model, criteria, doc1, doc2)}
+                    for entry_key, (_, doc1, doc2) in requests.items()
+                ]
             )
-            content = resp.content[0].text
-            self.cache.put(cache_key, content)
-        return extract_pairwise_response(doc1, doc2, content)
+            batch_id = batch.id
+            self.cache.put(batch_key, batch_id)
+            self.cache.flush()
+        while self.client.messages.batches.retrieve(batch_id).processing_status != "ended":
+            time.sleep(self.poll_interval)
+        for entry in self.client.messages.batches.results(batch_id):
+            if entry.custom_id in requests and entry.result.type == "succeeded":
+                key, doc1, doc2 = requests[entry.custom_id]
+                try:
+                    choice = extract_pairwise_response(doc1, doc2, entry.result.message.content[0].text)
+                except InvalidLlmResponseError:
+                    continue
+                self.records.record(key, doc1, doc2, choice)
+        self.cache.flush()
 
 
-def build_ranker(provider: Optional[ModelProvider] = None, model: Optional[str] = None, cache: Optional[Cache] = None) -> Ranker:
+class AsyncPairwiseWrapper:
+    """
+    The asyncio counterpart of PairwiseWrapper. Since comparison operators cannot be awaited,
+    comparisons are done with the async_lt() method instead.
+    Instances are created by AsyncRanker.wrap_for_pairwise_comparison().
+    """
+    __slots__ = ("wrapped", "ranker", "criteria")
+
+    def __init__(self, wrapped: Document, ranker: "AsyncRanker", criteria: str) -> None:
+        self.wrapped = wrapped
+        self.ranker = ranker
+        self.criteria = criteria
+
+    def __eq__(self, other: Self) -> bool:
+        return self.wrapped == other.wrapped
+
+    async def async_lt(self, other: Self) -> bool:
+        """Equivalent to self < other."""
+        choice = await self.ranker.choose_better(self.criteria, self.wrapped, other.wrapped)
+        if choice is self.wrapped:
+            return False
+        return True
+
+
+class AsyncRanker(ABC):
+    """
+    Base class for document rankers that use asyncio.
+
+    Async rankers build the same prompts and cache keys as their synchronous counterparts,
+    so results cached by one are reused by the other. Since a lookup that misses the cache's
+    memory queries the database (twice, if the legacy key is tried), and recording a result
+    may commit buffered writes, subclasses should use lookup() and record() rather than
+    calling records directly, so that the event loop isn't blocked.
+    """
+    records: Optional[ComparisonRecords] = None
+
+    async def lookup(self, criteria: str, doc1: Document, doc2: Document) -> tuple[ComparisonKey, Optional[Document]]:
+        """Calls records.lookup() in a worker thread."""
+        return await asyncio.to_thread(self.records.lookup, criteria, doc1, doc2)
+
+    async def record(self, key: ComparisonKey, doc1: Document, doc2: Document, choice: Document) -> None:
+        """Calls records.record() in a worker thread."""
+        await asyncio.to_thread(self.records.record, key, doc1, doc2, choice)
+
+    async def choose_better(self, criteria: str, doc1: Document, doc2: Document) -> Document:
+        """
+        Given some criteria and a pair of documents, returns the document which seems better
+        according to the given criteria.
+        """
+        annotate(doc1=str(doc1), doc2=str(doc2))
+        # This ensures we'll use the same cache entry regardless of the order of arguments.
+        return await self._choose_better(criteria, *canonical_order(doc1, doc2))
+
+    @abstractmethod
+    async def _choose_better(self, criteria: str, doc1: Document, doc2: Document) -> Document:
+        """
+        Called by choose_better().
+        Subclasses should implement logic for determining the better document in this method.
+        """
+        ...
+
+    def wrap_for_pairwise_comparison(self, criteria: str, docs: list[Document]) -> list[AsyncPairwiseWrapper]:
+        """
+        Wraps each document so that async_lt() is resolved by calling .choose_better() on this
+        AsyncRanker instance with the given criteria.
+        """
+        return [AsyncPairwiseWrapper(doc, self, criteria) for doc in docs]
+
+    def unwrap(self, items: list[AsyncPairwiseWrapper]) -> list[Document]:
+        """Call this on the result of wrap_for_pairwise_comparison() to get back the originals."""
+        return [item.wrapped for item in items]
+
+
+class AsyncFakeRanker(AsyncRanker):
+    """An AsyncRanker for testing purposes. It compares document text lexicographically."""
+    async def _choose_better(self, criteria: str, doc1: Document, doc2: Document) -> Document:
+        if doc1.read_text() < doc2.read_text():
+            return doc1
+        return doc2
+
+
+class AsyncOllamaRanker(AsyncRanker):
+    """
+    An AsyncRanker that invokes Ollama. See OllamaRanker; model calls are made with the
+    scheduler's async_call().
+    """
+    def __init__(self, model: str, cache: Optional[Cache] = None, client: Optional["ollama.AsyncClient"] = None, infer: bool = True, cycle_policy: CyclePolicy = CyclePolicy.ASK, keep_alive: Optional[float | str] = None, max_num_ctx: Optional[int] = None, scheduler: Optional[RequestScheduler] = None) -> None:
+        self.cache = cache if cache is not None else Cache(":memory:")
+        self.model = model
+        if client is None:
+            import ollama
+            client = ollama.AsyncClient()
+        self.client = client
+        self.scheduler = scheduler if scheduler is not None else RequestScheduler()
+        self.prompt_order = PromptOrder()
+        self.records = ComparisonRecords(self.cache, ModelProvider.OLLAMA, model, _ollama_legacy_cache_key, infer, cycle_policy)
+        self.keep_alive = keep_alive
+        self.context = OllamaContext(max_num_ctx)
+        self._context_capped = max_num_ctx is not None
+
+    async def _cap_context(self) -> None:
+        if not self._context_capped:
+            info = (await self.client.show(self.model)).modelinfo or {}
+            self.context.max_num_ctx = ollama_max_num_ctx(info, available_memory())
+            self._context_capped = True
+
+    async def _choose_better(self, criteria: str, doc1: Document, doc2: Document) -> Document:
+        key, choice = await self.lookup(criteria, doc1, doc2)
+        if choice is None:
+            first, second = self.prompt_order.arrange(doc1, doc2)
+            await self._cap_context()
+            async def ask(swap: bool) -> Document:
+                a, b = (second, first) if swap else (first, second)
+                with stage("prompt"):
+                    messages, options = _ollama_request(criteria, a, b, self.context)
+                with stage("model"):
+                    resp = await self.client.chat(model=self.model, messages=messages, options=options, keep_alive=self.keep_alive)
+                self.context.record(resp)
+                _annotate_ollama_call(messages, options, resp)
+                return extract_pairwise_response(a, b, resp.message.content)
+            choice = await self.scheduler.async_call(ask, _prompt_tokens(PAIRWISE_SYSTEM_PROMPT, criteria, [doc1, doc2]))
+            await self.record(key, doc1, doc2, choice)
+        return choice
+
+
+class AsyncAnthropicRanker(AsyncRanker):
+    """
+    An AsyncRanker that invokes the Anthropic API. See AnthropicRanker; requests are made
+    with the scheduler's async_call().
+    """
+    def __init__(self, model: str, cache: Optional[Cache] = None, client: Optional["AsyncAnthropic"] = None, infer: bool = True, cycle_policy: CyclePolicy = CyclePolicy.ASK, scheduler: Optional[RequestScheduler] = None) -> None:
+        self.cache = cache if cache is not None else Cache(":memory:")
+        self.model = model
+        if client is None:
+            from anthropic import AsyncAnthropic
+            client = AsyncAnthropic(max_retries=0)
+        self.client = client
+        self.scheduler = scheduler if scheduler is not None else RequestScheduler()
+        self.prompt_order = PromptOrder()
+        self.records = ComparisonRecords(self.cache, ModelProvider.ANTHROPIC, model, _anthropic_legacy_cache_key, infer, cycle_policy)
+
+    async def _choose_better(self, criteria: str, doc1: Document, doc2: Document) -> Document:
+        key, choice = await self.lookup(criteria, doc1, doc2)
+        if choice is None:
+            first, second = self.prompt_order.arrange(doc1, doc2)
+            async def ask(swap: bool) -> Document:
+                a, b = (second, first) if swap else (first, second)
+                with stage("prompt"):
+                    params = _anthropic_params(self.model, criteria, a, b)
+                with stage("model"):
+                    resp = await self.client.messages.create(**params)
+                _annotate_anthropic_call(params, resp)
+                return extract_pairwise_response(a, b, resp.content[0].text)
+            choice = await self.scheduler.async_call(ask, _prompt_tokens(PAIRWISE_SYSTEM_PROMPT, criteria, [doc1, doc2]))
+            await self.record(key, doc1, doc2, choice)
+        return choice
+
+
+def build_ranker(provider: Optional[ModelProvider] = None, model: Optional[str] = None, cache: Optional[Cache] = None, batch: bool = False, infer: bool = True, keep_alive: Optional[float | str] = None, max_num_ctx: Optional[int] = None, scheduler: Optional[RequestScheduler] = None) -> Ranker:
     """
     Create a Ranker using the given model provider, model, and cache, using configuration or
     defaults if they are not provided.
+
+    If batch is True, an AnthropicBatchRanker is created; this is only supported for the
+    anthropic provider. See ComparisonRecords regarding infer, OllamaRanker regarding
+    keep_alive and max_num_ctx (which are ignored by other providers), and RequestScheduler
+    regarding scheduler (which the fake provider ignores).
     """
     provider = default_provider() if provider is None else provider
     model = default_model(provider) if model is None else model
+    if batch and provider != ModelProvider.ANTHROPIC:
+        raise ValueError(f"Batch mode is not supported for provider {provider}")
     if provider == ModelProvider.FAKE:
         return FakeRanker()
     cache = default_cache() if cache is None else cache
     if provider == ModelProvider.OLLAMA:
-        return OllamaRanker(model, cache)
+        return OllamaRanker(model, cache, infer=infer, keep_alive=keep_alive, max_num_ctx=max_num_ctx, scheduler=scheduler)
+    if provider == ModelProvider.ANTHROPIC:
+        if batch:
+            return AnthropicBatchRanker(model, cache, infer=infer, scheduler=scheduler)
+        return AnthropicRanker(model, cache, infer=infer, scheduler=scheduler)
+    raise ValueError(f"Unsupported provider {provider}") # should be unreachable
+
+
+def build_async_ranker(provider: Optional[ModelProvider] = None, model: Optional[str] = None, cache: Optional[Cache] = None, infer: bool = True, keep_alive: Optional[float | str] = None, max_num_ctx: Optional[int] = None, scheduler: Optional[RequestScheduler] = None) -> AsyncRanker:
+    """The asyncio counterpart of build_ranker()."""
+    provider = default_provider() if provider is None else provider
+    model = default_model(provider) if model is None else model
+    if provider == ModelProvider.FAKE:
+        return AsyncFakeRanker()
+    cache = default_cache() if cache is None else cache
+    if provider == ModelProvider.OLLAMA:
+        return AsyncOllamaRanker(model, cache, infer=infer, keep_alive=keep_alive, max_num_ctx=max_num_ctx, scheduler=scheduler)
     if provider == ModelProvider.ANTHROPIC:
-        return AnthropicRanker(model, cache)
+        return AsyncAnthropicRanker(model, cache, infer=infer, scheduler=scheduler)
     raise ValueError(f"Unsupported provider {provider}") # should be unreachable
@@ -0,0 +1,355 @@
+from collections.abc import Awaitable, Callable
+from enum import StrEnum
+from rank_files.trace import increment, stage
+from typing import Optional, TypeVar
+import asyncio
+import math
+import random
+import threading
+import time
+
+
+T = TypeVar("T")
+
+# How much AdaptiveConcurrency lowers its limit when the provider is overloaded, and how much
+# weight each new latency gets in its short- and long-term moving averages.
+DECREASE_FACTOR = 0.5
+SHORT_SMOOTHING = 0.2
+LONG_SMOOTHING = 0.02
+
+
+class InvalidLlmResponseError(Exception):
+    """Raised when an LLM does not follow instructions and its output cannot be understood."""
+    pass
+
+
+class RateLimitedError(Exception):
+    """Raised when a model provider rejects a request because too many requests have been made."""
+    pass
+
+
+class RetryKind(StrEnum):
+    """How a RequestScheduler handles a failed request."""
+    # The provider is rate-limiting or overloaded: wait, and send fewer requests at once.
+    THROTTLED = "throttled"
+    # E.g. a dropped connection: wait and try again.
+    TRANSIENT = "transient"
+    # The response couldn't be understood: ask again, with the documents in the other order.
+    INVALID = "invalid"
+
+
+# Names of the exception classes of the provider SDKs and httpx (which they use) that are
+# worth retrying. They're matched by name so that the SDKs needn't be imported here.
+_TIMEOUT_ERRORS = {"TimeoutException", "APITimeoutError"}
+_CONNECTION_ERRORS = {"NetworkError", "RemoteProtocolError", "APIConnectionError"}
+
+
+def classify_error(exc: Exception) -> Optional[RetryKind]:
+    """
+    Decides whether a request that raised exc should be retried, and how; None means it
+    shouldn't be. HTTP 429 (too many requests), 503 (Ollama's queue is full) and 529
+    (Anthropic is overloaded) and timeouts count as throttling, as does RateLimitedError;
+    other 5xx statuses and connection errors are transient.
+    """
+    if isinstance(exc, InvalidLlmResponseError):
+        return RetryKind.INVALID
+    if isinstance(exc, RateLimitedError):
+        return RetryKind.THROTTLED
+    names = {cls.__name__ for cls in type(exc).__mro__}
+    status = getattr(exc, "status_code", None)
+    if status in (429, 503, 529) or isinstance(exc, TimeoutError) or names & _TIMEOUT_ERRORS:
+        return RetryKind.THROTTLED
+    if (isinstance(status, int) and status >= 500) or isinstance(exc, ConnectionError) or names & _CONNECTION_ERRORS:
+        return RetryKind.TRANSIENT
+    return None
+
+
+def retry_after(exc: Exception) -> Optional[float]:
+    """Returns the seconds to wait given by the Retry-After header of the response that raised exc, if any."""
+    headers = getattr(getattr(exc, "response", None), "headers", None)
+    try:
+        return max(0.0, float(headers.get("retry-after")))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """
+    Limits the rate of something (e.g. requests, or input tokens) to per_minute on average,
+    allowing bursts of up to capacity (by default, a minute's worth).
+
+    acquire() takes an amount from the bucket, which refills continuously, and waits if it's
+    overdrawn until it's refilled. Each caller takes its amount before waiting, so callers
+    are served in the order they arrived. An amount larger than the capacity is treated as
+    the capacity, so that it can be acquired at all.
+    """
+    def __init__(self, per_minute: float, capacity: Optional[float] = None, clock: Callable[[], float] = time.monotonic, sleep: Callable[[float], None] = time.sleep) -> None:
+        self.rate = per_minute / 60
+        self.capacity = per_minute if capacity is None else capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.level = self.capacity
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount: float) -> float:
+        """Takes the amount from the bucket and returns how many seconds to wait before using it."""
+        with self._lock:
+            now = self.clock()
+            self.level = min(self.capacity, self.level + (now - self._updated) * self.rate)
+            self._updated = now
+            self.level -= min(amount, self.capacity)
+            return 0.0 if self.level >= 0 else -self.level / self.rate
+
+    def acquire(self, amount: float = 1) -> float:
+        """Takes the amount from the bucket, waiting until it's available, and returns the seconds waited."""
+        wait = self.reserve(amount)
+        if wait > 0:
+            self.sleep(wait)
+        return wait
+
+
+class AdaptiveConcurrency:
+    """
+    Limits how many requests are in flight at once, adjusting the limit by AIMD (additive
+    increase, multiplicative decrease) as TCP does. The limit is multiplied by DECREASE_FACTOR
+    when a request is throttled, or when the short-term moving average of the latency (per
+    input token, so that long prompts don't count against it) rises above latency_tolerance
+    times the long-term one, which is a sign that requests have started queueing at the
+    backend. It grows by one each time a whole limit's worth of requests succeeds without
+    either, up to max_limit.
+
+    The limit starts at max_limit, or with no limit if that's None (in which case the number
+    of threads making requests is the limit until the first decrease). The requests already
+    in flight when the limit is lowered were sent under the old limit, so it isn't lowered
+    again until they've finished.
+
+    Coroutines use async_acquire() instead of acquire(), which waits without blocking the
+    event loop, like an asyncio.Semaphore whose size is the limit.
+
+    Statistics: total_decreases.
+    """
+    def __init__(self, max_limit: Optional[int] = None, latency_tolerance: float = 2.0) -> None:
+        self.max_limit = max_limit
+        self.latency_tolerance = latency_tolerance
+        self.limit: float = math.inf if max_limit is None else max_limit
+        self.in_flight = 0
+        self.total_decreases = 0
+        self._successes = 0
+        self._hold = 0
+        self._short_latency: Optional[float] = None
+        self._long_latency: Optional[float] = None
+        self._changed = threading.Condition()
+        self._async_waiters: list[tuple[asyncio.AbstractEventLoop, asyncio.Future]] = []
+
+    def acquire(self) -> None:
+        """Waits until fewer than limit requests are in flight, and counts another one."""
+        with self._changed:
+            while self.in_flight >= self.limit:
+                self._changed.wait()
+            self.in_flight += 1
+
+    async def async_acquire(self) -> None:
+        """Equivalent to acquire(), for coroutines."""
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._changed:
+                if self.in_flight < self.limit:
+                    self.in_flight += 1
+                    return
+                waiter = loop.create_future()
+                self._async_waiters.append((loop, waiter))
+            await waiter
+
+    def release(self, latency: Optional[float] = None, throttled: bool = False) -> None:
+        """
+        Records that a request finished: with latency (in seconds per input token, or seconds)
+        if it succeeded, or with throttled set if it was throttled.
+        """
+        with self._changed:
+            in_flight = self.in_flight
+            self.in_flight -= 1
+            self._hold = max(0, self._hold - 1)
+            congested = throttled
+            if latency is not None:
+                if self._short_latency is None or self._long_latency is None:
+                    self._short_latency = self._long_latency = latency
+                else:
+                    self._short_latency += SHORT_SMOOTHING * (latency - self._short_latency)
+                    self._long_latency += LONG_SMOOTHING * (latency - self._long_latency)
+                congested = congested or self._short_latency > self.latency_tolerance * self._long_latency
+            if congested:
+                if self._hold == 0 and min(self.limit, in_flight) > 1:
+                    self.limit = max(1, math.floor(min(self.limit, in_flight) * DECREASE_FACTOR))
+                    self.total_decreases += 1
+                    self._hold = self.in_flight
+                    self._short_latency = self._long_latency
+                self._successes = 0
+            elif self.limit != math.inf:
+                self._successes += 1
+                if self._successes >= self.limit and (self.max_limit is None or self.limit < self.max_limit):
+                    self.limit += 1
+                    self._successes = 0
+            self._changed.notify_all()
+            waiters, self._async_waiters = self._async_waiters, []
+        for loop, waiter in waiters:
+            loop.call_soon_threadsafe(_wake, waiter)
+
+
+def _wake(waiter: asyncio.Future) -> None:
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+class RequestScheduler:
+    """
+    Sits between a Ranker and its model provider's client, so that a busy or flaky provider
+    slows a job down rather than stopping it.
+
+    Each request is made by call(), which first waits for:
+    - a request from the requests_per_minute TokenBucket and its estimated input tokens from
+      the tokens_per_minute one, if those limits are set
+    - a slot from an AdaptiveConcurrency with max_concurrency (None meaning no limit until
+      the provider is overloaded)
+
+    If the request fails, classify (see classify_error()) decides what happens. Throttled and
+    transient failures are retried, up to max_attempts attempts in all, after the delay given
+    by the provider's Retry-After header, or else after a random delay of up to base_delay
+    doubled for each failure so far (at most max_delay), so that requests which failed
+    together don't all retry together. Malformed responses are asked again, with the
+    documents swapped, up to max_invalid_attempts attempts in all. Other errors are raised.
+
+    async_call() does the same for requests made by coroutines, sleeping with async_sleep, so
+    that sync and async rankers can share a scheduler and its limits.
+
+    Statistics: total_requests, total_retries, total_throttled, total_invalid and
+    total_wait_seconds (spent waiting for the rate limits or to retry).
+    """
+    def __init__(self, requests_per_minute: Optional[float] = None, tokens_per_minute: Optional[float] = None, max_concurrency: Optional[int] = None, max_attempts: int = 5, max_invalid_attempts: int = 3, base_delay: float = 1.0, max_delay: float = 60.0, classify: Callable[[Exception], Optional[RetryKind]] = classify_error, seed: Optional[int] = None, clock: Callable[[], float] = time.monotonic, sleep: Callable[[float], None] = time.sleep, async_sleep: Callable[[float], Awaitable[None]] = asyncio.sleep) -> None:
+        self.requests = None if requests_per_minute is None else TokenBucket(requests_per_minute, clock=clock, sleep=sleep)
+        self.tokens = None if tokens_per_minute is None else TokenBucket(tokens_per_minute, clock=clock, sleep=sleep)
+        self.concurrency = AdaptiveConcurrency(max_concurrency)
+        self.max_attempts = max_attempts
+        self.max_invalid_attempts = max_invalid_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.classify = classify
+        self.clock = clock
+        self.sleep = sleep
+        self.async_sleep = async_sleep
+        self.total_requests = 0
+        self.total_retries = 0
+        self.total_throttled = 0
+        self.total_invalid = 0
+        self.total_wait_seconds = 0.0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _wait(self, seconds: float, stage_name: str) -> None:
+        if seconds <= 0:
+            return
+        with self._lock:
+            self.total_wait_seconds += seconds
+        with stage(stage_name):
+            self.sleep(seconds)
+
+    async def _async_wait(self, seconds: float, stage_name: str) -> None:
+        if seconds <= 0:
+            return
+        with self._lock:
+            self.total_wait_seconds += seconds
+        with stage(stage_name):
+            await self.async_sleep(seconds)
+
+    def _reserve(self, tokens: int) -> float:
+        """Takes the request and its tokens from the buckets, and returns how long the longer of them requires waiting."""
+        waits = [bucket.reserve(amount) for bucket, amount in ((self.requests, 1), (self.tokens, tokens)) if bucket is not None]
+        return max(waits, default=0.0)
+
+    def backoff(self, failures: int) -> float:
+        """Returns a random delay before retrying a request that has failed this many times in a row."""
+        with self._lock:
+            return self._random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (failures - 1)))
+
+    def call(self, request: Callable[[bool], T], tokens: int = 0) -> T:
+        """
+        Makes a request, retrying it as described above, and returns its result. request is
+        called with swap, which is True when the documents should be presented in the other
+        order than the first time; requests not involving a pair of documents can ignore it.
+        tokens is the request's estimated number of input tokens.
+        """
+        failures = 0
+        invalid = 0
+        swap = False
+        while True:
+            self._wait(self._reserve(tokens), "rate_limit")
+            self.concurrency.acquire()
+            start = self.clock()
+            try:
+                with self._lock:
+                    self.total_requests += 1
+                result = request(swap)
+            except Exception as exc:
+                failures, invalid, delay = self._failed(exc, failures, invalid)
+                if delay is None:
+                    swap = not swap
+                else:
+                    self._wait(delay, "backoff")
+                continue
+            self.concurrency.release(latency=(self.clock() - start) / max(1, tokens))
+            return result
+
+    async def async_call(self, request: Callable[[bool], Awaitable[T]], tokens: int = 0) -> T:
+        """Equivalent to call(), for a request that's a coroutine function."""
+        failures = 0
+        invalid = 0
+        swap = False
+        while True:
+            await self._async_wait(self._reserve(tokens), "rate_limit")
+            await self.concurrency.async_acquire()
+            start = self.clock()
+            try:
+                with self._lock:
+                    self.total_requests += 1
+                result = await request(swap)
+            except Exception as exc:
+                failures, invalid, delay = self._failed(exc, failures, invalid)
+                if delay is None:
+                    swap = not swap
+                else:
+                    await self._async_wait(delay, "backoff")
+                continue
+            self.concurrency.release(latency=(self.clock() - start) / max(1, tokens))
+            return result
+
+    def _failed(self, exc: Exception, failures: int, invalid: int) -> tuple[int, int, Optional[float]]:
+        """
+        Called by call() and async_call() while handling exc, raised by an attempt at a request
+        after the given numbers of failed and malformed attempts. Re-raises it unless the request
+        should be retried; otherwise returns the new numbers and the delay before retrying, which
+        is None if the response was malformed (and should be asked again with a swap at once).
+        """
+        kind = self.classify(exc)
+        self.concurrency.release(throttled=kind == RetryKind.THROTTLED)
+        if kind == RetryKind.INVALID:
+            invalid += 1
+            with self._lock:
+                self.total_invalid += 1
+            if invalid >= self.max_invalid_attempts:
+                raise
+            increment("invalid_responses")
+            return failures, invalid, None
+        failures += 1
+        if kind is None or failures >= self.max_attempts:
+            raise
+        with self._lock:
+            self.total_retries += 1
+            self.total_throttled += kind == RetryKind.THROTTLED
+        increment("retries")
+        delay = retry_after(exc)
+        return failures, invalid, self.backoff(failures) if delay is None else delay
+
+    def summary(self) -> str:
+        """Returns a human-readable description of the statistics."""
+        limit = "none" if self.concurrency.limit == math.inf else str(self.concurrency.limit)
+        return f"Requests: {self.total_requests}. Retried: {self.total_retries} ({self.total_throttled} throttled). Malformed responses: {self.total_invalid}. Concurrency limit: {limit} (lowered {self.concurrency.total_decreases} times). Waited: {self.total_wait_seconds:.1f}s."
@@ -0,0 +1,344 @@
+from argparse import ArgumentParser, Namespace
+from enum import StrEnum
+from http.server import BaseHTTPRequestHandler
+from rank_files.cache import Cache, default_cache
+from rank_files.cli import MAX_TEXT_MEMORY, create_ranker, run
+from rank_files.client import ServerClient, ServerError, cache_id, default_socket_path
+from rank_files.document import DigestMemo, TextBudget
+from rank_files.ranker import ModelProvider, Ranker
+from socketserver import ThreadingMixIn, UnixStreamServer
+from typing import Optional, Self
+from urllib.parse import parse_qs, urlsplit
+import json
+import os
+import queue
+import signal
+import sys
+import threading
+import traceback
+import uuid
+
+
+class JobCancelledError(Exception):
+    """Raised within a job that was cancelled, at its next comparison."""
+    pass
+
+
+class JobStatus(StrEnum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+
+class ServerJob:
+    """
+    A job submitted to the server. What it prints, and its progress, are recorded as a list of
+    events, each of which is one of:
+    - {"out": text} or {"err": text}: text printed to stdout or stderr
+    - {"total": n}: the estimated number of comparisons, once it's known
+    - {"progress": n}: the number of comparisons done so far
+    """
+    def __init__(self, job_id: str, args: Namespace, provider: str, model: str) -> None:
+        self.id = job_id
+        self.args = args
+        self.provider = provider
+        self.model = model
+        self.status = JobStatus.QUEUED
+        self.error: Optional[str] = None
+        self.events: list[dict] = []
+        self.cancel_requested = threading.Event()
+        self.changed = threading.Condition()
+
+    def emit(self, event: dict) -> None:
+        with self.changed:
+            self.events.append(event)
+            self.changed.notify_all()
+
+    def set_status(self, status: JobStatus, error: Optional[str] = None) -> None:
+        with self.changed:
+            self.status = status
+            self.error = error
+            self.changed.notify_all()
+
+    def finished(self) -> bool:
+        return self.status in (JobStatus.DONE, JobStatus.FAILED, JobStatus.CANCELLED)
+
+    def wait(self, since: int, timeout: float) -> tuple[list[dict], bool]:
+        """
+        Returns the events from the one numbered since on, waiting up to timeout seconds if
+        there are none yet, and whether the job had finished (so no more events will come).
+        """
+        with self.changed:
+            if len(self.events) <= since and not self.finished():
+                self.changed.wait(timeout)
+            return self.events[since:], self.finished()
+
+    def to_json(self, since: int = 0) -> dict:
+        with self.changed:
+            return {"id": self.id, "status": self.status, "error": self.error, "events": self.events[since:], "next": len(self.events)}
+
+
+class JobOutput:
+    """A file-like object which records what's written to it as events of the job."""
+    def __init__(self, job: ServerJob, stream: str) -> None:
+        self.job = job
+        self.stream = stream
+
+    def write(self, text: str) -> int:
+        if text:
+            self.job.emit({self.stream: text})
+        return len(text)
+
+    def flush(self) -> None:
+        pass
+
+
+class JobProgress:
+    """
+    Used by run() in place of a progress bar: records the job's progress as events, and stops
+    the job by raising JobCancelledError if it has been cancelled.
+    """
+    def __init__(self, job: ServerJob, total: int) -> None:
+        self.job = job
+        self.n = 0
+        job.emit({"total": total})
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, type, value, traceback) -> None:
+        pass
+
+    def update(self, n: int = 1) -> None:
+        if self.job.cancel_requested.is_set():
+            raise JobCancelledError()
+        self.n += n
+        self.job.emit({"progress": self.n})
+
+
+class RankingServer:
+    """
+    The daemon started by 'rank-files serve', which keeps the cache, rankers (with their model
+    clients and connection pools) and file digests in memory between jobs, so that small jobs
+    start quickly.
+
+    Jobs submitted with submit() are run one at a time, in the order they were submitted.
+    Rankers are created the first time they're needed and then reused (so jobs with the same
+    settings share their RequestScheduler's rate limits), and so are the digests of files
+    that haven't changed. The most recent max_finished_jobs finished jobs are kept so
+    that clients can still poll them.
+    """
+    def __init__(self, cache: Cache, max_finished_jobs: int = 100) -> None:
+        self.cache = cache
+        self.max_finished_jobs = max_finished_jobs
+        self.budget = TextBudget(MAX_TEXT_MEMORY)
+        self.digests = DigestMemo()
+        self.rankers: dict[tuple, Ranker] = {}
+        self.jobs: dict[str, ServerJob] = {}
+        self.lock = threading.Lock()
+        self._queue: queue.Queue[Optional[ServerJob]] = queue.Queue()
+        self._worker = threading.Thread(target=self._work, daemon=True)
+        self._worker.start()
+
+    def ranker_for(self, job: ServerJob) -> Ranker:
+        args = job.args
+        key = (job.provider, job.model, args.batch, args.distributed, args.no_inference, args.keep_alive, args.max_num_ctx, args.concurrency, args.requests_per_minute, args.tokens_per_minute, args.max_attempts)
+        if key not in self.rankers:
+            self.rankers[key] = create_ranker(args, self.cache, job.provider, job.model)
+        return self.rankers[key]
+
+    def submit(self, args: Namespace, provider: str, model: str) -> ServerJob:
+        job = ServerJob(uuid.uuid4().hex, args, provider, model)
+        with self.lock:
+            self.jobs[job.id] = job
+        self._queue.put(job)
+        return job
+
+    def get(self, job_id: str) -> Optional[ServerJob]:
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def cancel(self, job: ServerJob) -> None:
+        """Cancels the job; if it's running, it stops at its next comparison."""
+        job.cancel_requested.set()
+
+    def count_unfinished(self) -> int:
+        with self.lock:
+            return sum(not job.finished() for job in self.jobs.values())
+
+    def run_job(self, job: ServerJob) -> None:
+        if job.cancel_requested.is_set():
+            job.set_status(JobStatus.CANCELLED)
+            return
+        job.set_status(JobStatus.RUNNING)
+        try:
+            run(job.args, self.cache, self.ranker_for(job), job.provider, job.model, self.budget, JobOutput(job, "out"), JobOutput(job, "err"), self.digests, lambda total: JobProgress(job, total))
+        except JobCancelledError:
+            job.set_status(JobStatus.CANCELLED)
+        except Exception as exc:
+            traceback.print_exc()
+            job.set_status(JobStatus.FAILED, f"{type(exc).__name__}: {exc}")
+        else:
+            job.set_status(JobStatus.DONE)
+        finally:
+            self.cache.flush()
+
+    def _work(self) -> None:
+        while (job := self._queue.get()) is not None:
+            self.run_job(job)
+            with self.lock:
+                finished = [job_id for job_id, job in self.jobs.items() if job.finished()]
+                for job_id in finished[:max(0, len(finished) - self.max_finished_jobs)]:
+                    del self.jobs[job_id]
+
+    def close(self) -> None:
+        """Waits for the current job to finish and stops running jobs; queued jobs are cancelled."""
+        with self.lock:
+            for job in self.jobs.values():
+                if job.status == JobStatus.QUEUED:
+                    job.cancel_requested.set()
+        self._queue.put(None)
+        self._worker.join()
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    """
+    Serves the API used by ServerClient:
+    - GET /status: the cache_id() of the server's cache, and how many jobs are queued or running
+    - POST /jobs: submits a job, given {"args", "provider", "model", "cache"} (see
+      ServerClient.submit()), responding with {"id"}
+    - GET /jobs/ID?since=N: the job's status, error (if it failed) and events from the Nth on,
+      with "next" giving N for the next poll
+    - GET /jobs/ID/stream?since=N: the job's events from the Nth on, as JSON lines, as they
+      happen, ending with one giving its final status and error
+    - DELETE /jobs/ID: cancels the job
+    See ServerJob regarding events.
+    """
+    server: "_UnixHTTPServer"
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def _send_json(self, status: int, data: dict) -> None:
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _route(self) -> tuple[list[str], int, Optional[ServerJob]]:
+        """Returns the parts of the request's path, its since parameter, and the job it names, if any."""
+        url = urlsplit(self.path)
+        parts = url.path.strip("/").split("/")
+        since = int(parse_qs(url.query).get("since", ["0"])[0])
+        job = self.server.ranking.get(parts[1]) if len(parts) >= 2 and parts[0] == "jobs" else None
+        return parts, since, job
+
+    def do_GET(self) -> None:
+        parts, since, job = self._route()
+        if parts == ["status"]:
+            self._send_json(200, {"cache": cache_id(self.server.ranking.cache.path), "unfinished_jobs": self.server.ranking.count_unfinished()})
+        elif job is not None and len(parts) == 2:
+            self._send_json(200, job.to_json(since))
+        elif job is not None and parts[2:] == ["stream"]:
+            self._stream(job, since)
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def do_POST(self) -> None:
+        parts, _, _ = self._route()
+        if parts != ["jobs"]:
+            self._send_json(404, {"error": "not found"})
+            return
+        try:
+            data = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            if data["cache"] != cache_id(self.server.ranking.cache.path):
+                self._send_json(409, {"error": "the server uses a different cache"})
+                return
+            job = self.server.ranking.submit(Namespace(**data["args"]), ModelProvider(data["provider"]), data["model"])
+        except (ValueError, KeyError, TypeError) as exc:
+            self._send_json(400, {"error": f"invalid job: {exc}"})
+            return
+        self._send_json(201, {"id": job.id})
+
+    def do_DELETE(self) -> None:
+        parts, _, job = self._route()
+        if job is None or len(parts) != 2:
+            self._send_json(404, {"error": "not found"})
+            return
+        self.server.ranking.cancel(job)
+        self._send_json(200, job.to_json())
+
+    def _stream(self, job: ServerJob, since: int) -> None:
+        # Without a Content-Length, the end of the response is marked by closing the connection.
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.end_headers()
+        try:
+            while True:
+                events, finished = job.wait(since, timeout=1.0)
+                since += len(events)
+                lines = [json.dumps(event) + "\n" for event in events]
+                if finished:
+                    lines.append(json.dumps({"status": job.status, "error": job.error}) + "\n")
+                self.wfile.write("".join(lines).encode())
+                self.wfile.flush()
+                if finished:
+                    return
+        except (BrokenPipeError, ConnectionResetError):
+            # The client went away; the job carries on, and its results are cached.
+            pass
+
+
+class _UnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path: str, ranking: RankingServer) -> None:
+        self.ranking = ranking
+        super().__init__(socket_path, _RequestHandler)
+
+    def server_bind(self) -> None:
+        # Create the socket with permissions that only allow this user to connect.
+        umask = os.umask(0o177)
+        try:
+            super().server_bind()
+        finally:
+            os.umask(umask)
+
+
+def remove_stale_socket(socket_path: str) -> None:
+    """Removes the socket file left by a server that's no longer running, or raises ServerError if one is still running."""
+    if not os.path.exists(socket_path):
+        return
+    try:
+        ServerClient(socket_path, timeout=2.0).status()
+    except ServerError:
+        os.unlink(socket_path)
+        return
+    raise ServerError(f"A server is already listening on {socket_path}")
+
+
+def serve_main(argv: Optional[list[str]] = None) -> None:
+    parser = ArgumentParser(prog="rank-files serve", description="Run jobs for rank-files in this process, keeping the cache, model clients and file digests in memory between jobs. The provider, model and cache are configured with the same environment variables as rank-files; jobs are only sent here by rank-files processes using the same cache.")
+    parser.add_argument("--socket", type=str, default=default_socket_path(), help="Path of the Unix socket to listen on (default: the RANK_FILES_SERVER env var, or rank-files-server.sock in the current directory)")
+    args = parser.parse_args(argv)
+    try:
+        remove_stale_socket(args.socket)
+    except ServerError as exc:
+        parser.error(str(exc))
+    with default_cache() as cache:
+        ranking = RankingServer(cache)
+        with _UnixHTTPServer(args.socket, ranking) as httpd:
+            print(f"Listening on {args.socket}", file=sys.stderr)
+            # Shut down cleanly when stopped by a service manager, too.
+            signal.signal(signal.SIGTERM, signal.default_int_handler)
+            try:
+                httpd.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                os.unlink(args.socket)
+                ranking.close()
@@ -0,0 +1,199 @@
+from collections.abc import Callable
+from enum import StrEnum
+from hashlib import sha256
+from rank_files.cache import Cache
+from rank_files.document import Document
+from rank_files.trace import stage
+from typing import Optional
+import json
+import math
+import re
+
+
+# Increment this if count_tokens() changes, so that reduced documents cached with the old
+# counts aren't reused.
+TOKENIZER_VERSION = 2
+
+# A non-ASCII letter or digit, a run of ASCII ones, or a punctuation mark.
+_TOKEN_PATTERN = re.compile(r"[^\W\x00-\x7f]|[0-9A-Za-z_]+|[^\w\s]")
+
+TRUNCATION_MARKER = "\n[...]\n"
+
+
+def _token_spans(text: str) -> list[tuple[int, int, int]]:
+    """Returns (start, end, tokens) for each ASCII word, other word character or punctuation mark in the text."""
+    return [(m.start(), m.end(), math.ceil((m.end() - m.start()) / 4)) for m in _TOKEN_PATTERN.finditer(text)]
+
+
+def count_tokens(text: str) -> int:
+    """
+    Counts tokens in the text with a local approximation of the subword tokenizers used by
+    LLMs: each punctuation mark is a token, each ASCII word is a token per four characters,
+    and each other letter or digit is a token. Scripts written without spaces between words
+    (e.g. Chinese) therefore count about one token per character. This errs on the high side
+    for common English words, so budgets based on it are safe.
+    """
+    return sum(tokens for _, _, tokens in _token_spans(text))
+
+
+def truncate_head(text: str, max_tokens: int) -> str:
+    """Returns the longest prefix of the text with at most max_tokens tokens."""
+    total = 0
+    end = 0
+    for _, span_end, tokens in _token_spans(text):
+        if total + tokens > max_tokens:
+            break
+        total += tokens
+        end = span_end
+    return text[:end]
+
+
+def truncate_tail(text: str, max_tokens: int) -> str:
+    """Returns the longest suffix of the text with at most max_tokens tokens."""
+    total = 0
+    start = len(text)
+    for span_start, _, tokens in reversed(_token_spans(text)):
+        if total + tokens > max_tokens:
+            break
+        total += tokens
+        start = span_start
+    return text[start:]
+
+
+def truncate_head_tail(text: str, max_tokens: int) -> str:
+    """
+    Keeps the beginning and end of the text, with at most max_tokens tokens in total.
+    If the budget is too small to be worth splitting, only the beginning is kept.
+    """
+    if count_tokens(text) <= max_tokens:
+        return text
+    budget = max_tokens - count_tokens(TRUNCATION_MARKER)
+    if budget < 2:
+        return truncate_head(text, max_tokens)
+    return truncate_head(text, budget - budget // 2) + TRUNCATION_MARKER + truncate_tail(text, budget // 2)
+
+
+class ReductionStrategy(StrEnum):
+    """How DocumentReducer shortens documents that exceed its budget."""
+    HEAD = "head"
+    """Keep the beginning."""
+    HEAD_TAIL = "head-tail"
+    """Keep the beginning and the end."""
+    SUMMARY = "summary"
+    """Replace the document with a summary written by a model."""
+
+
+class DocumentReducer:
+    """
+    Shortens documents with more than max_tokens tokens (per count_tokens()), so that the
+    prompts containing them stay small.
+
+    Each reduced document is stored in the Cache, keyed by the digest of the original content
+    along with the strategy and budget, so it's only computed once per document. For the
+    SUMMARY strategy, summarize must be provided: it's called with the text (first shortened
+    by HEAD_TAIL to summary_input_tokens) and max_tokens, and should return a summary.
+    summarizer_id identifies the summarizer (e.g. the provider and model) in cache keys.
+    """
+    def __init__(self, max_tokens: int, strategy: ReductionStrategy = ReductionStrategy.HEAD_TAIL, cache: Optional[Cache] = None, summarize: Optional[Callable[[str, int], str]] = None, summarizer_id: str = "", summary_input_tokens: int = 8192) -> None:
+        if strategy == ReductionStrategy.SUMMARY and summarize is None:
+            raise ValueError("The summary strategy requires a summarize function")
+        self.max_tokens = max_tokens
+        self.strategy = strategy
+        self.cache = cache if cache is not None else Cache(":memory:")
+        self.summarize = summarize
+        self.summarizer_id = summarizer_id if strategy == ReductionStrategy.SUMMARY else ""
+        self.summary_input_tokens = summary_input_tokens
+        self.total_reduced = 0
+
+    def fits(self, doc: Document) -> bool:
+        """
+        Returns whether the document is within the budget. Every token has at least one
+        character, so documents with at most max_tokens bytes are known to fit without
+        reading them.
+        """
+        if doc.byte_size() <= self.max_tokens:
+            return True
+        with stage("tokenize"):
+            return count_tokens(doc.read_text()) <= self.max_tokens
+
+    def key(self, doc: Document) -> str:
+        """Returns the cache key for the reduced form of the document."""
+        return "reduced:" + sha256(json.dumps([self.strategy, self.max_tokens, TOKENIZER_VERSION, self.summarizer_id, doc.digest()]).encode()).hexdigest()
+
+    def reduce_text(self, text: str) -> str:
+        """Returns the text shortened by the strategy, without using the cache."""
+        if self.strategy == ReductionStrategy.HEAD:
+            return truncate_head(text, self.max_tokens)
+        if self.strategy == ReductionStrategy.HEAD_TAIL:
+            return truncate_head_tail(text, self.max_tokens)
+        with stage("summarize"):
+            summary = self.summarize(truncate_head_tail(text, self.summary_input_tokens), self.max_tokens)
+        return truncate_head(summary, self.max_tokens)
+
+    def reduce(self, doc: Document) -> str:
+        """Returns the reduced text of a document which doesn't fit, from the cache if possible."""
+        key = self.key(doc)
+        text = self.cache.fetch(key, count=False)
+        if text is None:
+            text = self.reduce_text(doc.read_text())
+            self.cache.put(key, text)
+            self.total_reduced += 1
+        return text
+
+    def wrap(self, docs: list[Document]) -> list[Document]:
+        """Returns the documents, with those that don't fit replaced by ReducedDocuments."""
+        return [doc if self.fits(doc) else ReducedDocument(doc, self) for doc in docs]
+
+
+class ReducedDocument(Document):
+    """
+    A shortened version of a document which exceeds a DocumentReducer's budget.
+    The reduced text is only computed (or loaded from the cache) when it's needed, so
+    comparisons that hit the cache don't require it.
+    """
+    def __init__(self, original: Document, reducer: DocumentReducer) -> None:
+        super().__init__()
+        self.original = original
+        self.reducer = reducer
+        self._text: Optional[str] = None
+        self._digest: Optional[str] = None
+
+    def read_text(self) -> str:
+        if self._text is None:
+            self._text = self.reducer.reduce(self.original)
+        return self._text
+
+    def read_bytes(self) -> bytes:
+        return self.read_text().encode("utf8")
+
+    def pending_summary(self) -> bool:
+        """Returns whether reading the text would call the summarizer, i.e. it's a summary that isn't cached."""
+        if self._text is None:
+            self._text = self.reducer.cache.fetch(self.reducer.key(self.original), count=False)
+        return self._text is None and self.reducer.strategy == ReductionStrategy.SUMMARY
+
+    def summary_input_size(self) -> int:
+        """Estimates the size in bytes of the text the summarizer is given, at four bytes per token."""
+        return min(self.original.byte_size(), self.reducer.summary_input_tokens * 4)
+
+    def byte_size(self) -> int:
+        """
+        Returns the size of the reduced text if it's known or can be computed locally. A summary
+        that isn't cached yet isn't written just to measure it (e.g. for a dry run): its size
+        is estimated from the budget instead, at four bytes per token.
+        """
+        if self.pending_summary():
+            return min(self.original.byte_size(), self.reducer.max_tokens * 4)
+        return len(self.read_bytes())
+
+    def digest(self) -> str:
+        # The reducer's cache key identifies the reduced content without computing it.
+        if self._digest is None:
+            self._digest = sha256(self.reducer.key(self.original).encode()).hexdigest()
+        return self._digest
+
+    def cheap_sort_key(self) -> str:
+        return self.original.cheap_sort_key()
+
+    def __str__(self) -> str:
+        return str(self.original)
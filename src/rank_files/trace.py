@@ -0,0 +1,159 @@
+from collections.abc import Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+import json
+import math
+import threading
+import time
+
+
+class ComparisonTrace:
+    """
+    The measurements taken during one comparison: when it started and ended, the time spent in
+    each stage (e.g. "cache", "read", "prompt", "model"), and attributes describing it (e.g.
+    prompt_chars, prompt_tokens, cache_hit, num_ctx, retries). Times are in seconds, relative
+    to the creation of the Tracer.
+    """
+    def __init__(self, index: int, start: float, thread: int) -> None:
+        self.index = index
+        self.start = start
+        self.end = start
+        self.thread = thread
+        self.stages: list[tuple[str, float, float]] = []
+        self.attrs: dict = {}
+
+    def duration(self) -> float:
+        return self.end - self.start
+
+    def stage_totals(self) -> dict[str, float]:
+        """Returns the total time spent in each stage."""
+        totals: dict[str, float] = {}
+        for name, _, duration in self.stages:
+            totals[name] = totals.get(name, 0.0) + duration
+        return totals
+
+    def to_json(self) -> dict:
+        return {
+            "index": self.index,
+            "start": self.start,
+            "duration": self.duration(),
+            "thread": self.thread,
+            "stages": self.stage_totals(),
+            **self.attrs,
+        }
+
+
+_current: ContextVar[Optional[ComparisonTrace]] = ContextVar("rank_files_trace", default=None)
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """Times the enclosed code as a stage of the comparison being traced, if there is one."""
+    trace = _current.get()
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.stages.append((name, start, time.perf_counter() - start))
+
+
+def annotate(**attrs) -> None:
+    """Sets attributes of the comparison being traced, if there is one."""
+    trace = _current.get()
+    if trace is not None:
+        trace.attrs.update(attrs)
+
+
+def increment(name: str, amount: int = 1) -> None:
+    """Adds to a numeric attribute (e.g. retries) of the comparison being traced, if there is one."""
+    trace = _current.get()
+    if trace is not None:
+        trace.attrs[name] = trace.attrs.get(name, 0) + amount
+
+
+def _percentile(values: list[float], p: float) -> float:
+    """Returns the p-th percentile of the sorted values, by the nearest-rank method."""
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+class Tracer:
+    """
+    Collects a ComparisonTrace for each comparison. Pass a Tracer to ComparisonTracker to
+    trace every comparison it counts; code running during a comparison (in the same thread or
+    asyncio task) can then record stages and attributes with stage() and annotate().
+
+    The traces can be written as JSON lines (write_jsonl()) or in the Chrome trace event
+    format (write_chrome_trace()), which can be viewed with chrome://tracing or Perfetto.
+    """
+    def __init__(self) -> None:
+        self.traces: list[ComparisonTrace] = []
+        self._origin = time.perf_counter()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def comparison(self) -> Iterator[ComparisonTrace]:
+        """Traces the comparison made by the enclosed code."""
+        with self._lock:
+            index = len(self.traces)
+            trace = ComparisonTrace(index, time.perf_counter(), threading.get_ident())
+            self.traces.append(trace)
+        token = _current.set(trace)
+        try:
+            yield trace
+        finally:
+            trace.end = time.perf_counter()
+            _current.reset(token)
+
+    def to_json(self) -> list[dict]:
+        """Returns one dict per comparison, with times relative to the creation of the Tracer."""
+        result = []
+        for trace in self.traces:
+            data = trace.to_json()
+            data["start"] -= self._origin
+            result.append(data)
+        return result
+
+    def write_jsonl(self, path: str) -> None:
+        """Writes one JSON object per comparison."""
+        with open(path, "w") as f:
+            for data in self.to_json():
+                f.write(json.dumps(data) + "\n")
+
+    def write_chrome_trace(self, path: str) -> None:
+        """Writes a trace in the Chrome trace event format, with each stage nested in its comparison."""
+        threads: dict[int, int] = {}
+        events = []
+        micros = lambda t: (t - self._origin) * 1e6
+        for trace in self.traces:
+            tid = threads.setdefault(trace.thread, len(threads) + 1)
+            events.append({"name": "comparison", "ph": "X", "pid": 1, "tid": tid, "ts": micros(trace.start), "dur": trace.duration() * 1e6, "args": trace.attrs})
+            for name, start, duration in trace.stages:
+                events.append({"name": name, "ph": "X", "pid": 1, "tid": tid, "ts": micros(start), "dur": duration * 1e6})
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+    def write(self, path: str) -> None:
+        """Writes a Chrome trace if the path ends with .json, and JSON lines otherwise."""
+        if path.endswith(".json"):
+            self.write_chrome_trace(path)
+        else:
+            self.write_jsonl(path)
+
+    def summary(self) -> str:
+        """Returns a human-readable table of percentiles of the time spent per comparison and per stage."""
+        if not self.traces:
+            return "No comparisons traced."
+        series = {"comparison": sorted(trace.duration() for trace in self.traces)}
+        for trace in self.traces:
+            for name, total in trace.stage_totals().items():
+                series.setdefault(name, []).append(total)
+        lines = [f"{'':<12} {'count':>6} {'p50':>9} {'p90':>9} {'p99':>9} {'max':>9} {'total':>9}"]
+        for name, values in series.items():
+            values.sort()
+            stats = " ".join(f"{_percentile(values, p):>8.3f}s" for p in (50, 90, 99, 100))
+            lines.append(f"{name:<12} {len(values):>6} {stats} {sum(values):>8.3f}s")
+        return "\n".join(lines)
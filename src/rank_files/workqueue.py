@@ -0,0 +1,354 @@
+from argparse import ArgumentParser
+from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
+from rank_files.cache import Cache, ComparisonKey, default_cache
+from rank_files.document import Document
+from rank_files.graph import CyclePolicy
+from rank_files.ranker import PAIRWISE_SYSTEM_PROMPT, ComparisonRecords, ModelProvider, PairwiseWrapper, Ranker, build_ranker, canonical_order, default_model, default_provider, parse_keep_alive
+from rank_files.scheduler import RequestScheduler
+from typing import NamedTuple, Optional, Self
+import os
+import socket
+import sqlite3
+import sys
+import threading
+import time
+
+
+class QueueError(Exception):
+    """Raised when a queued comparison fails too many times."""
+    pass
+
+
+class QueuedComparison(NamedTuple):
+    """
+    A comparison waiting in a WorkQueue: its key, the criteria, and the text of the documents
+    whose digests are key.doc1_digest and key.doc2_digest.
+    """
+    key: ComparisonKey
+    criteria: str
+    doc1_text: str
+    doc2_text: str
+
+
+class QueuedDocument(Document):
+    """
+    A document received from a WorkQueue. Its digest is the one computed by the coordinator,
+    which (e.g. for a ReducedDocument) isn't necessarily the digest of its text, so that the
+    result is cached under the coordinator's ComparisonKey.
+    """
+    def __init__(self, text: str, digest: str) -> None:
+        super().__init__()
+        self.text = text
+        self._digest = digest
+
+    def read_text(self) -> str:
+        return self.text
+
+    def read_bytes(self) -> bytes:
+        return self.text.encode("utf8")
+
+    def digest(self) -> str:
+        return self._digest
+
+    def cheap_sort_key(self) -> str:
+        return self._digest
+
+    def __str__(self) -> str:
+        return self._digest[:12]
+
+
+class WorkQueue:
+    """
+    A queue of comparisons in a sqlite database, normally the cache file, which lets several
+    worker processes (e.g. each using a different Ollama host) answer the comparisons needed by
+    one coordinator process.
+
+    The coordinator adds comparisons with enqueue() and polls for their results with results().
+    Workers take comparisons with claim(), which leases them for lease_seconds; a worker that
+    takes longer must call renew(). If a lease expires (e.g. because the worker died), another
+    worker can claim the comparison. Each claim counts as an attempt; after max_attempts, a
+    comparison whose lease expires or which fails is marked as failed.
+    """
+    def __init__(self, path: str, lease_seconds: float = 300.0, max_attempts: int = 3) -> None:
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, timeout=30, isolation_level=None)
+        self._init_db()
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, type, value, traceback) -> None:
+        self.close()
+
+    def close(self) -> None:
+        with self.lock:
+            self.db.close()
+
+    def _init_db(self) -> None:
+        cur = self.db.cursor()
+        if self.path != ":memory:":
+            cur.execute("PRAGMA journal_mode=WAL")
+        cur.execute("CREATE TABLE IF NOT EXISTS comparison_queue (entry_key TEXT PRIMARY KEY, provider TEXT, model TEXT, system_digest TEXT, criteria_digest TEXT, doc1_digest TEXT, doc2_digest TEXT, criteria TEXT, doc1_text TEXT, doc2_text TEXT, status TEXT, worker TEXT, lease_expires REAL, attempts INTEGER, result TEXT, enqueued REAL)")
+        cur.execute("CREATE INDEX IF NOT EXISTS comparison_queue_status ON comparison_queue (status, provider, model, enqueued)")
+
+    def enqueue(self, comparisons: Iterable[QueuedComparison]) -> None:
+        """
+        Adds comparisons to the queue. Comparisons that are already queued are left alone,
+        unless they failed, in which case they're retried.
+        """
+        now = time.time()
+        rows = [(c.key.entry_key(), *c.key, c.criteria, c.doc1_text, c.doc2_text, now) for c in comparisons]
+        with self.lock:
+            self.db.executemany(
+                "INSERT INTO comparison_queue (entry_key, provider, model, system_digest, criteria_digest, doc1_digest, doc2_digest, criteria, doc1_text, doc2_text, status, attempts, enqueued) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 'pending', 0, ?) "
+                "ON CONFLICT (entry_key) DO UPDATE SET status = 'pending', attempts = 0, worker = NULL, result = NULL WHERE status = 'failed'",
+                rows,
+            )
+
+    def claim(self, worker: str, provider: str, model: str, limit: int) -> list[QueuedComparison]:
+        """
+        Leases up to limit comparisons for the given provider and model to the worker: those
+        that are pending, or whose lease has expired, oldest first.
+        """
+        now = time.time()
+        with self.lock:
+            cur = self.db.cursor()
+            cur.execute("BEGIN IMMEDIATE")
+            try:
+                cur.execute(
+                    "UPDATE comparison_queue SET status = 'failed', result = 'lease expired' WHERE status = 'claimed' AND lease_expires < ? AND attempts >= ?",
+                    (now, self.max_attempts),
+                )
+                rows = cur.execute(
+                    "SELECT entry_key, provider, model, system_digest, criteria_digest, doc1_digest, doc2_digest, criteria, doc1_text, doc2_text FROM comparison_queue "
+                    "WHERE provider = ? AND model = ? AND (status = 'pending' OR (status = 'claimed' AND lease_expires < ?)) ORDER BY enqueued LIMIT ?",
+                    (provider, model, now, limit),
+                ).fetchall()
+                cur.executemany(
+                    "UPDATE comparison_queue SET status = 'claimed', worker = ?, lease_expires = ?, attempts = attempts + 1 WHERE entry_key = ?",
+                    [(worker, now + self.lease_seconds, row[0]) for row in rows],
+                )
+                cur.execute("COMMIT")
+            except BaseException:
+                cur.execute("ROLLBACK")
+                raise
+        return [QueuedComparison(ComparisonKey(*row[1:7]), *row[7:]) for row in rows]
+
+    def renew(self, worker: str, entry_keys: list[str]) -> None:
+        """Extends the worker's leases on the given comparisons."""
+        with self.lock:
+            self.db.executemany(
+                "UPDATE comparison_queue SET lease_expires = ? WHERE entry_key = ? AND worker = ? AND status = 'claimed'",
+                [(time.time() + self.lease_seconds, key, worker) for key in entry_keys],
+            )
+
+    def complete(self, worker: str, entry_key: str, winner_digest: str) -> None:
+        """Records the digest of the winner of a comparison."""
+        with self.lock:
+            self.db.execute(
+                "UPDATE comparison_queue SET status = 'done', worker = ?, result = ? WHERE entry_key = ? AND status != 'done'",
+                (worker, winner_digest, entry_key),
+            )
+
+    def fail(self, worker: str, entry_key: str, error: str) -> None:
+        """Records that the worker couldn't answer a comparison; it's retried unless it has run out of attempts."""
+        with self.lock:
+            self.db.execute(
+                "UPDATE comparison_queue SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, result = ? WHERE entry_key = ? AND worker = ? AND status = 'claimed'",
+                (self.max_attempts, error, entry_key, worker),
+            )
+
+    def results(self, entry_keys: list[str]) -> dict[str, tuple[str, Optional[str], Optional[str]]]:
+        """
+        Returns the status ('pending', 'claimed', 'done' or 'failed'), result and worker of
+        each of the given comparisons that's in the queue. The result is the winner's digest
+        if the comparison is done, or an error message if it failed.
+        """
+        found = {}
+        with self.lock:
+            cur = self.db.cursor()
+            for i in range(0, len(entry_keys), 900):
+                chunk = entry_keys[i:i + 900]
+                placeholders = ", ".join("?" * len(chunk))
+                for key, status, result, worker in cur.execute(f"SELECT entry_key, status, result, worker FROM comparison_queue WHERE entry_key IN ({placeholders})", chunk):
+                    found[key] = (status, result, worker)
+        return found
+
+    def remove(self, entry_keys: list[str]) -> None:
+        """Deletes comparisons from the queue."""
+        with self.lock:
+            self.db.executemany("DELETE FROM comparison_queue WHERE entry_key = ?", [(key,) for key in entry_keys])
+
+
+class QueueRanker(Ranker):
+    """
+    A Ranker for a coordinator process: rather than invoking a model, it puts comparisons that
+    aren't cached into a WorkQueue and waits for workers (see run_worker()) using the same
+    provider and model to answer them. Results are cached like any other Ranker's.
+
+    prefetch_wrapped() enqueues a whole batch of comparisons (across all criteria) at once, so
+    every worker can take part. The number of comparisons each worker answered is kept in
+    total_by_worker.
+    """
+    def __init__(self, provider: ModelProvider, model: str, cache: Cache, queue: WorkQueue, poll_interval: float = 0.5, infer: bool = True, cycle_policy: CyclePolicy = CyclePolicy.ASK) -> None:
+        self.cache = cache
+        self.queue = queue
+        self.poll_interval = poll_interval
+        self.records = ComparisonRecords(cache, provider, model, None, infer, cycle_policy)
+        self.total_by_worker: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def _enqueue(self, requests: list[tuple[str, ComparisonKey, Document, Document]]) -> None:
+        self.queue.enqueue(QueuedComparison(key, criteria, *(doc.read_text() for doc in _by_digest(key, doc1, doc2))) for criteria, key, doc1, doc2 in requests)
+
+    def _wait_for(self, requests: dict[str, tuple[str, ComparisonKey, Document, Document]]) -> dict[str, Document]:
+        """
+        Enqueues the (criteria, key, doc1, doc2) requests, waits for the results, records them
+        and returns the winners. If another coordinator queued the same comparison and removed
+        it when it was done, the result is read from the cache instead (or the comparison is
+        queued again, if it isn't there).
+        """
+        self._enqueue(list(requests.values()))
+        winners = {}
+        pending = list(requests)
+        while pending:
+            found = self.queue.results(pending)
+            missing = []
+            for entry_key in pending:
+                if entry_key not in found:
+                    criteria, key, doc1, doc2 = requests[entry_key]
+                    _, choice = self.records.lookup(criteria, doc1, doc2, count=False)
+                    if choice is None:
+                        missing.append(requests[entry_key])
+                    else:
+                        winners[entry_key] = choice
+            self._enqueue(missing)
+            for entry_key, (status, result, worker) in found.items():
+                if status == "failed":
+                    raise QueueError(f"A queued comparison failed: {result}")
+                if status == "done":
+                    _, key, doc1, doc2 = requests[entry_key]
+                    choice = doc1 if result == doc1.digest() else doc2
+                    self.records.record(key, doc1, doc2, choice)
+                    winners[entry_key] = choice
+                    with self._lock:
+                        self.total_by_worker[worker] = self.total_by_worker.get(worker, 0) + 1
+            done = [key for key in pending if key in winners]
+            self.queue.remove(done)
+            pending = [key for key in pending if key not in winners]
+            if pending:
+                time.sleep(self.poll_interval)
+        return winners
+
+    def prefetch_wrapped(self, pairs: list[tuple[PairwiseWrapper, PairwiseWrapper]]) -> None:
+        requests = {}
+        for a, b in pairs:
+            doc1, doc2 = canonical_order(a.wrapped, b.wrapped)
+            key, choice = self.records.lookup(a.criteria, doc1, doc2, count=False)
+            if choice is None:
+                self.records.charge(PAIRWISE_SYSTEM_PROMPT, a.criteria, [doc1, doc2])
+                requests[key.entry_key()] = (a.criteria, key, doc1, doc2)
+        if requests:
+            self._wait_for(requests)
+
+    def prefetch(self, criteria: str, pairs: list[tuple[Document, Document]]) -> None:
+        self.prefetch_wrapped([(PairwiseWrapper(doc1, self, criteria), PairwiseWrapper(doc2, self, criteria)) for doc1, doc2 in pairs])
+
+    def _choose_better(self, criteria: str, doc1: Document, doc2: Document) -> Document:
+        key, choice = self.records.lookup(criteria, doc1, doc2)
+        if choice is None:
+            choice = self._wait_for({key.entry_key(): (criteria, key, doc1, doc2)})[key.entry_key()]
+        return choice
+
+    def summary(self) -> Optional[str]:
+        counts = ", ".join(f"{worker}: {count}" for worker, count in sorted(self.total_by_worker.items()))
+        return f"Comparisons answered by workers: {counts or 'none'}."
+
+
+def _by_digest(key: ComparisonKey, doc1: Document, doc2: Document) -> tuple[Document, Document]:
+    """Returns the documents in the order of the digests in the key."""
+    return (doc1, doc2) if doc1.digest() == key.doc1_digest else (doc2, doc1)
+
+
+def default_worker_id() -> str:
+    """Identifies this process and the Ollama host it uses."""
+    host = os.getenv("OLLAMA_HOST")
+    return f"{socket.gethostname()}:{os.getpid()}" + ("" if host is None else f"@{host}")
+
+
+def run_worker(queue: WorkQueue, ranker: Ranker, cache: Cache, provider: ModelProvider, model: str, worker: Optional[str] = None, concurrency: int = 1, poll_interval: float = 0.5, idle_exit: Optional[float] = None) -> int:
+    """
+    Repeatedly claims comparisons for the provider and model from the queue, up to concurrency
+    at a time, answers them with the ranker, and records the results in the cache and the queue.
+    Leases are renewed while the comparisons are in progress. A comparison that raises an
+    exception is recorded as failed, so that it's retried (perhaps by another worker).
+
+    Returns the number of comparisons answered, once the queue has had nothing to claim for
+    idle_exit seconds; if idle_exit is None, runs until interrupted.
+    """
+    worker = default_worker_id() if worker is None else worker
+    answered = 0
+    idle_since = time.monotonic()
+
+    def answer(item: QueuedComparison) -> bool:
+        doc1 = QueuedDocument(item.doc1_text, item.key.doc1_digest)
+        doc2 = QueuedDocument(item.doc2_text, item.key.doc2_digest)
+        try:
+            winner = ranker.choose_better(item.criteria, doc1, doc2)
+        except Exception as exc:
+            queue.fail(worker, item.key.entry_key(), f"{type(exc).__name__}: {exc}")
+            return False
+        cache.put_comparison(item.key, winner.digest())
+        queue.complete(worker, item.key.entry_key(), winner.digest())
+        return True
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        while True:
+            items = queue.claim(worker, provider, model, concurrency)
+            if not items:
+                if idle_exit is not None and time.monotonic() - idle_since >= idle_exit:
+                    return answered
+                time.sleep(poll_interval)
+                continue
+            finished = threading.Event()
+
+            def heartbeat() -> None:
+                while not finished.wait(queue.lease_seconds / 3):
+                    queue.renew(worker, [item.key.entry_key() for item in items])
+
+            renewer = threading.Thread(target=heartbeat, daemon=True)
+            renewer.start()
+            try:
+                answered += sum(executor.map(answer, items))
+            finally:
+                finished.set()
+                renewer.join()
+            cache.flush()
+            idle_since = time.monotonic()
+
+
+def worker_main() -> None:
+    parser = ArgumentParser(description="Answer comparisons queued by 'rank-files --distributed' using the same cache file. The provider, model and cache are configured with the same environment variables as rank-files; set OLLAMA_HOST to choose the Ollama instance.")
+    parser.add_argument("-c", "--concurrency", type=int, default=1, help="How many comparisons to claim and send to the model at once")
+    parser.add_argument("--lease", type=float, default=300.0, help="Seconds a claimed comparison is reserved for this worker before others may take it over (leases are renewed while it's in progress)")
+    parser.add_argument("--poll-interval", type=float, default=0.5, help="Seconds to wait before checking the queue again when it's empty")
+    parser.add_argument("--idle-exit", type=float, help="Exit after the queue has been empty for this many seconds (default: run until interrupted)")
+    parser.add_argument("--id", type=str, help="Name for this worker in statistics (default: hostname, process ID and OLLAMA_HOST)")
+    parser.add_argument("--keep-alive", type=str, help="Ollama only: see rank-files --keep-alive")
+    parser.add_argument("--requests-per-minute", type=float, metavar="N", help="Send at most this many requests to the model per minute (default: no limit)")
+    parser.add_argument("--tokens-per-minute", type=float, metavar="N", help="Send at most about this many input tokens to the model per minute (default: no limit)")
+    args = parser.parse_args()
+    provider = default_provider()
+    model = default_model(provider)
+    with default_cache() as cache:
+        if cache.path == ":memory:":
+            parser.error("workers must share a cache file with the coordinator; set RANK_FILES_CACHE")
+        scheduler = RequestScheduler(args.requests_per_minute, args.tokens_per_minute, max_concurrency=max(1, args.concurrency))
+        ranker = build_ranker(provider, model, cache=cache, keep_alive=parse_keep_alive(args.keep_alive), scheduler=scheduler)
+        with WorkQueue(cache.path, lease_seconds=args.lease) as queue:
+            answered = run_worker(queue, ranker, cache, provider, model, args.id, args.concurrency, args.poll_interval, args.idle_exit)
+    print(f"Answered {answered} comparisons.", file=sys.stderr)
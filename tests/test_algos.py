@@ -1,6 +1,11 @@
+import asyncio
+import itertools
+import json
+import math
+import pytest
 import random
-from rank_files.algos import tournament, tournament_estimated_comparisons, ComparisonTracker
-from hypothesis import given, strategies as st
+from rank_files.algos import array_tournament, multiway_tournament, multiway_estimated_comparisons, plan_top_k, run_interleaved, select_top_k, top_k_steps, tournament, tournament_async, tournament_iter, tournament_steps, tournament_estimated_comparisons, ComparisonTracker, TopKAlgorithm, TournamentState
+from hypothesis import given, settings, strategies as st
 
 
 @given(st.integers(min_value=0, max_value=1000), st.integers(min_value=0, max_value=10000), st.integers())
@@ -14,3 +19,193 @@ def test_tournament(k, n, seed):
     result = tracker.unwrap(tournament(k, tracker.wrap(nums)))
     assert result == sorted(nums, reverse=True)[:k]
     assert tracker.total <= tournament_estimated_comparisons(k, len(nums))
+
+
+@given(st.integers(min_value=0, max_value=1000), st.integers(min_value=0, max_value=10000), st.integers())
+def test_array_tournament(k, n, seed):
+    random.seed(seed)
+    nums = list(range(n))
+    random.shuffle(nums)
+    tracker = ComparisonTracker()
+    result = array_tournament(k, nums, tracker.comparator())
+    assert result == sorted(nums, reverse=True)[:k]
+    assert tracker.total <= tournament_estimated_comparisons(k, len(nums))
+
+
+def test_tournament_estimated_comparisons_is_tight():
+    for n in range(1, 7):
+        for k in range(n + 1):
+            most = 0
+            for nums in itertools.permutations(range(n)):
+                tracker = ComparisonTracker()
+                tournament(k, tracker.wrap(list(nums)))
+                most = max(most, tracker.total)
+            assert most == tournament_estimated_comparisons(k, n)
+
+
+def test_array_tournament_custom_comparison():
+    words = ["pear", "fig", "banana", "kiwi", "apple"]
+    assert array_tournament(3, words, lambda a, b: len(a) > len(b)) == ["fig", "kiwi", "pear"]
+    # Ties go to the earlier item, as in tournament().
+    assert array_tournament(2, [(1, "a"), (1, "b")], lambda a, b: a[0] < b[0]) == [(1, "a"), (1, "b")]
+
+
+@settings(max_examples=20, deadline=None)
+@given(st.integers(min_value=0, max_value=50), st.integers(min_value=0, max_value=500), st.integers())
+def test_concurrent_tournament_matches_sequential(k, n, seed):
+    random.seed(seed)
+    nums = list(range(n))
+    random.shuffle(nums)
+    sequential = ComparisonTracker()
+    expected = sequential.unwrap(tournament(k, sequential.wrap(nums)))
+    concurrent = ComparisonTracker()
+    result = concurrent.unwrap(tournament(k, concurrent.wrap(nums), concurrency=8))
+    assert result == expected
+    assert concurrent.total == sequential.total
+
+
+def test_tournament_steps_batches_first_round():
+    nums = list(range(100))
+    random.seed(0)
+    random.shuffle(nums)
+    steps = tournament_steps(1, nums)
+    batches = []
+    try:
+        batch = next(steps)
+        while True:
+            batches.append(batch)
+            batch = steps.send([a < b for a, b in batch])
+    except StopIteration as stop:
+        assert stop.value == [99]
+    assert len(batches) == math.ceil(math.log2(len(nums)))
+    assert sum(len(batch) for batch in batches) == len(nums) - 1
+
+
+class AsyncInt:
+    def __init__(self, val: int) -> None:
+        self.val = val
+
+    async def async_lt(self, other) -> bool:
+        await asyncio.sleep(0)
+        return self.val < other.val
+
+
+@settings(max_examples=20, deadline=None)
+@given(st.integers(min_value=0, max_value=50), st.integers(min_value=0, max_value=500), st.integers())
+def test_tournament_async(k, n, seed):
+    random.seed(seed)
+    nums = list(range(n))
+    random.shuffle(nums)
+    sequential = ComparisonTracker()
+    expected = sequential.unwrap(tournament(k, sequential.wrap(nums)))
+    tracker = ComparisonTracker()
+    result = asyncio.run(tournament_async(k, tracker.wrap([AsyncInt(x) for x in nums]), concurrency=4))
+    assert [x.val for x in tracker.unwrap(result)] == expected
+    assert tracker.total == sequential.total
+
+
+@settings(max_examples=20, deadline=None)
+@given(st.integers(min_value=0, max_value=30), st.integers(min_value=0, max_value=30), st.integers(min_value=0, max_value=300), st.integers())
+def test_tournament_resume(k1, k2, n, seed):
+    random.seed(seed)
+    nums = list(range(n))
+    random.shuffle(nums)
+    fresh = ComparisonTracker()
+    expected = fresh.unwrap(tournament(max(k1, k2), fresh.wrap(nums)))
+
+    tracker = ComparisonTracker()
+    items = tracker.wrap(nums)
+    saved = []
+    tournament(k1, items, checkpoint=lambda state: saved.append(json.dumps(state.to_json(items))))
+    first_total = tracker.total
+    state = TournamentState.from_json(json.loads(saved[-1]), items) if saved else TournamentState()
+    result = tracker.unwrap(tournament(k2, items, state=state))
+    assert result == expected[:k2]
+    if k2 <= k1:
+        assert tracker.total == first_total
+    else:
+        # Resuming didn't repeat any of the comparisons from the first call.
+        assert tracker.total == fresh.total
+
+
+@settings(max_examples=50, deadline=None)
+@given(st.integers(min_value=0, max_value=50), st.integers(min_value=0, max_value=2000), st.integers(min_value=2, max_value=9), st.integers())
+def test_multiway_tournament(k, n, m, seed):
+    random.seed(seed)
+    nums = list(range(n))
+    random.shuffle(nums)
+    tracker = ComparisonTracker()
+    sizes = []
+
+    def best_of(group):
+        sizes.append(len(group))
+        return group.index(max(group))
+
+    result = multiway_tournament(k, nums, m, tracker.counted(best_of), concurrency=1 if seed % 2 else 4)
+    assert result == sorted(nums, reverse=True)[:k]
+    assert tracker.total <= multiway_estimated_comparisons(k, n, m)
+    assert all(2 <= size <= m for size in sizes)
+
+
+@settings(max_examples=50, deadline=None)
+@given(st.sampled_from(list(TopKAlgorithm)), st.integers(min_value=0, max_value=30), st.integers(min_value=0, max_value=300), st.integers())
+def test_select_top_k(algorithm, k, n, seed):
+    random.seed(seed)
+    nums = list(range(n))
+    random.shuffle(nums)
+    tracker = ComparisonTracker()
+    result = select_top_k(algorithm, k, tracker.wrap(nums), concurrency=1 if seed % 2 else 4)
+    assert tracker.unwrap(result) == sorted(nums, reverse=True)[:k]
+
+
+@pytest.mark.parametrize("algorithm", list(TopKAlgorithm))
+def test_select_top_k_with_repeated_items(algorithm):
+    assert select_top_k(algorithm, 2, [5, 5]) == [5, 5]
+    nums = [3, 1, 3, 2, 3, 1, 2]
+    assert select_top_k(algorithm, 5, nums) == [3, 3, 3, 2, 2]
+    # Equal but distinct objects are all kept too.
+    tracker = ComparisonTracker()
+    assert tracker.unwrap(select_top_k(algorithm, 4, tracker.wrap(nums))) == [3, 3, 3, 2]
+
+
+def test_plan_top_k():
+    assert plan_top_k(10, 1000, concurrency=1) == TopKAlgorithm.TOURNAMENT
+    assert plan_top_k(10, 1000, concurrency=4) == TopKAlgorithm.KNUTH
+    assert plan_top_k(100, 1000, concurrency=64) == TopKAlgorithm.QUICKSELECT
+
+
+def test_tournament_iter_yields_before_finishing():
+    nums = list(range(64))
+    random.seed(3)
+    random.shuffle(nums)
+    tracker = ComparisonTracker()
+    results = tournament_iter(5, tracker.wrap(nums))
+    assert next(results).val == 63
+    assert tracker.total == 63
+    assert [x.val for x in results] == [62, 61, 60, 59]
+    assert tracker.total <= tournament_estimated_comparisons(5, 64)
+
+    state = TournamentState()
+    assert list(tournament_iter(3, nums, state=state)) == [63, 62, 61]
+    assert list(tournament_iter(2, nums, state=state)) == [63, 62]
+    assert list(tournament_iter(4, nums, concurrency=4, state=state)) == [63, 62, 61, 60]
+
+
+@given(st.lists(st.integers()), st.integers(min_value=0, max_value=20), st.sampled_from(list(TopKAlgorithm)))
+def test_schedule_does_not_change_results(items, k, algorithm):
+    reverse = lambda batch: list(reversed(range(len(batch))))
+    expected = sorted(items, reverse=True)[:k]
+    tracker = ComparisonTracker()
+    assert tracker.unwrap(select_top_k(algorithm, k, tracker.wrap(items), schedule=reverse)) == expected
+    tracker = ComparisonTracker()
+    assert tracker.unwrap(tournament(k, tracker.wrap(items), schedule=reverse)) == expected
+
+
+@given(st.lists(st.lists(st.integers()), max_size=5), st.integers(min_value=0, max_value=10), st.sampled_from(list(TopKAlgorithm)))
+def test_run_interleaved(jobs, k, algorithm):
+    batches = []
+    tracker = ComparisonTracker()
+    all_steps = [top_k_steps(algorithm, k, tracker.wrap(items)) for items in jobs]
+    results = run_interleaved(all_steps, concurrency=2, prefetch=batches.append)
+    assert [tracker.unwrap(result) for result in results] == [sorted(items, reverse=True)[:k] for items in jobs]
+    assert sum(len(batch) for batch in batches) == tracker.total
@@ -1,4 +1,4 @@
-from rank_files.cache import Cache
+from rank_files.cache import Cache, ComparisonKey
 
 
 def test_cache(tmpdir):
@@ -17,3 +17,56 @@ def test_cache(tmpdir):
         assert cache.total_hits == 3
         assert cache.fetch("other") == "bar"
         assert cache.total_hits == 4
+
+
+def test_cache_contains():
+    with Cache(":memory:") as cache:
+        assert not cache.contains("foo")
+        cache.put("foo", "bar")
+        assert cache.contains("foo")
+        assert cache.total_hits == 0
+
+
+def test_cache_batches_commits(tmpdir):
+    path = str(tmpdir / "testcache.sqlite3")
+    with Cache(path, flush_interval=3600) as cache:
+        assert cache.db.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+        cache.put("foo", "bar")
+        with Cache(path) as other:
+            assert other.fetch("foo") is None
+        cache.flush()
+        assert cache.total_commits == 1
+        with Cache(path) as other:
+            assert other.fetch("foo") == "bar"
+        cache.put("foo", "baz")
+    with Cache(path) as cache:
+        assert cache.fetch("foo") == "baz"
+
+
+def test_cache_many(tmpdir):
+    path = str(tmpdir / "testcache.sqlite3")
+    keys = [f"key{i}" for i in range(2000)]
+    with Cache(path) as cache:
+        cache.put_many({key: key.upper() for key in keys[::2]})
+    with Cache(path, memory_size=10) as cache:
+        assert cache.preload(keys[:20]) == 10
+        found = cache.fetch_many(keys)
+        assert found == {key: key.upper() for key in keys[::2]}
+        assert cache.total_hits == 1000
+        assert cache.total_misses == 1000
+        assert cache.memory_hits == 10
+
+
+def test_comparisons_involving(tmpdir):
+    path = str(tmpdir / "testcache.sqlite3")
+    ab = ComparisonKey.build("p", "m", "s", "c", "b", "a")
+    bc = ComparisonKey.build("p", "m", "s", "c", "b", "c")
+    assert ab == ComparisonKey.build("p", "m", "s", "c", "a", "b")
+    assert ab.entry_key() != bc.entry_key()
+    with Cache(path) as cache:
+        cache.put_comparison(ab, "a")
+        cache.put_comparison(bc, "c")
+    with Cache(path) as cache:
+        assert cache.fetch(ab.entry_key()) == "a"
+        assert sorted(cache.comparisons_involving("b")) == [(ab, "a"), (bc, "c")]
+        assert cache.comparisons_involving("a") == [(ab, "a")]
@@ -0,0 +1,51 @@
+from rank_files.discovery import DiscoveryReport, SkipReason, discover_files, is_probably_text, remove_duplicates
+from rank_files.document import FileDocument, StrDocument
+
+
+def make_tree(root):
+    (root / "sub" / "deeper").mkdir(parents=True)
+    (root / "skip").mkdir()
+    (root / "a.txt").write_text("alpha", "utf8")
+    (root / "b.md").write_text("beta", "utf8")
+    (root / "empty.txt").write_text("", "utf8")
+    (root / "image.png").write_bytes(b"\x89PNG\r\n\x1a\n\0\0")
+    (root / "latin1.txt").write_bytes("caf\xe9".encode("latin1"))
+    (root / "sub" / "c.txt").write_text("gamma", "utf8")
+    (root / "sub" / "deeper" / "d.txt").write_text("delta" * 10, "utf8")
+    (root / "skip" / "e.txt").write_text("epsilon", "utf8")
+
+
+def test_discover_files(tmp_path):
+    make_tree(tmp_path)
+    report = DiscoveryReport()
+    assert discover_files(tmp_path, report=report) == [tmp_path / "a.txt", tmp_path / "b.md", tmp_path / "empty.txt"]
+    assert report.skipped == {SkipReason.BINARY: 2}
+    found = discover_files(tmp_path, recursive=True, exclude=["skip"], include=["*.txt"], min_size=1, max_size=20)
+    assert found == [tmp_path / "a.txt", tmp_path / "sub" / "c.txt"]
+    assert discover_files(tmp_path, recursive=True, include=["sub/*"]) == [tmp_path / "sub" / "c.txt", tmp_path / "sub" / "deeper" / "d.txt"]
+
+
+def test_is_probably_text(tmp_path):
+    path = tmp_path / "a.txt"
+    # A multi-byte character cut off by the end of the sniffed part is fine.
+    path.write_text("x" * 9 + "é", "utf8")
+    assert is_probably_text(path, sniff_bytes=10)
+    path.write_bytes(b"x\xff")
+    assert not is_probably_text(path)
+
+
+def test_remove_duplicates(tmp_path):
+    paths = []
+    for name, text in [("1", "same"), ("2", "diff"), ("3", "same"), ("4", "other text"), ("5", "same")]:
+        path = tmp_path / name
+        path.write_text(text, "utf8")
+        paths.append(path)
+    docs = [FileDocument(path) for path in paths]
+    report = DiscoveryReport()
+    assert remove_duplicates(docs, report) == [docs[0], docs[1], docs[3]]
+    assert [doc.path for doc in remove_duplicates(docs)] == [paths[0], paths[1], paths[3]]
+    assert report.duplicates_of(docs[0]) == [docs[2], docs[4]]
+    assert report.duplicates_of(docs[1]) == []
+    # Documents with unique sizes aren't hashed.
+    assert docs[3]._digest is None
+    assert remove_duplicates([StrDocument("x"), StrDocument("y")]) == [StrDocument("x"), StrDocument("y")]
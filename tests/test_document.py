@@ -0,0 +1,57 @@
+from rank_files.document import DigestMemo, FileDocument, StrDocument, TextBudget
+import os
+
+
+def test_file_document(tmp_path):
+    path = tmp_path / "a.txt"
+    path.write_text("<hello>", "utf8")
+    doc = FileDocument(path)
+    assert doc.read_text() == "<hello>"
+    path.write_text("changed", "utf8")
+    assert doc.read_text() == "<hello>"
+    assert doc.digest() == StrDocument("<hello>").digest()
+    assert doc == StrDocument("<hello>")
+    assert doc.memoized_text("upper", str.upper) == "<HELLO>"
+    doc.release()
+    assert doc.read_text() == "changed"
+    assert doc.memoized_text("upper", str.upper) == "CHANGED"
+
+
+def test_file_document_mmap(tmp_path):
+    path = tmp_path / "a.txt"
+    path.write_text("x" * 100, "utf8")
+    doc = FileDocument(path, mmap_threshold=10)
+    assert doc.read_text() == "x" * 100
+    assert doc == FileDocument(path)
+
+
+def test_text_budget(tmp_path):
+    budget = TextBudget(25)
+    docs = []
+    for i in range(3):
+        path = tmp_path / f"{i}.txt"
+        path.write_text(str(i) * 10, "utf8")
+        docs.append(FileDocument(path, budget))
+    docs[0].read_text()
+    docs[1].read_text()
+    docs[0].read_text()
+    docs[2].read_text()
+    assert docs[0]._text is not None
+    assert docs[1]._text is None
+    assert docs[2]._text is not None
+    assert budget.total_bytes == 20
+    assert docs[1].read_text() == "1" * 10
+    assert docs[0]._text is None
+
+
+def test_digest_memo(tmp_path):
+    path = tmp_path / "a.txt"
+    path.write_text("one", "utf8")
+    digests = DigestMemo()
+    assert FileDocument(path, digests=digests).digest() == StrDocument("one").digest()
+    assert FileDocument(path, digests=digests).digest() == StrDocument("one").digest()
+    assert digests.total_hits == 1
+    path.write_text("two", "utf8")
+    os.utime(path, ns=(0, 12345))
+    assert FileDocument(path, digests=digests).digest() == StrDocument("two").digest()
+    assert digests.total_hits == 1
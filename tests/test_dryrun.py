@@ -0,0 +1,81 @@
+from rank_files.algos import TopKAlgorithm, multiway_tournament_steps, top_k_steps, tournament, tournament_steps
+from rank_files.cache import Cache
+from rank_files.document import StrDocument
+from rank_files.dryrun import DryRunRanker
+from rank_files.ranker import ComparisonRecords, ModelProvider, SimulatedRanker, _ollama_legacy_cache_key, canonical_order
+from rank_files.sizing import DocumentReducer, ReducedDocument, ReductionStrategy
+
+
+def test_dry_run_counts_cached_and_uncached():
+    docs = [StrDocument(f"{i:02d}") for i in range(20, 0, -1)]
+    ranker = SimulatedRanker(cache=Cache(":memory:"))
+    dry = DryRunRanker(ranker.records)
+    items = dry.wrap_for_pairwise_comparison("crit", docs)
+    dry.run_steps(tournament_steps(3, items), lambda batch: [a < b for a, b in batch], concurrency=4)
+    assert (dry.total_cached, dry.total_inferred) == (0, 0)
+    assert dry.total_tokens > 0
+    # Batches of 8, 4, 4, 2 and 1 find the best in 6 rounds of up to 4 calls; the 7 comparisons
+    # for the runners-up are made one at a time.
+    assert (dry.total_uncached, dry.total_rounds) == (26, 13)
+
+    tournament(3, ranker.wrap_for_pairwise_comparison("crit", docs))
+    dry = DryRunRanker(ranker.records)
+    result = dry.run_steps(tournament_steps(3, dry.wrap_for_pairwise_comparison("crit", docs)), lambda batch: [a < b for a, b in batch])
+    assert dry.unwrap(result) == docs[-1:-4:-1]
+    assert (dry.total_cached, dry.total_uncached, dry.total_rounds) == (ranker.total_calls, 0, 0)
+    assert ranker.records.cache.total_hits == 0
+
+    more = docs + [StrDocument("00")]
+    dry = DryRunRanker(ranker.records)
+    dry.run_steps(top_k_steps(TopKAlgorithm.KNUTH, 3, dry.wrap_for_pairwise_comparison("crit", more)), lambda batch: [a < b for a, b in batch])
+    assert dry.total_cached > 0 and dry.total_uncached > 0
+
+
+def test_dry_run_without_cache():
+    docs = [StrDocument(str(i)) for i in range(9)]
+    dry = DryRunRanker(None)
+
+    def best_of(group):
+        best = dry.choose_best("crit", group)
+        return next(i for i, doc in enumerate(group) if doc is best)
+
+    dry.run_steps(multiway_tournament_steps(1, docs, 3), lambda batch: [best_of(group) for group in batch], concurrency=3)
+    assert (dry.total_uncached, dry.total_rounds) == (4, 2)
+
+
+def test_dry_run_does_not_summarize():
+    calls = []
+
+    def summarize(text, max_tokens):
+        calls.append(text)
+        return "summary"
+
+    reducer = DocumentReducer(20, ReductionStrategy.SUMMARY, summarize=summarize)
+    docs = reducer.wrap([StrDocument(f"{i} " + "word " * 1000) for i in range(4)])
+    assert all(isinstance(doc, ReducedDocument) for doc in docs)
+    dry = DryRunRanker(None)
+    dry.run_steps(tournament_steps(2, dry.wrap_for_pairwise_comparison("crit", docs)), lambda batch: [a < b for a, b in batch])
+    assert dry.total_uncached == 4 and dry.total_tokens > 0
+    # Every document would be summarized for the comparisons, though not by the dry run.
+    assert dry.total_summaries == 4
+    assert calls == []
+    # Once a summary is cached, its actual size is used.
+    assert docs[0].read_text() == "summary"
+    assert docs[0].byte_size() == len("summary")
+    assert len(calls) == 1
+
+
+def test_dry_run_finds_results_under_legacy_keys():
+    docs = [StrDocument(f"doc {i}") for i in range(8)]
+    cache = Cache(":memory:")
+    records = ComparisonRecords(cache, ModelProvider.OLLAMA, "m", _ollama_legacy_cache_key)
+    for i, a in enumerate(docs):
+        for b in docs[i + 1:]:
+            doc1, doc2 = canonical_order(a, b)
+            cache.put(_ollama_legacy_cache_key("m", "crit", doc1, doc2), "1" if doc1.text > doc2.text else "2")
+    dry = DryRunRanker(records)
+    result = dry.run_steps(tournament_steps(3, dry.wrap_for_pairwise_comparison("crit", docs)), lambda batch: [a < b for a, b in batch])
+    assert dry.unwrap(result) == docs[:-4:-1]
+    assert dry.total_uncached == 0 and dry.total_cached > 0
+    # Peeking doesn't copy the results to the new keys.
+    assert list(cache.comparisons_matching(records.provider, records.model, records.key("crit", docs[0], docs[1]).system_digest, records.key("crit", docs[0], docs[1]).criteria_digest)) == []
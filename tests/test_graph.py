@@ -0,0 +1,23 @@
+from rank_files.graph import ComparisonGraph, CyclePolicy
+
+
+def test_infer():
+    graph = ComparisonGraph()
+    graph.add("a", "b")
+    graph.add("b", "c")
+    graph.add("c", "d")
+    assert graph.infer("a", "d") == "a"
+    assert graph.infer("d", "a") == "a"
+    assert graph.chain_length("a", "d") == 3
+    assert graph.infer("a", "e") is None
+
+
+def test_cycles():
+    for policy, expected in [(CyclePolicy.ASK, None), (CyclePolicy.SHORTER, "a")]:
+        graph = ComparisonGraph(policy)
+        graph.add("a", "b")
+        graph.add("b", "c")
+        graph.add("c", "d")
+        graph.add("d", "e")
+        graph.add("e", "a")
+        assert graph.infer("a", "c") == expected
@@ -0,0 +1,75 @@
+from rank_files.cache import Cache
+from rank_files.cli import build_parser, run
+from rank_files.document import StrDocument, TextBudget
+from rank_files.prefilter import Prefilter, lexical_score, stability_report
+from rank_files.ranker import BudgetExceededError, FakeRanker, ModelProvider
+import io
+import pytest
+import threading
+
+
+def test_lexical_score():
+    criteria = "The best document explains how tides work."
+    assert lexical_score(criteria, "Tides work because of the moon.") > lexical_score(criteria, "The moon is bright.") == 0.0
+    # Repeating a word helps less and less, and longer texts are scaled down.
+    assert lexical_score(criteria, "tides tides") < 2 * lexical_score(criteria, "tides")
+    assert lexical_score(criteria, "tides " + "filler " * 1000) < lexical_score(criteria, "tides")
+    assert lexical_score("The best one.", "the best one") == 0.0
+
+
+def test_prefilter_scores_in_parallel_and_caches():
+    docs = [StrDocument(f"doc {i}") for i in [3, 9, 1, 7, 5]]
+    # Each call waits for all of them to start, so this only finishes if they run in parallel.
+    barrier = threading.Barrier(len(docs), timeout=10)
+    def score(criteria, doc):
+        barrier.wait()
+        return int(doc.read_text().split()[1])
+    with Cache(":memory:") as cache:
+        prefilter = Prefilter(2, score, "test", cache, concurrency=len(docs))
+        selection = prefilter.select("c", docs)
+        # The survivors keep their original order.
+        assert [doc.read_text() for doc in selection.docs] == ["doc 9", "doc 7"]
+        assert [selection.ranks[doc.digest()] for doc in docs] == [4, 1, 5, 2, 3]
+        assert (selection.total, selection.uncached, prefilter.total_scored) == (5, 0, 5)
+
+        prefilter.score = lambda criteria, doc: pytest.fail("scores should be cached")
+        assert prefilter.select("c", docs).docs == selection.docs
+        assert prefilter.scores("other", docs, cached_only=True) == [None] * 5
+        # With cached_only, unscored documents rank last.
+        partial = prefilter.select("other", docs[:1], cached_only=True)
+        assert (partial.docs, partial.uncached) == (docs[:1], 1)
+
+
+def test_stability_report():
+    docs = [StrDocument(str(i)) for i in range(40)]
+    prefilter = Prefilter(8, lambda criteria, doc: -int(doc.read_text()), "test")
+    selection = prefilter.select("c", docs)
+    report = stability_report(selection, [docs[0], docs[5]])
+    assert "kept 8 of 40" in report
+    assert "Ranks of the results by score: 1, 6." in report
+    assert "smaller m: 4: 1 of 2; 2: 1 of 2." in report
+    assert "a larger m may change the results" in report
+    assert "larger m" not in stability_report(selection, [docs[0], docs[1]])
+
+
+def test_model_scores_count_towards_the_budget(tmp_path):
+    for i in range(5):
+        (tmp_path / f"{i}.txt").write_text(f"document {i} " * 50, "utf8")
+    cache = Cache(":memory:")
+    prefilter = Prefilter(2, lambda criteria, doc: 1.0, "test", cache)
+    docs = [StrDocument(str(i)) for i in range(3)]
+    prefilter.select("c", docs[:1])
+    assert prefilter.pending("c", docs) == docs[1:]
+
+    def run_with(*options):
+        args = build_parser().parse_args(["c", str(tmp_path), "--prefilter", "2", "--prefilter-model", "m", "-q", *options])
+        out = io.StringIO()
+        run(args, cache, FakeRanker(), ModelProvider.FAKE, "m", TextBudget(10**6), out, io.StringIO())
+        return out.getvalue()
+
+    # The documents aren't scored at all if that would exceed the budget.
+    with pytest.raises(BudgetExceededError, match="Scoring 5 documents"):
+        run_with("--max-tokens", "100")
+    assert "plus 5 documents to score" in run_with("--dry-run")
+    run_with()
+    assert "documents to score" not in run_with("--dry-run")
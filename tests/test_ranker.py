@@ -1,6 +1,12 @@
+import asyncio
+import re
 import pytest
+import threading
+from types import SimpleNamespace
+from typing import Optional
+from rank_files.algos import tournament, tournament_async
 from rank_files.cache import Cache
-from rank_files.ranker import FakeRanker, ModelProvider, build_ranker
+from rank_files.ranker import _ollama_legacy_cache_key, AnthropicBatchRanker, BudgetExceededError, CallBudget, num_ctx_bucket, ollama_max_num_ctx, AnthropicRanker, InvalidLlmResponseError, RateLimitedError, SimulatedRanker, extract_listwise_response, extract_pointwise_response, listwise_group_size, PromptOrder, AsyncFakeRanker, AsyncOllamaRanker, FakeRanker, ModelProvider, OllamaRanker, build_async_ranker, build_ranker
 from rank_files.document import StrDocument
 
 
@@ -11,6 +17,9 @@ def test_fake_ranker():
     doc1 = StrDocument("foo")
     doc2 = StrDocument("bar")
     assert FakeRanker().choose_better("just pick one", doc1, doc2) is doc2
+    assert FakeRanker().summarize("just pick one", "a b c d", 2) == "a b"
+    assert FakeRanker().score("just pick one", doc2) >= FakeRanker().score("just pick one", doc1)
+    assert FakeRanker().score("just pick one", StrDocument("\U0001F600")) == 1
 
 
 def test_wrap_for_pairwise_comparison():
@@ -24,6 +33,296 @@ def test_wrap_for_pairwise_comparison():
     assert FakeRanker().unwrap(sorted(docs)) == [doc1, doc2]
 
 
+def test_async_fake_ranker():
+    docs = [StrDocument(x) for x in ["foo", "bar", "baz", "qux"]]
+    ranker = AsyncFakeRanker()
+    assert asyncio.run(ranker.choose_better("just pick one", docs[0], docs[1])) is docs[1]
+    wrapped = ranker.wrap_for_pairwise_comparison("just pick one", docs)
+    result = ranker.unwrap(asyncio.run(tournament_async(2, wrapped)))
+    assert [str(doc) for doc in result] == ["bar", "baz"]
+
+
+class FakeOllamaClient:
+    def __init__(self, content: str, modelinfo: Optional[dict] = None, load_seconds: float = 0.0) -> None:
+        self.content = content
+        self.modelinfo = {} if modelinfo is None else modelinfo
+        self.load_seconds = load_seconds
+        self.calls = 0
+        self.options = []
+
+    def chat(self, model, messages, options, keep_alive=None):
+        self.calls += 1
+        self.options.append(options)
+        return SimpleNamespace(message=SimpleNamespace(content=self.content), load_duration=int(self.load_seconds * 1e9))
+
+    def show(self, model):
+        return SimpleNamespace(modelinfo=self.modelinfo)
+
+
+class FakeAsyncOllamaClient(FakeOllamaClient):
+    async def chat(self, model, messages, options, keep_alive=None):
+        return super().chat(model, messages, options, keep_alive)
+
+    async def show(self, model):
+        return super().show(model)
+
+
+def test_sync_and_async_rankers_share_cache():
+    doc1 = StrDocument("foo")
+    doc2 = StrDocument("bar")
+    cache = Cache(":memory:")
+    sync_client = FakeOllamaClient("1")
+    assert OllamaRanker("m", cache, sync_client).choose_better("c", doc1, doc2) is doc2
+    async_client = FakeAsyncOllamaClient("2")
+    async_ranker = AsyncOllamaRanker("m", cache, async_client)
+    assert asyncio.run(async_ranker.choose_better("c", doc1, doc2)) is doc2
+    assert async_client.calls == 0
+    assert cache.total_hits == 1
+
+
+class ThreadRecordingCache(Cache):
+    """Records the threads that fetch from and write to the cache."""
+    def __init__(self) -> None:
+        super().__init__(":memory:")
+        self.threads = set()
+
+    def fetch(self, *args, **kwargs):
+        self.threads.add(threading.get_ident())
+        return super().fetch(*args, **kwargs)
+
+    def put_many(self, entries):
+        self.threads.add(threading.get_ident())
+        super().put_many(entries)
+
+
+def test_async_ranker_uses_cache_off_the_event_loop():
+    cache = ThreadRecordingCache()
+    ranker = AsyncOllamaRanker("m", cache, FakeAsyncOllamaClient("1"))
+    doc1, doc2 = StrDocument("foo"), StrDocument("bar")
+    assert asyncio.run(ranker.choose_better("c", doc1, doc2)) is doc2
+    assert asyncio.run(ranker.choose_better("c", doc1, doc2)) is doc2
+    assert cache.threads
+    assert threading.get_ident() not in cache.threads
+
+
+def alphabetical_answer(params) -> SimpleNamespace:
+    prompt = "".join(block["text"] for block in params["messages"][0]["content"])
+    text1 = prompt.split("<document-1>")[1].split("</document-1>")[0]
+    text2 = prompt.split("<document-2>")[1].split("</document-2>")[0]
+    return SimpleNamespace(content=[SimpleNamespace(text="1" if text1 < text2 else "2")])
+
+
+class FakeBatches:
+    """
+    Answers every request by picking the document whose text comes first alphabetically,
+    except that the first request of each batch errors if fail_first is set.
+    """
+    def __init__(self, polls_until_done: int = 1, fail_first: bool = False) -> None:
+        self.polls_until_done = polls_until_done
+        self.fail_first = fail_first
+        self.batches = {}
+        self.polls = 0
+
+    def create(self, requests):
+        batch_id = f"batch-{len(self.batches)}"
+        self.batches[batch_id] = requests
+        return SimpleNamespace(id=batch_id, processing_status="in_progress")
+
+    def retrieve(self, batch_id):
+        self.polls += 1
+        status = "ended" if self.polls >= self.polls_until_done else "in_progress"
+        return SimpleNamespace(id=batch_id, processing_status=status)
+
+    def results(self, batch_id):
+        for i, request in enumerate(self.batches[batch_id]):
+            if i == 0 and self.fail_first:
+                yield SimpleNamespace(custom_id=request["custom_id"], result=SimpleNamespace(type="errored"))
+                continue
+            message = alphabetical_answer(request["params"])
+            yield SimpleNamespace(custom_id=request["custom_id"], result=SimpleNamespace(type="succeeded", message=message))
+
+
+class FakeAnthropicClient:
+    """Answers individual requests like FakeBatches, and counts them."""
+    def __init__(self, batches: FakeBatches) -> None:
+        self.messages = SimpleNamespace(batches=batches, create=self.create)
+        self.direct = 0
+
+    def create(self, **params):
+        self.direct += 1
+        return alphabetical_answer(params)
+
+
+def test_anthropic_batch_ranker():
+    docs = [StrDocument(f"doc {i:02}") for i in range(20)]
+    batches = FakeBatches()
+    client = FakeAnthropicClient(batches)
+    ranker = AnthropicBatchRanker("m", Cache(":memory:"), client, poll_interval=0)
+    wrapped = ranker.wrap_for_pairwise_comparison("c", docs)
+    result = ranker.unwrap(tournament(3, wrapped, prefetch=ranker.prefetch_wrapped))
+    assert result == docs[:3]
+    # Every round of the first-place phase but the final is a batch; single pairs go direct.
+    assert len(batches.batches) == 4
+    assert len(batches.batches["batch-0"]) == 8
+    assert all(len(requests) >= 2 for requests in batches.batches.values())
+    assert client.direct > 0
+
+
+def test_anthropic_batch_ranker_charges_failed_entries_once():
+    docs = [StrDocument(f"doc {i:02}") for i in range(20)]
+    batches = FakeBatches(fail_first=True)
+    client = FakeAnthropicClient(batches)
+    ranker = AnthropicBatchRanker("m", Cache(":memory:"), client, poll_interval=0)
+    budget = CallBudget()
+    ranker.records.budget = budget
+    wrapped = ranker.wrap_for_pairwise_comparison("c", docs)
+    assert ranker.unwrap(tournament(3, wrapped, prefetch=ranker.prefetch_wrapped)) == docs[:3]
+    batched = sum(len(requests) for requests in batches.batches.values())
+    assert budget.total_calls == batched + client.direct - len(batches.batches)
+
+
+def test_anthropic_batch_ranker_resumes():
+    docs = [StrDocument(f"doc {i}") for i in range(4)]
+    pairs = [(docs[0], docs[1]), (docs[2], docs[3])]
+    cache = Cache(":memory:")
+    batches = FakeBatches(polls_until_done=3)
+
+    def interrupt(seconds):
+        raise KeyboardInterrupt()
+
+    ranker = AnthropicBatchRanker("m", cache, FakeAnthropicClient(batches), poll_interval=0)
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr("rank_files.ranker.time.sleep", interrupt)
+        with pytest.raises(KeyboardInterrupt):
+            ranker.prefetch("c", pairs)
+    ranker = AnthropicBatchRanker("m", cache, FakeAnthropicClient(batches), poll_interval=0)
+    ranker.prefetch("c", pairs)
+    assert list(batches.batches) == ["batch-0"]
+    assert ranker.choose_better("c", docs[0], docs[1]) is docs[0]
+    assert ranker.choose_better("c", docs[3], docs[2]) is docs[2]
+
+
+def test_prompt_order():
+    a, b, c, d = [StrDocument(x) for x in "abcd"]
+    order = PromptOrder()
+    assert order.arrange(a, b) == (a, b)
+    assert order.arrange(c, b) == (b, c)
+    assert order.arrange(c, b) == (b, c)
+    assert order.arrange(a, d) == (a, d)
+    assert order.arrange(c, d) == (d, c)
+
+
+class AlphabeticalAnthropicClient:
+    """Picks the document whose text comes first alphabetically, and records the prompts."""
+    def __init__(self) -> None:
+        self.messages = SimpleNamespace(create=self.create)
+        self.prompts = []
+
+    def create(self, **params):
+        blocks = params["messages"][0]["content"]
+        assert blocks[0]["cache_control"] == {"type": "ephemeral"}
+        prompt = "".join(block["text"] for block in blocks)
+        self.prompts.append(prompt)
+        text1 = prompt.split("<document-1>")[1].split("</document-1>")[0]
+        text2 = prompt.split("<document-2>")[1].split("</document-2>")[0]
+        return SimpleNamespace(content=[SimpleNamespace(text="1" if text1 < text2 else "2")])
+
+
+def test_anthropic_ranker_puts_repeated_document_first():
+    docs = [StrDocument(x) for x in ["b", "c", "a"]]
+    cache = Cache(":memory:")
+    client = AlphabeticalAnthropicClient()
+    ranker = AnthropicRanker("m", cache, client)
+    assert ranker.choose_better("c", docs[0], docs[1]) is docs[0]
+    assert ranker.choose_better("c", docs[0], docs[2]) is docs[2]
+    assert client.prompts[1].startswith("<criteria>c</criteria>\n<document-1>b</document-1>")
+    # The swapped response was cached under the same key as if "a" had been presented first.
+    assert AnthropicRanker("m", cache, FakeAnthropicClient(FakeBatches())).choose_better("c", docs[2], docs[0]) is docs[2]
+
+
+def test_legacy_cache_entries_are_migrated():
+    doc1 = StrDocument("bar")
+    doc2 = StrDocument("foo")
+    cache = Cache(":memory:")
+    cache.put(_ollama_legacy_cache_key("m", "c", doc1, doc2), "2")
+    client = FakeOllamaClient("1")
+    ranker = OllamaRanker("m", cache, client)
+    assert ranker.choose_better("c", doc2, doc1) is doc2
+    assert client.calls == 0
+    [(key, winner)] = cache.comparisons_involving(doc1.digest())
+    assert key.model == "m"
+    assert winner == doc2.digest()
+    assert cache.total_hits == 1
+
+
+def test_ranker_infers_transitive_results():
+    docs = [StrDocument(x) for x in "abc"]
+    cache = Cache(":memory:")
+    client = FakeOllamaClient("1")
+    ranker = OllamaRanker("m", cache, client)
+    assert ranker.choose_better("c", docs[0], docs[1]) is docs[0]
+    assert ranker.choose_better("c", docs[1], docs[2]) is docs[1]
+    assert client.calls == 2
+    assert ranker.choose_better("c", docs[2], docs[0]) is docs[0]
+    assert client.calls == 2
+    assert ranker.records.total_inferred == 1
+    # A new ranker loads the earlier results from the cache.
+    ranker = OllamaRanker("m", cache, client)
+    assert ranker.choose_better("c", docs[2], docs[0]) is docs[0]
+    assert client.calls == 2
+    # Results for other criteria aren't used.
+    assert ranker.choose_better("other", docs[2], docs[0]) is docs[0]
+    assert client.calls == 3
+    ranker = OllamaRanker("m", cache, client, infer=False)
+    ranker.choose_better("c", docs[2], docs[0])
+    assert client.calls == 4
+
+
+
+def test_num_ctx_bucket():
+    assert num_ctx_bucket(10) == 2048
+    assert num_ctx_bucket(2048) == 2048
+    assert num_ctx_bucket(2049) == 4096
+    assert num_ctx_bucket(20000) == 32768
+    assert num_ctx_bucket(20000, max_num_ctx=16384) == 16384
+
+
+def test_ollama_max_num_ctx():
+    info = {"llama.context_length": 131072, "llama.block_count": 32, "llama.attention.head_count_kv": 8, "llama.embedding_length": 4096, "llama.attention.head_count": 32}
+    # 128 KiB of KV cache per token; 2 GiB of memory allows a 1 GiB cache.
+    assert ollama_max_num_ctx(info, 2 * 1024 ** 3) == 8192
+    assert ollama_max_num_ctx(info, 1024 ** 4) == 131072
+    assert ollama_max_num_ctx(info, None) == 131072
+    assert ollama_max_num_ctx({}, 1024 ** 3) is None
+
+
+def test_ollama_ranker_never_lowers_num_ctx():
+    small = [StrDocument(x) for x in "ab"]
+    large = [StrDocument(x * 5000) for x in "cd"]
+    client = FakeOllamaClient("1", modelinfo={"m.context_length": 8192}, load_seconds=1.5)
+    ranker = OllamaRanker("m", Cache(":memory:"), client)
+    ranker.choose_better("c", *small)
+    ranker.choose_better("c", *large)
+    ranker.choose_better("c", small[0], large[0])
+    ranker.choose_better("c", small[1], large[1])
+    assert [options["num_ctx"] for options in client.options] == [2048, 8192, 8192, 8192]
+    assert ranker.context.total_resizes == 1
+    assert ranker.context.total_loads == 4
+    assert ranker.context.total_load_seconds == pytest.approx(6.0)
+
+
+def test_ollama_ranker_schedule_and_warm_up():
+    docs = [StrDocument(x * size) for x, size in zip("abcd", [5000, 1, 5000, 1])]
+    client = FakeOllamaClient("1")
+    ranker = OllamaRanker("m", Cache(":memory:"), client, max_num_ctx=4096)
+    pairs = [(docs[0], docs[2]), (docs[1], docs[3])]
+    assert ranker.schedule("c", pairs) == [1, 0]
+    ranker.warm_up(100000)
+    assert client.options == [{"num_ctx": 4096}]
+    # Once the model is loaded with the largest num_ctx, the order doesn't matter.
+    assert ranker.schedule("c", pairs) == [0, 1]
+
+
 @mark_ollama
 def test_ollama_ranker():
     criteria = "The best document is the one with the most spelling errors."
@@ -44,3 +343,160 @@ def test_anthropic_ranker():
     assert ranker.choose_better(criteria, doc1, doc2) is doc1
     assert ranker.choose_better(criteria, doc2, doc1) is doc1
     assert ranker.cache.total_hits == 1
+
+
+@mark_ollama
+def test_async_ollama_ranker():
+    criteria = "The best document is the one with the most spelling errors."
+    doc1 = StrDocument("In the long run, were all ded.")
+    doc2 = StrDocument("In the long run, we're all dead.")
+    ranker = build_async_ranker(ModelProvider.OLLAMA, cache=Cache(":memory:"))
+    assert asyncio.run(ranker.choose_better(criteria, doc1, doc2)) is doc1
+
+
+@mark_anthropic
+def test_async_anthropic_ranker():
+    criteria = "The best document is the one with the most spelling errors."
+    doc1 = StrDocument("In the long run, were all ded.")
+    doc2 = StrDocument("In the long run, we're all dead.")
+    ranker = build_async_ranker(ModelProvider.ANTHROPIC, cache=Cache(":memory:"))
+    assert asyncio.run(ranker.choose_better(criteria, doc1, doc2)) is doc1
+
+
+class ListwiseAnthropicClient:
+    """Answers listwise prompts with the number of the alphabetically first document."""
+    def __init__(self):
+        self.calls = []
+        self.messages = SimpleNamespace(create=self.create)
+
+    def create(self, **params):
+        self.calls.append(params)
+        content = params["messages"][0]["content"]
+        texts = re.findall(r"<document-\d+>(.*?)</document-\d+>", content)
+        best = texts.index(min(texts)) + 1
+        return SimpleNamespace(content=[SimpleNamespace(text=str(best))])
+
+
+def test_listwise_response():
+    docs = [StrDocument("a"), StrDocument("b"), StrDocument("c")]
+    assert extract_listwise_response(docs, "2") is docs[1]
+    assert extract_listwise_response(docs, " 3\n") is docs[2]
+    for bad in ["0", "4", "two", ""]:
+        with pytest.raises(InvalidLlmResponseError):
+            extract_listwise_response(docs, bad)
+
+
+def test_pointwise_response():
+    doc = StrDocument("a")
+    assert extract_pointwise_response(doc, "7") == 7
+    assert extract_pointwise_response(doc, " 10\n") == 10
+    for bad in ["0", "11", "seven", ""]:
+        with pytest.raises(InvalidLlmResponseError):
+            extract_pointwise_response(doc, bad)
+
+
+def test_anthropic_ranker_choose_best():
+    client = ListwiseAnthropicClient()
+    cache = Cache(":memory:")
+    ranker = AnthropicRanker("test-model", cache, client=client)
+    docs = [StrDocument(t) for t in ["pear", "apple", "fig", "kiwi"]]
+    assert ranker.choose_best("crit", docs).text == "apple"
+    assert len(client.calls) == 1
+    assert "<document-4>" in client.calls[0]["messages"][0]["content"]
+    assert ranker.choose_best("crit", list(reversed(docs))).text == "apple"
+    assert len(client.calls) == 1
+
+
+def test_listwise_group_size():
+    docs = [StrDocument("x" * 2000), StrDocument("y" * 200)]
+    assert listwise_group_size(docs, None) == 8
+    assert listwise_group_size(docs, 200000) == 8
+    assert listwise_group_size(docs, 3000) == 2
+    assert 2 < listwise_group_size(docs, 5000) < 8
+
+
+def test_simulated_ranker():
+    docs = [StrDocument(t) for t in ["b", "a", "d", "c"]]
+    ranker = SimulatedRanker()
+    assert ranker.unwrap(tournament(2, ranker.wrap_for_pairwise_comparison("crit", docs))) == [docs[1], docs[0]]
+    biased = SimulatedRanker(position_bias=1.0)
+    assert biased.choose_better("crit", docs[2], docs[3]) is docs[3]
+    wrong = SimulatedRanker(error_rate=1.0)
+    assert wrong.choose_better("crit", docs[0], docs[1]) is docs[0]
+    with pytest.raises(RateLimitedError):
+        SimulatedRanker(rate_limit_rate=1.0).choose_better("crit", docs[0], docs[1])
+
+
+def test_simulated_ranker_is_consistent_and_cached():
+    docs = [StrDocument(str(i)) for i in range(20)]
+    cache = Cache(":memory:")
+    ranker = SimulatedRanker(error_rate=0.3, cache=cache, seed=1)
+    first = [ranker.choose_better("crit", a, b) for a, b in zip(docs, docs[1:])]
+    assert ranker.total_calls == 19
+    other = SimulatedRanker(error_rate=0.3, seed=1)
+    assert [other.choose_better("crit", a, b) for a, b in zip(docs, docs[1:])] == first
+    assert [ranker.choose_better("crit", a, b) for a, b in zip(docs, docs[1:])] == first
+    assert ranker.total_calls == 19
+    assert cache.total_hits == 19
+
+
+def test_call_budget_counts_only_model_calls():
+    docs = [StrDocument(str(i)) for i in range(10)]
+    ranker = SimulatedRanker(cache=Cache(":memory:"))
+    ranker.records.budget = CallBudget(max_calls=5)
+    with pytest.raises(BudgetExceededError) as info:
+        tournament(3, ranker.wrap_for_pairwise_comparison("crit", docs))
+    assert info.value.limit == "calls"
+    assert ranker.total_calls == 5
+    ranker.records.budget = CallBudget(max_calls=ranker.total_calls + 12)
+    tournament(3, ranker.wrap_for_pairwise_comparison("crit", docs))
+    # Cached comparisons are free, so a rerun costs nothing.
+    ranker.records.budget = CallBudget(max_calls=0, max_tokens=0)
+    tournament(3, ranker.wrap_for_pairwise_comparison("crit", docs))
+    budget = CallBudget(max_tokens=100, max_cost=0.01, price=200)
+    budget.charge(40)
+    with pytest.raises(BudgetExceededError) as info:
+        budget.charge(20)
+    assert info.value.limit == "cost"
+    with pytest.raises(BudgetExceededError) as info:
+        budget.charge(70)
+    assert info.value.limit == "tokens"
+    assert (budget.total_calls, budget.total_tokens) == (1, 40)
+    # Other calls count towards the tokens and cost, but not the number of comparisons.
+    budget = CallBudget(max_calls=0, max_tokens=100)
+    budget.charge(60, comparison=False)
+    with pytest.raises(BudgetExceededError):
+        budget.charge(60, comparison=False)
+    assert (budget.total_calls, budget.total_other_calls, budget.total_tokens) == (0, 1, 60)
+
+
+def test_summaries_are_charged():
+    ranker = OllamaRanker("m", Cache(":memory:"), FakeOllamaClient("short"))
+    ranker.records.budget = CallBudget(max_calls=0)
+    assert ranker.summarize("c", "a long text", 10) == "short"
+    assert ranker.records.budget.total_other_calls == 1
+    ranker.records.budget = CallBudget(max_tokens=1)
+    with pytest.raises(BudgetExceededError):
+        ranker.summarize("c", "a long text", 10)
+    with pytest.raises(BudgetExceededError):
+        ranker.score("c", StrDocument("a document"))
+
+
+def test_wrapped_hooks_group_pairs_by_criteria():
+    class RecordingRanker(FakeRanker):
+        def __init__(self) -> None:
+            self.prefetched = []
+
+        def prefetch(self, criteria, pairs):
+            self.prefetched.append((criteria, [(str(a), str(b)) for a, b in pairs]))
+
+        def schedule(self, criteria, pairs):
+            return list(reversed(range(len(pairs))))
+
+    ranker = RecordingRanker()
+    a = ranker.wrap_for_pairwise_comparison("a", [StrDocument(x) for x in "wxyz"])
+    b = ranker.wrap_for_pairwise_comparison("b", [StrDocument(x) for x in "wx"])
+    pairs = [(a[0], a[1]), (b[0], b[1]), (a[2], a[3])]
+    ranker.prefetch_wrapped(pairs)
+    assert ranker.prefetched == [("a", [("w", "x"), ("y", "z")]), ("b", [("w", "x")])]
+    assert ranker.schedule_wrapped(pairs) == [2, 0, 1]
@@ -0,0 +1,203 @@
+from rank_files.algos import tournament
+from rank_files.cache import Cache
+from rank_files.document import StrDocument
+from rank_files.ranker import AnthropicRanker, AsyncAnthropicRanker, SimulatedRanker
+from rank_files.scheduler import AdaptiveConcurrency, InvalidLlmResponseError, RateLimitedError, RequestScheduler, RetryKind, TokenBucket, classify_error
+from types import SimpleNamespace
+import asyncio
+import pytest
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+    async def async_sleep(self, seconds: float) -> None:
+        self.sleep(seconds)
+
+
+class StatusError(Exception):
+    def __init__(self, status_code: int, headers: dict = {}) -> None:
+        self.status_code = status_code
+        self.response = SimpleNamespace(headers=headers)
+
+
+class TimeoutException(Exception):
+    pass
+
+
+def test_classify_error():
+    assert classify_error(InvalidLlmResponseError()) == RetryKind.INVALID
+    assert classify_error(RateLimitedError()) == RetryKind.THROTTLED
+    assert classify_error(StatusError(529)) == RetryKind.THROTTLED
+    assert classify_error(type("ReadTimeout", (TimeoutException,), {})()) == RetryKind.THROTTLED
+    assert classify_error(StatusError(500)) == RetryKind.TRANSIENT
+    assert classify_error(ConnectionRefusedError()) == RetryKind.TRANSIENT
+    assert classify_error(StatusError(401)) is None
+    assert classify_error(ValueError()) is None
+
+
+def test_token_bucket():
+    clock = FakeClock()
+    bucket = TokenBucket(60, clock=clock, sleep=clock.sleep)
+    assert bucket.acquire(60) == 0
+    assert bucket.acquire(1) == pytest.approx(1.0)
+    assert bucket.reserve(2) == pytest.approx(2.0)
+    clock.now += 10
+    assert bucket.reserve(1) == 0
+    # More than the capacity is treated as the capacity.
+    clock.now += 60
+    assert bucket.reserve(1000) == 0
+
+
+def test_adaptive_concurrency():
+    limiter = AdaptiveConcurrency(max_limit=8)
+    for _ in range(8):
+        limiter.acquire()
+    limiter.release(throttled=True)
+    assert (limiter.limit, limiter.total_decreases) == (4, 1)
+    # The other requests were sent before the decrease, so their failures don't count again.
+    for _ in range(7):
+        limiter.release(throttled=True)
+    assert limiter.limit == 4
+    for _ in range(8):
+        limiter.acquire()
+        limiter.release(latency=1.0)
+    assert limiter.limit == 5
+    # Latency rising sharply also counts as overload.
+    for _ in range(5):
+        limiter.acquire()
+    for _ in range(5):
+        limiter.release(latency=10.0)
+    assert (limiter.limit, limiter.total_decreases) == (2, 2)
+
+
+def test_scheduler_retries_with_backoff():
+    clock = FakeClock()
+    scheduler = RequestScheduler(max_attempts=4, base_delay=1.0, seed=0, clock=clock, sleep=clock.sleep)
+    failures = [RateLimitedError(), StatusError(500), StatusError(429, {"retry-after": "7"})]
+    def request(swap):
+        if failures:
+            raise failures.pop(0)
+        return "ok"
+    assert scheduler.call(request) == "ok"
+    assert (scheduler.total_requests, scheduler.total_retries, scheduler.total_throttled) == (4, 3, 2)
+    assert 0 <= clock.sleeps[0] <= 1 and 0 <= clock.sleeps[1] <= 2
+    assert clock.sleeps[2] == 7
+
+    failures = [StatusError(503)] * 4
+    with pytest.raises(StatusError):
+        scheduler.call(request)
+    with pytest.raises(ValueError):
+        scheduler.call(lambda swap: int("x"))
+
+
+def test_scheduler_swaps_documents_after_malformed_response():
+    scheduler = RequestScheduler(max_invalid_attempts=3)
+    swaps = []
+    def request(swap):
+        swaps.append(swap)
+        if len(swaps) < 3:
+            raise InvalidLlmResponseError()
+        return swap
+    assert scheduler.call(request) is False
+    assert swaps == [False, True, False]
+    assert scheduler.total_invalid == 2
+    def garbled(swap):
+        raise InvalidLlmResponseError()
+    with pytest.raises(InvalidLlmResponseError):
+        scheduler.call(garbled)
+    assert scheduler.total_invalid == 5
+
+
+def test_scheduler_rate_limits():
+    clock = FakeClock()
+    scheduler = RequestScheduler(requests_per_minute=60, tokens_per_minute=600, clock=clock, sleep=clock.sleep)
+    for _ in range(3):
+        scheduler.call(lambda swap: None, tokens=300)
+    # The token limit allows two of these at once, and then one every 30 seconds.
+    assert clock.sleeps == [pytest.approx(30.0)]
+
+
+class GarblingAnthropicClient:
+    """Answers pairwise prompts about "b" before "a" with nonsense."""
+    def __init__(self) -> None:
+        self.messages = SimpleNamespace(create=self.create)
+        self.prompts = []
+
+    def create(self, **params):
+        prompt = "".join(block["text"] for block in params["messages"][0]["content"])
+        self.prompts.append(prompt)
+        text1 = prompt.split("<document-1>")[1].split("</document-1>")[0]
+        text2 = prompt.split("<document-2>")[1].split("</document-2>")[0]
+        if text1 > text2:
+            return SimpleNamespace(content=[SimpleNamespace(text="Document 2, clearly")])
+        return SimpleNamespace(content=[SimpleNamespace(text="1")])
+
+
+def test_ranker_asks_again_with_documents_swapped():
+    client = GarblingAnthropicClient()
+    ranker = AnthropicRanker("m", Cache(":memory:"), client)
+    # Present "b" first.
+    ranker.prompt_order = SimpleNamespace(arrange=lambda doc1, doc2: tuple(sorted([doc1, doc2], key=lambda doc: doc.text, reverse=True)))
+    docs = [StrDocument("b"), StrDocument("a")]
+    assert ranker.choose_better("c", docs[0], docs[1]) is docs[1]
+    assert [prompt.split("<document-1>")[1][0] for prompt in client.prompts] == ["b", "a"]
+    assert ranker.scheduler.total_invalid == 1
+
+
+class AsyncGarblingAnthropicClient(GarblingAnthropicClient):
+    """Like GarblingAnthropicClient, but async, and the first request is rate-limited."""
+    async def create(self, **params):
+        if not self.prompts:
+            self.prompts.append(None)
+            raise StatusError(429, {"retry-after": "2"})
+        return super().create(**params)
+
+
+def test_async_ranker_retries_through_the_scheduler():
+    client = AsyncGarblingAnthropicClient()
+    clock = FakeClock()
+    scheduler = RequestScheduler(clock=clock, sleep=clock.sleep, async_sleep=clock.async_sleep)
+    ranker = AsyncAnthropicRanker("m", Cache(":memory:"), client, scheduler=scheduler)
+    ranker.prompt_order = SimpleNamespace(arrange=lambda doc1, doc2: tuple(sorted([doc1, doc2], key=lambda doc: doc.text, reverse=True)))
+    docs = [StrDocument("b"), StrDocument("a")]
+    assert asyncio.run(ranker.choose_better("c", docs[0], docs[1])) is docs[1]
+    assert [prompt.split("<document-1>")[1][0] for prompt in client.prompts[1:]] == ["b", "a"]
+    assert clock.sleeps == [2.0]
+    assert (scheduler.total_requests, scheduler.total_throttled, scheduler.total_invalid) == (3, 1, 1)
+
+
+def test_adaptive_concurrency_async_acquire():
+    limiter = AdaptiveConcurrency(max_limit=1)
+    order = []
+
+    async def request(name: str) -> None:
+        await limiter.async_acquire()
+        order.append(f"{name} started")
+        await asyncio.sleep(0)
+        order.append(f"{name} finished")
+        limiter.release(latency=1.0)
+
+    async def main() -> None:
+        await asyncio.gather(request("a"), request("b"))
+
+    asyncio.run(main())
+    assert order == ["a started", "a finished", "b started", "b finished"]
+
+
+def test_simulated_ranker_survives_rate_limits():
+    docs = [StrDocument(f"{i:02d}") for i in range(30, 0, -1)]
+    scheduler = RequestScheduler(max_attempts=50, base_delay=0.0001, seed=0)
+    ranker = SimulatedRanker(rate_limit_rate=0.3, cache=Cache(":memory:"), scheduler=scheduler)
+    result = ranker.unwrap(tournament(3, ranker.wrap_for_pairwise_comparison("c", docs), concurrency=4))
+    assert [doc.text for doc in result] == ["01", "02", "03"]
+    assert scheduler.total_throttled == ranker.total_rate_limited > 0
@@ -0,0 +1,73 @@
+from rank_files.cache import Cache
+from rank_files.cli import build_parser
+from rank_files.client import ServerClient, job_args, run_on_server
+from rank_files.ranker import ModelProvider
+from rank_files.server import JobCancelledError, JobProgress, JobStatus, RankingServer, ServerJob, _UnixHTTPServer
+import io
+import pytest
+import threading
+
+
+def make_docs(root):
+    root.mkdir()
+    for i, text in enumerate("dbeac"):
+        (root / f"{i}.txt").write_text(text, "utf8")
+
+
+def test_server(tmp_path, monkeypatch):
+    make_docs(tmp_path / "docs")
+    socket_path = str(tmp_path / "s.sock")
+    with Cache(":memory:") as cache:
+        ranking = RankingServer(cache)
+        httpd = _UnixHTTPServer(socket_path, ranking)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        try:
+            client = ServerClient(socket_path)
+            assert client.status() == {"cache": ":memory:", "unfinished_jobs": 0}
+            args = build_parser().parse_args(["c", str(tmp_path / "docs"), "-k", "2", "-q"])
+            job_id = client.submit(job_args(args), ModelProvider.FAKE, "m", ":memory:")
+            events = list(client.stream(job_id))
+            assert "".join(event.get("out", "") for event in events) == "3.txt\n1.txt\n"
+            assert events[-1] == {"status": "done", "error": None}
+            assert client.poll(job_id)["status"] == "done"
+            assert client.poll(job_id, since=len(events) - 1)["events"] == []
+
+            monkeypatch.setenv("RANK_FILES_SERVER", socket_path)
+            out = io.StringIO()
+            assert run_on_server(args, ModelProvider.FAKE, "m", ":memory:", out, io.StringIO()) == 0
+            assert out.getvalue() == "3.txt\n1.txt\n"
+            # The second job didn't hash the files again.
+            assert ranking.digests.total_hits == 5
+            assert run_on_server(args, ModelProvider.FAKE, "m", str(tmp_path / "other.sqlite3"), out, io.StringIO()) is None
+
+            # The client's limit on comparisons applies, not the server's.
+            limited = build_parser().parse_args(["c", str(tmp_path / "docs"), "-k", "2", "-q", "--restart"])
+            limited.max_comparisons = 2
+            err = io.StringIO()
+            assert run_on_server(limited, ModelProvider.FAKE, "m", ":memory:", out, err) == 1
+            assert "the limit is 2 model calls" in err.getvalue()
+
+            args.input_dir = str(tmp_path / "missing")
+            err = io.StringIO()
+            assert run_on_server(args, ModelProvider.FAKE, "m", ":memory:", out, err) == 1
+            assert "FileNotFoundError" in err.getvalue()
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+            ranking.close()
+
+
+def test_job_cancellation():
+    args = build_parser().parse_args(["c", "."])
+    job = ServerJob("j", args, ModelProvider.FAKE, "m")
+    progress = JobProgress(job, 10)
+    progress.update()
+    job.cancel_requested.set()
+    with pytest.raises(JobCancelledError):
+        progress.update()
+    assert job.events == [{"total": 10}, {"progress": 1}]
+    with Cache(":memory:") as cache:
+        ranking = RankingServer(cache)
+        ranking.run_job(job)
+        ranking.close()
+    assert job.status == JobStatus.CANCELLED
@@ -0,0 +1,69 @@
+from hypothesis import given, strategies as st
+from rank_files.cache import Cache
+from rank_files.cli import build_parser, build_reducer
+from rank_files.document import StrDocument
+from rank_files.ranker import FakeRanker, SimulatedRanker
+from rank_files.sizing import DocumentReducer, ReducedDocument, ReductionStrategy, count_tokens, truncate_head, truncate_head_tail, truncate_tail
+import pytest
+
+
+def test_count_tokens():
+    assert count_tokens("") == 0
+    assert count_tokens("Hi, there!") == 5
+    assert count_tokens("extraordinarily") == 4
+    # Each character of text written without spaces, such as Chinese, is at least one token.
+    assert count_tokens("文本" * 250) == 500
+    assert count_tokens("café") == 2
+    assert truncate_head("文本文本", 3) == "文本文"
+
+
+@given(st.text(), st.integers(min_value=4, max_value=200))
+def test_truncation_fits_budget(text, max_tokens):
+    head = truncate_head(text, max_tokens)
+    tail = truncate_tail(text, max_tokens)
+    assert text.startswith(head)
+    assert text.endswith(tail)
+    assert count_tokens(head) <= max_tokens
+    assert count_tokens(tail) <= max_tokens
+    assert count_tokens(truncate_head_tail(text, max_tokens)) <= max_tokens
+    if count_tokens(text) <= max_tokens:
+        assert head.strip() == text.strip()
+
+
+def test_reducer():
+    long_doc = StrDocument("start " + "word " * 1000 + "end")
+    short_doc = StrDocument("short")
+    reducer = DocumentReducer(50, ReductionStrategy.HEAD_TAIL)
+    wrapped = reducer.wrap([long_doc, short_doc])
+    assert wrapped[1] is short_doc
+    assert isinstance(wrapped[0], ReducedDocument)
+    assert wrapped[0].digest() != long_doc.digest()
+    text = wrapped[0].read_text()
+    assert text.startswith("start") and text.endswith("end")
+    assert count_tokens(text) <= 50
+    assert str(wrapped[0]) == str(long_doc)
+
+
+def test_summaries_are_cached():
+    calls = []
+
+    def summarize(text, max_tokens):
+        calls.append(text)
+        return "summary " * 100
+
+    cache = Cache(":memory:")
+    doc = StrDocument("word " * 1000)
+    for _ in range(2):
+        reducer = DocumentReducer(20, ReductionStrategy.SUMMARY, cache, summarize=summarize, summarizer_id="test")
+        [reduced] = reducer.wrap([StrDocument(doc.text)])
+        assert count_tokens(reduced.read_text()) <= 20
+    assert len(calls) == 1
+
+
+def test_summary_requires_a_ranker_that_summarizes():
+    args = build_parser().parse_args(["c", ".", "--max-doc-tokens", "20", "--reduce", "summary"])
+    cache = Cache(":memory:")
+    reducer = build_reducer(args, cache, FakeRanker(), "fake", "m", "c")
+    assert reducer.wrap([StrDocument("word " * 50)])[0].read_text() == " ".join(["word"] * 20)
+    with pytest.raises(ValueError, match="not supported by SimulatedRanker"):
+        build_reducer(args, cache, SimulatedRanker(), "fake", "m", "c")
@@ -0,0 +1,33 @@
+import json
+from rank_files.algos import ComparisonTracker, tournament
+from rank_files.cache import Cache
+from rank_files.document import StrDocument
+from rank_files.ranker import SimulatedRanker
+from rank_files.trace import Tracer, annotate, stage
+
+
+def test_tracer(tmp_path):
+    tracer = Tracer()
+    tracker = ComparisonTracker(tracer=tracer)
+    ranker = SimulatedRanker(cache=Cache(":memory:"))
+    docs = [StrDocument(str(i)) for i in range(8)]
+    items = tracker.wrap(ranker.wrap_for_pairwise_comparison("crit", docs))
+    tournament(2, items)
+    assert len(tracer.traces) == tracker.total
+    first = tracer.to_json()[0]
+    assert first["cache_hit"] is False
+    assert {"cache", "model"} <= set(first["stages"])
+    assert "doc1" in first and "doc2" in first
+    assert "comparison" in tracer.summary()
+
+    tracer.write(str(tmp_path / "trace.jsonl"))
+    lines = (tmp_path / "trace.jsonl").read_text().splitlines()
+    assert len(lines) == tracker.total
+    tracer.write(str(tmp_path / "trace.json"))
+    events = json.loads((tmp_path / "trace.json").read_text())["traceEvents"]
+    assert sum(1 for event in events if event["name"] == "comparison") == tracker.total
+
+
+def test_hooks_without_tracer():
+    with stage("anything"):
+        annotate(ignored=True)
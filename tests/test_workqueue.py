@@ -0,0 +1,66 @@
+import os
+import subprocess
+import sys
+from rank_files.algos import tournament
+from rank_files.cache import Cache
+from rank_files.ranker import FakeRanker, ModelProvider, comparison_key
+from rank_files.document import StrDocument
+from rank_files.workqueue import QueueRanker, QueuedComparison, WorkQueue, run_worker
+
+
+def queued(criteria, doc1, doc2):
+    key = comparison_key(ModelProvider.FAKE, "m", criteria, doc1, doc2)
+    texts = sorted([doc1, doc2], key=lambda doc: doc.digest())
+    return QueuedComparison(key, criteria, texts[0].text, texts[1].text)
+
+
+def test_work_queue_leases(tmp_path):
+    queue = WorkQueue(str(tmp_path / "q.sqlite3"), lease_seconds=0, max_attempts=2)
+    item = queued("c", StrDocument("a"), StrDocument("b"))
+    entry_key = item.key.entry_key()
+    queue.enqueue([item])
+    assert queue.claim("w1", ModelProvider.FAKE, "other", 10) == []
+    assert queue.claim("w1", ModelProvider.FAKE, "m", 10) == [item]
+    # The lease has already expired, so another worker can take over.
+    assert queue.claim("w2", ModelProvider.FAKE, "m", 10) == [item]
+    assert queue.results([entry_key]) == {entry_key: ("claimed", None, "w2")}
+    queue.fail("w2", entry_key, "oops")
+    assert queue.results([entry_key])[entry_key][0] == "failed"
+    # Enqueuing a failed comparison again retries it.
+    queue.enqueue([item])
+    queue.lease_seconds = 60
+    assert queue.claim("w3", ModelProvider.FAKE, "m", 10) == [item]
+    assert queue.claim("w4", ModelProvider.FAKE, "m", 10) == []
+    queue.complete("w3", entry_key, item.key.doc1_digest)
+    assert queue.results([entry_key]) == {entry_key: ("done", item.key.doc1_digest, "w3")}
+    queue.remove([entry_key])
+    assert queue.results([entry_key]) == {}
+
+
+def test_run_worker(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    docs = [StrDocument(x) for x in "dbca"]
+    with Cache(path) as cache, WorkQueue(path) as queue:
+        queue.enqueue([queued("c", docs[0], docs[1]), queued("c", docs[2], docs[3])])
+        assert run_worker(queue, FakeRanker(), cache, ModelProvider.FAKE, "m", "w", concurrency=2, poll_interval=0.01, idle_exit=0) == 2
+        ranker = QueueRanker(ModelProvider.FAKE, "m", cache, queue)
+        assert ranker.choose_better("c", docs[0], docs[1]) is docs[1]
+        assert ranker.choose_better("c", docs[2], docs[3]) is docs[3]
+
+
+def test_distributed_tournament(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    env = dict(os.environ, RANK_FILES_PROVIDER="fake", RANK_FILES_MODEL="m", RANK_FILES_CACHE=path)
+    script = "import sys; sys.argv = ['rank-files-worker', '--idle-exit', '2', '--poll-interval', '0.01', '--id', sys.argv[1]]; from rank_files.workqueue import worker_main; worker_main()"
+    docs = [StrDocument(f"{i:03d}") for i in range(40, 0, -1)]
+    with Cache(path) as cache, WorkQueue(path) as queue:
+        workers = [subprocess.Popen([sys.executable, "-c", script, f"w{i}"], env=env) for i in range(2)]
+        try:
+            ranker = QueueRanker(ModelProvider.FAKE, "m", cache, queue, poll_interval=0.01)
+            wrapped = ranker.wrap_for_pairwise_comparison("c", docs)
+            result = ranker.unwrap(tournament(5, wrapped, prefetch=ranker.prefetch_wrapped))
+        finally:
+            for worker in workers:
+                assert worker.wait(timeout=60) == 0
+    assert [str(doc) for doc in result] == ["001", "002", "003", "004", "005"]
+    assert sum(ranker.total_by_worker.values()) >= 39